@@ -0,0 +1,26 @@
+# markdown_v2.py — Екранування тексту для Telegram MarkdownV2
+# Без залежностей, тож його імпортують і webapp.py, і telegram_handlers.py
+
+from functools import lru_cache
+
+# Таблиця екранування MarkdownV2: перед кожним спецсимволом додається зворотний слеш
+# https://core.telegram.org/bots/api#markdownv2-style
+_MDV2_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '_*[]()~`>#+-=|{}.!'})
+
+# Короткі фрагменти (джерела, назви фільтрів, кнопок) повторюються, тож результат для них кешується
+_MDV2_CACHED_MAX_LEN = 64
+
+@lru_cache(maxsize=4096)
+def _escape_markdown_v2_short(text: str) -> str:
+    return text.translate(_MDV2_ESCAPE_TABLE)
+
+# Функція для екранування тексту для MarkdownV2
+def escape_markdown_v2(text: str) -> str:
+    """
+    Екранує спеціальні символи MarkdownV2 у наданому тексті.
+    Один прохід str.translate замість окремого replace на кожен спецсимвол.
+    """
+    text = text if isinstance(text, str) else str(text)
+    if len(text) <= _MDV2_CACHED_MAX_LEN:
+        return _escape_markdown_v2_short(text)
+    return text.translate(_MDV2_ESCAPE_TABLE)
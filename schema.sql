@@ -162,9 +162,16 @@ CREATE TABLE IF NOT EXISTS translations_cache (
     original_lang TEXT NOT NULL,
     translated_text TEXT NOT NULL,
     translated_lang TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE (original_text, original_lang, translated_lang)
+    -- MD5 від оригінального тексту: ключ пошуку замість повного тексту (original_text лише для аудиту)
+    text_hash BYTEA GENERATED ALWAYS AS (decode(md5(original_text), 'hex')) STORED,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+-- Додавання хеш-ключа до таблиці translations_cache, якщо вона вже існувала
+ALTER TABLE translations_cache ADD COLUMN IF NOT EXISTS text_hash BYTEA GENERATED ALWAYS AS (decode(md5(original_text), 'hex')) STORED;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_translations_cache_hash_langs ON translations_cache (text_hash, original_lang, translated_lang);
+-- Стара унікальність за повним текстом: btree-ключ переповнюється на довгих текстах, а при кожному записі
+-- підтримувалися б обидва індекси. Її замінює хеш-індекс вище
+ALTER TABLE translations_cache DROP CONSTRAINT IF EXISTS translations_cache_original_text_original_lang_translated_lang_key;
 
 -- Додавання/оновлення таблиці ratings
 CREATE TABLE IF NOT EXISTS ratings (
@@ -313,12 +320,143 @@ CREATE TABLE IF NOT EXISTS source_stats (
     last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Фільтри source/language/country порівнюються точно (lower(col) = lower(value)), а не через ILIKE.
+-- Збережені раніше шаблони з '%' зводяться до точного значення ('bbc%' -> 'bbc'), інакше вони нічого не знаходили б;
+-- '_' лишається як є: літерал збігається сам із собою. Повторний запуск нічого не змінює.
+UPDATE filters SET
+    source = NULLIF(btrim(replace(source, '%', '')), ''),
+    language = NULLIF(btrim(replace(language, '%', '')), ''),
+    country = NULLIF(btrim(replace(country, '%', '')), '')
+WHERE source LIKE '%\%%' OR language LIKE '%\%%' OR country LIKE '%\%%';
+
 -- Створення або перестворення індексів. IF NOT EXISTS тут особливо корисний.
 CREATE INDEX IF NOT EXISTS idx_news_published_expires_moderation ON news (published_at DESC, expires_at, moderation_status);
 CREATE INDEX IF NOT EXISTS idx_filters_user_id ON filters (user_id);
 CREATE INDEX IF NOT EXISTS idx_blocks_user_type_value ON blocks (user_id, block_type, value);
-CREATE INDEX IF NOT EXISTS idx_bookmarks_user_id ON bookmarks (user_id);
 CREATE INDEX IF NOT EXISTS idx_user_stats_user_id ON user_stats (user_id);
 CREATE INDEX IF NOT EXISTS idx_comments_news_id ON comments (news_id);
-CREATE INDEX IF NOT EXISTS idx_user_news_views_user_news ON user_news_views (user_id, news_id);
-CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users (telegram_id);
+-- Унікальне обмеження UNIQUE (user_id, news_id) вже створює індекс, який обслуговує анти-join
+-- NOT EXISTS у стрічці новин, тож окремий індекс по тих самих стовпцях зайвий
+DROP INDEX IF EXISTS idx_user_news_views_user_news;
+-- Анти-join буде index-only лише при актуальній карті видимості; таблиця майже лише росте,
+-- тому autovacuum запускається частіше, ніж за замовчуванням (20% нових рядків)
+ALTER TABLE user_news_views SET (autovacuum_vacuum_insert_scale_factor = 0.02, autovacuum_vacuum_scale_factor = 0.05);
+-- Унікальний індекс по telegram_id — арбітр для INSERT ... ON CONFLICT (telegram_id) у /users/register;
+-- звичайний індекс по тому ж стовпцю після нього зайвий
+-- Наявні дублікати telegram_id зливаються в найстаріший рядок (найменший id): усі зовнішні ключі на users
+-- переводяться на нього, а там, де це порушило б унікальність (user_stats, subscriptions тощо),
+-- рядки дубліката видаляються; після цього самі дублікати видаляються з users
+DO $$
+DECLARE
+    fk RECORD;
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM users WHERE telegram_id IS NOT NULL GROUP BY telegram_id HAVING count(*) > 1
+    ) THEN
+        RETURN;
+    END IF;
+
+    CREATE TEMP TABLE users_duplicate_map ON COMMIT DROP AS
+    SELECT id AS duplicate_id, keep_id
+    FROM (
+        SELECT id, min(id) OVER (PARTITION BY telegram_id) AS keep_id
+        FROM users
+        WHERE telegram_id IS NOT NULL
+    ) u
+    WHERE id <> keep_id;
+
+    FOR fk IN
+        SELECT c.conrelid::regclass AS tbl, a.attname AS col
+        FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+        WHERE c.contype = 'f' AND c.confrelid = 'users'::regclass AND cardinality(c.conkey) = 1
+    LOOP
+        BEGIN
+            EXECUTE format(
+                'UPDATE %s t SET %I = m.keep_id FROM users_duplicate_map m WHERE t.%I = m.duplicate_id',
+                fk.tbl, fk.col, fk.col
+            );
+        EXCEPTION WHEN unique_violation THEN
+            EXECUTE format(
+                'DELETE FROM %s t USING users_duplicate_map m WHERE t.%I = m.duplicate_id',
+                fk.tbl, fk.col
+            );
+        END;
+    END LOOP;
+
+    DELETE FROM users u USING users_duplicate_map m WHERE u.id = m.duplicate_id;
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_telegram_id_unique ON users (telegram_id);
+DROP INDEX IF EXISTS idx_users_telegram_id;
+-- Назва добірки унікальна для користувача без урахування регістру: INSERT у /custom_feeds/create
+-- сам перевіряє унікальність (UniqueViolationError -> 409) без попереднього SELECT.
+-- Наявні дублікати, що відрізняються лише регістром, перейменовуються (до назви додається id),
+-- а не видаляються: на добірки посилається users.current_feed_id
+UPDATE custom_feeds c
+SET feed_name = c.feed_name || ' (' || c.id || ')'
+FROM (
+    SELECT id, row_number() OVER (PARTITION BY user_id, lower(feed_name) ORDER BY id) AS rn
+    FROM custom_feeds
+) d
+WHERE d.id = c.id AND d.rn > 1;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_custom_feeds_user_lower_name ON custom_feeds (user_id, lower(feed_name));
+-- Індекси для курсорної пагінації стрічки новин і закладок
+CREATE INDEX IF NOT EXISTS idx_news_published_at_id ON news (published_at DESC, id DESC);
+-- Покриває вибірку закладок користувача: порядок за датою та news_id беруться прямо з індексу
+CREATE INDEX IF NOT EXISTS idx_bookmarks_user_created_news ON bookmarks (user_id, created_at DESC, news_id DESC);
+-- Індекс лише по user_id — префікс попереднього індексу, тому зайвий
+DROP INDEX IF EXISTS idx_bookmarks_user_id;
+-- Фільтри стрічки (джерело, мова, теги) беруться з рядка filters через LEFT JOIN і стоять під OR ... IS NULL,
+-- тож планувальник не може застосувати до них ні lower()-індекси, ні GIN по тегах: стрічка йде
+-- по idx_news_published_at_id і фільтрує на льоту. Зайві індекси лише сповільнюють запис у news
+DROP INDEX IF EXISTS idx_news_lower_source_published;
+DROP INDEX IF EXISTS idx_news_lower_lang_published;
+DROP INDEX IF EXISTS idx_news_tags_gin;
+-- Частковий індекс під вибірку схвалених не дублікатів за датою
+CREATE INDEX IF NOT EXISTS idx_news_approved_published ON news (published_at DESC) WHERE moderation_status = 'approved' AND is_duplicate = FALSE;
+-- Схвалені коментарі новини в порядку створення (GET /comments/{news_id})
+CREATE INDEX IF NOT EXISTS idx_comments_news_approved_created ON comments (news_id, created_at) WHERE moderation_status = 'approved';
+-- Жоден запит не фільтрує за ai_classified_topics — GIN-індекс лише сповільнює запис
+DROP INDEX IF EXISTS idx_news_ai_classified_topics_gin;
+
+-- Представлення news_recent_approved (схвалені новини за 48 годин) ніхто не читає: стрічка й тренди
+-- працюють з news, бо новини з /news/add лишаються 'pending'. Прибираємо його разом з індексами,
+-- щоб не оновлювати щохвилини даремно
+DROP MATERIALIZED VIEW IF EXISTS news_recent_approved;
+
+-- Матеріалізоване представлення трендів: перегляди за останні 24 години та середня оцінка
+-- для кожної новини. Перегляди й оцінки агрегуються окремо, щоб JOIN не множив рядки.
+CREATE MATERIALIZED VIEW IF NOT EXISTS trending_scores AS
+SELECT v.news_id,
+       v.view_count,
+       COALESCE(r.avg_rating, 0) AS avg_rating,
+       v.view_count + COALESCE(r.avg_rating, 0) * 10 AS trend_score
+FROM (
+    SELECT news_id, COUNT(*) AS view_count
+    FROM user_news_views
+    WHERE last_viewed_at >= NOW() - INTERVAL '24 hours'
+    GROUP BY news_id
+) v
+LEFT JOIN (
+    SELECT news_id, AVG(value) AS avg_rating
+    FROM ratings
+    GROUP BY news_id
+) r ON r.news_id = v.news_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_trending_scores_news_id ON trending_scores (news_id);
+CREATE INDEX IF NOT EXISTS idx_trending_scores_trend_score ON trending_scores (trend_score DESC);
+
+-- Сповіщення застосунку про нові новини через LISTEN/NOTIFY (канал news_added):
+-- webapp.py запускає автоматичні сповіщення користувачів одразу, а не раз на 15 хвилин.
+-- Тригер на рівні оператора: пакетна вставка дає одне сповіщення.
+CREATE OR REPLACE FUNCTION notify_news_added() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('news_added', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_news_added_notify ON news;
+CREATE TRIGGER trg_news_added_notify
+AFTER INSERT ON news
+FOR EACH STATEMENT EXECUTE FUNCTION notify_news_added();
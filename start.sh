@@ -1,2 +1,2 @@
 #!/bin/bash
-uvicorn webapp:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+uvicorn webapp:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools
\ No newline at end of file
@@ -10,6 +10,9 @@ from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
+# Єдина реалізація екранування MarkdownV2 — спільна з webapp.py
+from markdown_v2 import escape_markdown_v2
+
 # API_URL буде передано з webapp.py через змінні оточення
 API_URL = os.getenv("WEBAPP_URL", "http://localhost:8000")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "your_bot_username") # Для посилання-запрошення
@@ -76,28 +79,6 @@ class CommentStates(StatesGroup):
     waiting_for_content = State()
     waiting_for_view_news_id = State()
 
-# Функція для екранування тексту для MarkdownV2
-def escape_markdown_v2(text: str) -> str:
-    """
-    Екранує спеціальні символи MarkdownV2 у наданому тексті.
-    """
-    if not isinstance(text, (str, int, float)):
-        text = str(text)
-
-    special_chars = [
-        '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+',
-        '-', '=', '|', '{', '}', '.', '!'
-    ]
-    
-    escaped_text = text
-    for char in special_chars:
-        escaped_text = escaped_text.replace(char, '\\' + char)
-    
-    if 'http' in text or 'https' in text:
-        escaped_text = escaped_text.replace('\\/', '/')
-    
-    return escaped_text
-
 # == КЛАВІАТУРИ ==
 main_keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, keyboard=[
     [types.KeyboardButton(text="📰 Новини"), types.KeyboardButton(text="🎯 Фільтри")],
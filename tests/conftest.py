@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Тести імпортують webapp.py з кореня репозиторію
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# webapp створює Bot при імпорті, тож потрібен токен коректного формату; до Telegram тести не звертаються
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
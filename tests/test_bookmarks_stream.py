@@ -0,0 +1,47 @@
+import asyncio
+from datetime import datetime
+
+import orjson
+
+from webapp import json_array_stream
+
+
+async def _rows(rows):
+    for row in rows:
+        yield row
+
+
+def _collect(rows):
+    async def collect():
+        return [chunk async for chunk in json_array_stream(_rows(rows))]
+    return asyncio.run(collect())
+
+
+def test_empty_stream_is_empty_array():
+    chunks = _collect([])
+    assert chunks == [b"[", b"]"]
+    assert orjson.loads(b"".join(chunks)) == []
+
+
+def test_single_row_has_no_separator():
+    chunks = _collect([{"id": 1, "title": "A"}])
+    assert chunks[1] == b'{"id":1,"title":"A"}'
+    assert orjson.loads(b"".join(chunks)) == [{"id": 1, "title": "A"}]
+
+
+def test_rows_are_comma_separated_and_parse_as_json():
+    bookmarked_at = datetime(2024, 5, 1, 12, 30)
+    rows = [
+        {"id": 1, "title": "Перша", "link": None, "bookmarked_at": bookmarked_at},
+        {"id": 2, "title": 'З "лапками"', "link": "https://example.com", "bookmarked_at": bookmarked_at},
+        {"id": 3, "title": "Третя", "link": None, "bookmarked_at": bookmarked_at},
+    ]
+    chunks = _collect(rows)
+    # '[' + по частині на рядок + ']'; кожен рядок після першого починається з коми
+    assert len(chunks) == len(rows) + 2
+    assert not chunks[1].startswith(b",")
+    assert all(chunk.startswith(b",") for chunk in chunks[2:-1])
+    parsed = orjson.loads(b"".join(chunks))
+    assert [item["id"] for item in parsed] == [1, 2, 3]
+    assert parsed[1]["title"] == 'З "лапками"'
+    assert parsed[0]["bookmarked_at"] == "2024-05-01T12:30:00"
@@ -0,0 +1,100 @@
+import asyncio
+import inspect
+
+import pytest
+
+from webapp import call_route, clear_state_after
+
+
+class FakeState:
+    """Замінник FSMContext: запам'ятовує виклики set_state."""
+
+    def __init__(self):
+        self.set_state_calls = []
+
+    async def set_state(self, value):
+        self.set_state_calls.append(value)
+
+
+def _make_handler(calls):
+    @clear_state_after
+    async def handler(event, state):
+        """Докстрінг хендлера."""
+        calls.append(event)
+        return "done"
+    return handler
+
+
+def test_clears_state_when_state_was_set():
+    calls, state = [], FakeState()
+    assert asyncio.run(_make_handler(calls)("msg", state, raw_state="Some:step")) == "done"
+    assert calls == ["msg"]
+    assert state.set_state_calls == [None]
+
+
+def test_skips_write_when_state_already_empty():
+    state = FakeState()
+    asyncio.run(_make_handler([])("msg", state, raw_state=None))
+    assert state.set_state_calls == []
+
+
+def test_clears_unconditionally_without_raw_state():
+    # Прямий виклик з коду (msg, state): стан до виклику невідомий
+    state = FakeState()
+    asyncio.run(_make_handler([])("msg", state))
+    assert state.set_state_calls == [None]
+
+
+def test_clears_state_when_handler_raises():
+    @clear_state_after
+    async def failing(event, state):
+        raise RuntimeError("boom")
+
+    state = FakeState()
+    with pytest.raises(RuntimeError):
+        asyncio.run(failing("msg", state, raw_state="Some:step"))
+    assert state.set_state_calls == [None]
+
+
+def test_forwards_only_dependencies_the_handler_declares():
+    received = {}
+
+    @clear_state_after
+    async def handler(event, state, bot):
+        received["bot"] = bot
+
+    asyncio.run(handler("msg", FakeState(), raw_state=None, bot="bot", event_from_user="user"))
+    assert received == {"bot": "bot"}
+
+
+def test_forwards_everything_to_handler_with_var_keyword():
+    received = {}
+
+    @clear_state_after
+    async def handler(event, state, **kwargs):
+        received.update(kwargs)
+
+    asyncio.run(handler("msg", FakeState(), raw_state=None, bot="bot", command="cmd"))
+    assert received == {"bot": "bot", "command": "cmd"}
+
+
+def test_wrapper_is_not_unwrapped_by_aiogram():
+    # aiogram будує аргументи з inspect.unwrap(callback): він має бачити сигнатуру обгортки з raw_state
+    handler = _make_handler([])
+    assert inspect.unwrap(handler) is handler
+    assert "raw_state" in inspect.signature(handler).parameters
+    assert handler.__name__ == "handler"
+    assert handler.__doc__ == "Докстрінг хендлера."
+
+
+def test_call_route_passes_raw_state_only_to_state_clearing_handlers():
+    received = []
+
+    async def plain(event, state):
+        received.append("plain")
+
+    state = FakeState()
+    asyncio.run(call_route(plain, "msg", state, "Some:step"))
+    asyncio.run(call_route(_make_handler(received), "msg", state, None))
+    assert received == ["plain", "msg"]
+    assert state.set_state_calls == []
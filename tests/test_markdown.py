@@ -0,0 +1,43 @@
+import markdown_v2
+from markdown_v2 import escape_markdown_v2
+from webapp import format_news_list
+
+
+MDV2_SPECIAL_CHARS = '_*[]()~`>#+-=|{}.!'
+
+
+def test_escapes_every_special_char():
+    assert escape_markdown_v2(MDV2_SPECIAL_CHARS) == "".join("\\" + char for char in MDV2_SPECIAL_CHARS)
+
+
+def test_plain_text_is_unchanged():
+    assert escape_markdown_v2("Новини дня 2024") == "Новини дня 2024"
+
+
+def test_non_string_is_converted():
+    assert escape_markdown_v2(-1.5) == "\\-1\\.5"
+
+
+def test_long_text_matches_short_path():
+    # Рядки довші за поріг кешу екрануються без lru_cache, але з тим самим результатом
+    fragment = "a.b-c!"
+    long_text = fragment * (markdown_v2._MDV2_CACHED_MAX_LEN // len(fragment) + 1)
+    assert len(long_text) > markdown_v2._MDV2_CACHED_MAX_LEN
+    assert escape_markdown_v2(long_text) == escape_markdown_v2(fragment) * (len(long_text) // len(fragment))
+
+
+def test_url_is_escaped_like_any_text():
+    assert escape_markdown_v2("https://example.com/a_b") == "https://example\\.com/a\\_b"
+
+
+def test_format_news_list():
+    items = [{"id": 1, "title": "Перша."}, {"id": 22, "title": "Друга (оновлено)"}]
+    assert format_news_list("*Список:*\n\n", items) == (
+        "*Список:*\n\n"
+        "\\- `1`: Перша\\.\n"
+        "\\- `22`: Друга \\(оновлено\\)\n"
+    )
+
+
+def test_format_news_list_empty():
+    assert format_news_list("*Список:*\n\n", []) == "*Список:*\n\n"
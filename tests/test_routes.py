@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram import types
+
+import webapp
+from webapp import (
+    CALLBACK_EXACT_ROUTES,
+    CALLBACK_PREFIX_ROUTES,
+    MENU_ROUTES,
+    callback_dispatch_handler,
+    callback_route_filter,
+    find_callback_route,
+    menu_dispatch_handler,
+)
+
+
+def _module_keyboards(markup_type):
+    return [value for value in vars(webapp).values() if isinstance(value, markup_type)]
+
+
+def test_every_reply_keyboard_button_has_a_menu_route():
+    texts = {
+        button.text
+        for keyboard in _module_keyboards(types.ReplyKeyboardMarkup)
+        for row in keyboard.keyboard
+        for button in row
+    }
+    assert texts
+    assert texts - set(MENU_ROUTES) == set()
+
+
+def test_menu_dispatch_calls_route_with_message_and_state(monkeypatch):
+    calls = []
+
+    async def route(msg, state):
+        calls.append((msg, state))
+
+    monkeypatch.setitem(MENU_ROUTES, "📰 Новини", route)
+    msg = SimpleNamespace(text="📰 Новини")
+    asyncio.run(menu_dispatch_handler(msg, "state", None))
+    assert calls == [(msg, "state")]
+
+
+def test_menu_dispatch_passes_raw_state_to_state_clearing_handlers(monkeypatch):
+    calls = []
+
+    async def route(msg, state, raw_state):
+        calls.append(raw_state)
+    route.accepts_raw_state = True
+
+    monkeypatch.setitem(MENU_ROUTES, "📰 Новини", route)
+    asyncio.run(menu_dispatch_handler(SimpleNamespace(text="📰 Новини"), "state", "SomeStates:step"))
+    assert calls == ["SomeStates:step"]
+
+
+def test_every_inline_keyboard_callback_has_a_route():
+    callback_data = {
+        button.callback_data
+        for keyboard in _module_keyboards(types.InlineKeyboardMarkup)
+        for row in keyboard.inline_keyboard
+        for button in row
+        if button.callback_data
+    }
+    assert callback_data
+    assert {data for data in callback_data if find_callback_route(data) is None} == set()
+
+
+def test_find_callback_route_exact_match():
+    assert find_callback_route("buy_premium") is CALLBACK_EXACT_ROUTES["buy_premium"]
+    assert find_callback_route("add_email") is find_callback_route("change_email")
+
+
+def test_find_callback_route_exact_wins_over_similar_prefix():
+    # "unsubscribe_daily" — точний маршрут, а не префікс "subscribe_daily_"
+    assert find_callback_route("unsubscribe_daily") is CALLBACK_EXACT_ROUTES["unsubscribe_daily"]
+
+
+def test_find_callback_route_prefix_with_several_underscores():
+    assert find_callback_route("add_feed_filter_tag") is CALLBACK_PREFIX_ROUTES["add_feed_filter_"]
+    assert find_callback_route("set_view_mode_manual") is CALLBACK_PREFIX_ROUTES["set_view_mode_"]
+    assert find_callback_route("like_42") is CALLBACK_PREFIX_ROUTES["like_"]
+
+
+def test_find_callback_route_unknown():
+    assert find_callback_route("unknown") is None
+    assert find_callback_route("unknown_prefix_1") is None
+    assert find_callback_route("") is None
+
+
+def test_callback_route_filter_injects_route():
+    assert callback_route_filter(SimpleNamespace(data="report_news")) == {"route": CALLBACK_PREFIX_ROUTES["report_"]}
+    assert callback_route_filter(SimpleNamespace(data="unknown")) is False
+    assert callback_route_filter(SimpleNamespace(data=None)) is False
+
+
+def test_callback_dispatch_calls_route():
+    calls = []
+
+    async def route(callback_query, state):
+        calls.append((callback_query, state))
+
+    callback_query = SimpleNamespace(data="report_news")
+    asyncio.run(callback_dispatch_handler(callback_query, "state", None, route))
+    assert calls == [(callback_query, "state")]
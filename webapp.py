@@ -1,20 +1,33 @@
 # webapp.py — FastAPI backend для Telegram AI News бота з підтримкою 500+ функцій
 
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
-from datetime import datetime, timedelta
+from fastapi import FastAPI, Request, Response, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, ValidationError
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable, Deque, AsyncIterator
+from collections import deque
+from datetime import datetime, timezone
 import os
 import asyncpg
-import json
-import random # Для мокованих AI функцій
+import orjson
+import hashlib
+import inspect
+import re
+import random # Для джитера інтервалів фонових задач
 import asyncio # Для асинхронних черг
 import logging
+from functools import update_wrapper
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
+import redis.asyncio as aioredis
 
 # Aiogram імпорти
-from aiogram import Bot, Dispatcher, types
-from aiogram.enums import ParseMode
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.enums import ChatAction, ContentType, ParseMode
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 # from aiogram.utils.executor import start_webhook # Використовуємо start_webhook для запуску бота
@@ -22,6 +35,8 @@ from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_webhook
 
 from dotenv import load_dotenv
 
+from markdown_v2 import escape_markdown_v2
+
 load_dotenv()
 
 # Налаштування логування
@@ -30,14 +45,149 @@ logging.basicConfig(level=logging.INFO)
 # ==== DATABASE CONNECTION ====
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-async def get_db_connection():
-    """Функція для отримання з'єднання з базою даних."""
+# FastAPI app definition
+# Пул підключень до БД створюється при старті (див. on_startup) і доступний як app.state.pool
+app = FastAPI(default_response_class=ORJSONResponse)
+# Стискаємо JSON-відповіді від 1 КБ (стрічка новин з повним текстом добре стискається); дрібні відповіді йдуть як є
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+def _orjson_default(obj):
+    """Серіалізує типи, яких orjson не підтримує напряму (asyncpg.Record)."""
+    if isinstance(obj, asyncpg.Record):
+        return dict(obj)
+    raise TypeError
+
+class RecordJSONResponse(ORJSONResponse):
+    """
+    JSON-відповідь, що серіалізує списки asyncpg.Record напряму через orjson.
+    Повертається з ендпоінтів як є, тож FastAPI не проганяє результат через jsonable_encoder.
+    """
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_orjson_default)
+
+def _orjson_dumps_str(value) -> str:
+    """Серіалізує значення в JSON-рядок (текстовий кодек jsonb, тіла запитів aiohttp)."""
+    return orjson.dumps(value).decode()
+
+async def init_db_connection(conn: asyncpg.Connection):
+    """Налаштовує кожне нове з'єднання пулу: jsonb кодується/декодується через orjson."""
+    await conn.set_type_codec('jsonb', encoder=_orjson_dumps_str, decoder=orjson.loads, schema='pg_catalog')
+
+# Скільки чекати на вільне з'єднання з пулу; при вичерпаному пулі запит завершується 503, а не висить
+POOL_ACQUIRE_TIMEOUT = 2.0 # секунд
+
+async def create_db_pool() -> asyncpg.Pool:
+    """Створює пул підключень до бази даних."""
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        init=init_db_connection,
+        min_size=4,
+        max_size=32,
+        statement_cache_size=512, # Кеш підготовлених запитів на кожне з'єднання
+        max_inactive_connection_lifetime=300, # Закриваємо з'єднання, що простоюють понад 5 хвилин
+        command_timeout=60, # Запасний клієнтський таймаут на будь-який запит
+    )
+
+@app.exception_handler(asyncio.TimeoutError)
+async def db_timeout_handler(request: Request, exc: asyncio.TimeoutError):
+    """Вичерпаний пул або command_timeout — тимчасова перевантаженість, а не помилка сервера."""
+    logging.error(f"Таймаут БД при обробці {request.url.path}")
+    return ORJSONResponse(status_code=503, content={"detail": "Сервіс тимчасово перевантажений, спробуйте пізніше."})
+
+# Обмеження часу для читання в публічних кешованих ендпоінтах (коментарі, тренди):
+# запит, що вийшов за межі, обривається сервером і з'єднання повертається в пул
+PUBLIC_READ_TIMEOUTS_SQL = "SET LOCAL statement_timeout = '500ms'; SET LOCAL lock_timeout = '200ms'"
+# Персональна стрічка не кешується і на холодному кеші може читатися довше:
+# 500 мс перетворювали б повільну сторінку на 503 для кнопки «Новини»
+FEED_READ_TIMEOUTS_SQL = "SET LOCAL statement_timeout = '5s'; SET LOCAL lock_timeout = '1s'"
+
+@asynccontextmanager
+async def public_read_transaction(conn: asyncpg.Connection, timeouts_sql: str = PUBLIC_READ_TIMEOUTS_SQL):
+    """
+    Read-only транзакція з SET LOCAL statement_timeout/lock_timeout (за замовчуванням — для публічних запитів).
+    Перерваний за таймаутом запит перетворюється на 503.
+    """
+    async with conn.transaction(readonly=True):
+        await conn.execute(timeouts_sql)
+        try:
+            yield
+        except asyncpg.QueryCanceledError:
+            raise HTTPException(status_code=503, detail="Запит виконувався надто довго, спробуйте пізніше.")
+
+# ==== CACHE (REDIS) ====
+# Необов'язковий: якщо REDIS_URL не задано, кешування вимкнене і запити йдуть прямо в БД
+REDIS_URL = os.getenv("REDIS_URL")
+COMMENTS_CACHE_TTL = 60 # секунд
+TRENDING_CACHE_TTL = 30 # секунд
+PROFILE_CACHE_TTL = 60 # секунд
+ANALYTICS_CACHE_TTL = 30 # секунд
+FILTERS_CACHE_TTL = 300 # секунд
+RECOMMEND_CACHE_TTL = 60 # секунд
+SUMMARY_CACHE_TTL = 24 * 60 * 60 # секунд; резюме новини не змінюється, а генерація дорога
+
+# Посилання на фонові задачі оновлення кешу, щоб їх не прибрав збирач сміття
+_cache_refresh_tasks: set = set()
+
+async def _store_cached_json(key: str, ttl: int, payload: bytes):
+    """Зберігає відповідь на 2*ttl і позначку свіжості на ttl."""
+    async with app.state.redis.pipeline(transaction=False) as pipe:
+        pipe.set(key, payload, ex=ttl * 2)
+        pipe.set(f"{key}:fresh", 1, ex=ttl)
+        await pipe.execute()
+
+async def _refresh_cached_json(key: str, ttl: int, loader):
+    """Фонове оновлення застарілого запису кешу."""
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        return conn
+        await _store_cached_json(key, ttl, await loader())
     except Exception as e:
-        logging.error(f"Помилка підключення до бази даних: {e}")
-        raise HTTPException(status_code=500, detail="Помилка підключення до бази даних")
+        logging.error(f"Помилка оновлення кешу {key}: {e}")
+    finally:
+        await app.state.redis.delete(f"{key}:lock")
+
+async def cached_json(key: str, ttl: int, loader) -> bytes:
+    """
+    Read-through кеш серіалізованого JSON у Redis зі stale-while-revalidate.
+    loader — корутина без аргументів, що повертає вже серіалізований JSON (bytes).
+    Свіжий запис віддається як є; застарілий (старший за ttl) віддається одразу,
+    а оновлення запускається у фоні лише одним запитом (блокування через SET NX).
+    """
+    redis_client = app.state.redis
+    if redis_client is not None:
+        try:
+            cached, fresh = await redis_client.mget(key, f"{key}:fresh")
+            if cached is not None:
+                if fresh is None and await redis_client.set(f"{key}:lock", 1, nx=True, ex=ttl):
+                    task = asyncio.create_task(_refresh_cached_json(key, ttl, loader))
+                    _cache_refresh_tasks.add(task)
+                    task.add_done_callback(_cache_refresh_tasks.discard)
+                return cached
+        except Exception as e:
+            logging.error(f"Помилка читання кешу {key}: {e}")
+
+    payload = await loader()
+    if redis_client is not None:
+        try:
+            await _store_cached_json(key, ttl, payload)
+        except Exception as e:
+            logging.error(f"Помилка запису кешу {key}: {e}")
+    return payload
+
+async def cached_json_response(key: str, ttl: int, loader) -> Response:
+    """Відповідь API з кешу cached_json."""
+    return json_bytes_response(await cached_json(key, ttl, loader))
+
+def json_bytes_response(payload: bytes) -> Response:
+    """Віддає вже серіалізований JSON як є, без повторної серіалізації."""
+    return Response(content=payload, media_type="application/json")
+
+async def invalidate_cached(*keys: str):
+    """Видаляє записи кешу разом із позначками свіжості після зміни даних, що в них кешуються."""
+    if app.state.redis is None:
+        return
+    try:
+        await app.state.redis.delete(*keys, *(f"{key}:fresh" for key in keys))
+    except Exception as e:
+        logging.error(f"Помилка інвалідації кешу {keys}: {e}")
 
 # ==== MODELS ====
 class SummaryRequest(BaseModel):
@@ -81,6 +231,9 @@ class UserRegisterRequest(BaseModel):
     auto_notifications: Optional[bool] = None
     view_mode: Optional[str] = None
 
+class UserToggleRequest(BaseModel):
+    field: str
+
 class FilterUpdateRequest(BaseModel):
     user_id: int
     tag: Optional[str] = None
@@ -145,8 +298,11 @@ WEBAPP_URL = os.getenv("WEBAPP_URL", "http://localhost:8000")
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"{WEBAPP_URL}{WEBHOOK_PATH}"
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage() # Використовуємо MemoryStorage для Aiogram v3+
+# Параметри запитів до Bot API (зокрема reply_markup кожної відповіді) серіалізуються через orjson
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(json_loads=orjson.loads, json_dumps=_orjson_dumps_str))
+# Стани FSM зберігаються в Redis, якщо він налаштований: переживають рестарт і спільні для всіх воркерів.
+# Без REDIS_URL — MemoryStorage в межах процесу
+storage = RedisStorage.from_url(REDIS_URL) if REDIS_URL else MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 MONOBANK_CARD_NUMBER = os.getenv("MONOBANK_CARD_NUMBER", "XXXX XXXX XXXX XXXX")
@@ -206,833 +362,1279 @@ class ProfileSettingsStates(StatesGroup):
     waiting_for_email = State()
     waiting_for_view_mode = State()
 
-# Функція для екранування тексту для MarkdownV2
-def escape_markdown_v2(text: str) -> str:
-    """
-    Екранує спеціальні символи MarkdownV2 у наданому тексті.
-    """
-    if not isinstance(text, (str, int, float)):
-        text = str(text)
-
-    # Список символів, які потребують екранування в MarkdownV2
-    # https://core.telegram.org/bots/api#markdownv2-style
-    # Важливо: зворотний слеш `\` сам по собі потребує екранування
-    special_chars = [
-        '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+',
-        '-', '=', '|', '{', '}', '.', '!'
-    ]
-    
-    escaped_text = text
-    for char in special_chars:
-        # Екрануємо символ, якщо він є в тексті, подвійним зворотним слешем
-        # щоб уникнути SyntaxWarning у f-рядках, де `\` вже є спецсимволом
-        escaped_text = escaped_text.replace(char, '\\' + char)
-    
-    # Спеціальна обробка для символів, які можуть бути частиною URL, але також є спецсимволами MDV2
-    # Це спроба зробити URL більш "безпечними" без надмірного екранування
-    if 'http' in text or 'https' in text:
-        # Не екрануємо `/` у URL
-        escaped_text = escaped_text.replace('\\/', '/')
-        # Можна додати інші винятки, якщо це викликає проблеми з URL
-    
-    return escaped_text
+def format_news_list(header: str, items) -> str:
+    """Список новин "ID: заголовок" для MarkdownV2; рядки збираються через join, а не +=."""
+    return header + "".join(
+        f"\\- `{escape_markdown_v2(str(item['id']))}`: {escape_markdown_v2(item['title'])}\n" for item in items
+    )
 
 # ==== ДОПОМІЖНІ ФУНКЦІЇ БД ====
+# Дії, що мають лічильник у user_stats
+USER_STATS_ACTIONS = ("viewed", "saved", "reported")
+
+# Один запит для всіх дій: лічильник дії ($2) збільшується на 1, решта — на 0
+UPDATE_USER_STATS_QUERY = """
+    INSERT INTO user_stats (user_id, viewed, saved, reported, last_active)
+    VALUES ($1, ($2 = 'viewed')::INT, ($2 = 'saved')::INT, ($2 = 'reported')::INT, NOW())
+    ON CONFLICT (user_id) DO UPDATE SET
+        viewed = user_stats.viewed + EXCLUDED.viewed,
+        saved = user_stats.saved + EXCLUDED.saved,
+        reported = user_stats.reported + EXCLUDED.reported,
+        last_active = NOW()
+"""
+
 async def update_user_stats(conn, user_id: int, action: str):
     """Оновлює статистику користувача."""
+    if action not in USER_STATS_ACTIONS:
+        return
     try:
-        if action == "viewed":
-            await conn.execute("INSERT INTO user_stats (user_id, viewed, last_active) VALUES ($1, 1, NOW()) ON CONFLICT (user_id) DO UPDATE SET viewed = user_stats.viewed + 1, last_active = NOW()", user_id)
-        elif action == "saved":
-            await conn.execute("INSERT INTO user_stats (user_id, saved, last_active) VALUES ($1, 1, NOW()) ON CONFLICT (user_id) DO UPDATE SET saved = user_stats.saved + 1, last_active = NOW()", user_id)
-        elif action == "reported":
-            await conn.execute("INSERT INTO user_stats (user_id, reported, last_active) VALUES ($1, 1, NOW()) ON CONFLICT (user_id) DO UPDATE SET reported = user_stats.reported + 1, last_active = NOW()", user_id)
-        # Додайте інші дії за потреби
+        await conn.execute(UPDATE_USER_STATS_QUERY, user_id, action)
     except Exception as e:
         logging.error(f"Помилка при оновленні статистики користувача {user_id} для дії {action}: {e}")
 
+# Стрічка новин користувача: один статичний запит, у якому фільтри користувача підтягуються
+# з таблиці filters через CTE (без окремого запиту), а порожній фільтр вимикає свою умову.
+# Тег, категорія та тип контенту зберігаються в n.tags, тому об'єднуються в один масив
+# для предиката включення (використовує GIN-індекс по tags).
+# Текст запиту не залежить від набору фільтрів, тож він готується один раз на з'єднання.
+NEWS_FEED_QUERY = """
+    WITH f AS (
+        SELECT array_remove(ARRAY[NULLIF(tag, ''), NULLIF(category, ''), NULLIF(content_type, '')], NULL) AS tag_filters,
+               NULLIF(source, '') AS source,
+               NULLIF(language, '') AS language,
+               NULLIF(country, '') AS country
+        FROM filters WHERE user_id = $1
+    )
+    SELECT n.id, n.title, n.content, n.lang, n.country, n.tags, n.source, n.link, n.published_at
+    FROM news n
+    LEFT JOIN f ON TRUE
+    WHERE NOT EXISTS (
+        SELECT 1 FROM user_news_views uv WHERE uv.user_id = $1 AND uv.news_id = n.id
+    ) -- Новини, які ще не були переглянуті цим користувачем
+      AND (f.tag_filters IS NULL OR cardinality(f.tag_filters) = 0 OR n.tags @> f.tag_filters)
+      AND (f.source IS NULL OR lower(n.source) = lower(f.source))
+      AND (f.language IS NULL OR lower(n.lang) = lower(f.language))
+      AND (f.country IS NULL OR lower(n.country) = lower(f.country))
+      AND ($2::TIMESTAMP IS NULL OR (n.published_at, n.id) < ($2::TIMESTAMP, $3::INT))
+    ORDER BY n.published_at DESC, n.id DESC
+    LIMIT $4
+"""
+
+# Позначає видані новини переглянутими і збільшує лічильник viewed на їх кількість — один запит
+MARK_NEWS_VIEWED_QUERY = """
+    WITH v AS (
+        INSERT INTO user_news_views (user_id, news_id, viewed, first_viewed_at)
+        SELECT $1, news_id, TRUE, NOW() FROM unnest($2::INT[]) AS news_id
+        ON CONFLICT (user_id, news_id) DO UPDATE SET viewed = TRUE, last_viewed_at = NOW()
+        RETURNING 1
+    )
+    INSERT INTO user_stats (user_id, viewed, last_active)
+    SELECT $1, count(*), NOW() FROM v
+    ON CONFLICT (user_id) DO UPDATE SET viewed = user_stats.viewed + EXCLUDED.viewed, last_active = NOW()
+"""
+
+# Кеш відповідності telegram_id -> users.id (внутрішній ID користувача не змінюється)
+_uid_cache: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+
+async def resolve_uid(conn, telegram_id: int) -> Optional[int]:
+    """
+    Повертає внутрішній ID користувача за telegram_id, звертаючись до БД лише при промаху кешу.
+    conn може бути як з'єднанням, так і пулом (asyncpg.Pool теж має fetchval).
+    """
+    user_internal_id = _uid_cache.get(telegram_id)
+    if user_internal_id is None:
+        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", telegram_id)
+        if user_internal_id is not None:
+            _uid_cache[telegram_id] = user_internal_id
+    return user_internal_id
+
+USER_PROFILE_QUERY = "SELECT telegram_id, language, country, safe_mode, current_feed_id, is_premium, premium_expires_at, level, badges, inviter_id, email, auto_notifications, view_mode FROM users WHERE telegram_id = $1"
+
+# Профілі для хендлерів бота (той самий процес): повторне відкриття меню не йде ні в Redis, ні в БД
+_profile_cache: TTLCache = TTLCache(maxsize=10_000, ttl=45)
+
+async def get_user_profile(user_id: int) -> Optional[asyncpg.Record]:
+    """Профіль користувача за telegram_id з in-process кешу; None, якщо користувача не знайдено."""
+    user_profile = _profile_cache.get(user_id)
+    if user_profile is None:
+        async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+            user_profile = await conn.fetchrow(USER_PROFILE_QUERY, user_id)
+        if user_profile is not None:
+            _profile_cache[user_id] = user_profile
+    return user_profile
+
+# Посилання на задачі попереднього завантаження профілю, щоб їх не прибрав збирач сміття
+_profile_prefetch_tasks: set = set()
+
+def prefetch_user_profile(user_id: int):
+    """Завантажує профіль у кеш у фоні, якщо його там ще немає (не блокує хендлер)."""
+    if user_id in _profile_cache:
+        return
+    task = asyncio.create_task(get_user_profile(user_id))
+    _profile_prefetch_tasks.add(task)
+    task.add_done_callback(_profile_prefetch_tasks.discard)
+
+# Готовий текст статистики для show_analytics_handler: повторне натискання «Аналітика» без запиту і форматування
+_analytics_text_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+# Тренди однакові для всіх користувачів: натискання «Тренд» протягом TTL не звертаються до API
+_trending_cache: TTLCache = TTLCache(maxsize=8, ttl=TRENDING_CACHE_TTL)
+
+async def invalidate_profile(user_id: int):
+    """Скидає профіль користувача з in-process кешу та з Redis після його зміни."""
+    _profile_cache.pop(user_id, None)
+    await invalidate_cached(f"profile:{user_id}")
+
+# ==== ПАКЕТНИЙ ЗАПИС АКТИВНОСТІ КОРИСТУВАЧІВ ====
+# Події з /log_user_activity накопичуються в черзі та записуються в БД пакетами
+ACTIVITY_FLUSH_INTERVAL = 0.2 # секунд між скиданнями черги
+ACTIVITY_FLUSH_BATCH_SIZE = 500 # максимальна кількість подій в одному пакеті
+ACTIVITY_QUEUE_MAXSIZE = 10_000 # при заповненій черзі подія пишеться одразу (зворотний тиск на клієнта)
+ACTIVITY_MAX_ATTEMPTS = 3 # спроб запису пакета, після яких він іде в журнал помилок
+ACTIVITY_RETRY_DELAY = 1.0 # секунд очікування після невдалого запису
+activity_queue: asyncio.Queue = asyncio.Queue(maxsize=ACTIVITY_QUEUE_MAXSIZE)
+# Пакети, запис яких не вдався: (кількість спроб, події); повторюються раніше за нові події
+_activity_retry: Deque[Tuple[int, list]] = deque()
+
+async def write_user_activity(events: list) -> int:
+    """
+    Записує події активності одним COPY в interactions та одним оновленням user_stats.
+    Події з неіснуючими news_id відкидаються заздалегідь, щоб одне порушення FK не зривало весь COPY.
+    Повертає кількість записаних подій.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        known_news = {
+            row['id'] for row in await conn.fetch(
+                "SELECT id FROM news WHERE id = ANY($1::INT[])", list({event[1] for event in events})
+            )
+        }
+        rows = [event for event in events if event[1] in known_news]
+        if len(rows) < len(events):
+            logging.warning(f"Пропущено {len(events) - len(rows)} подій активності з неіснуючими новинами")
+        if not rows:
+            return 0
+
+        # Підсумовуємо лічильники статистики по користувачах (ті ж дії, що й в update_user_stats)
+        stats: Dict[int, Dict[str, int]] = {}
+        for user_internal_id, _, action in rows:
+            if action in USER_STATS_ACTIONS:
+                counters = stats.setdefault(user_internal_id, dict.fromkeys(USER_STATS_ACTIONS, 0))
+                counters[action] += 1
+
+        async with conn.transaction():
+            # created_at не передаємо: його ставить DEFAULT CURRENT_TIMESTAMP, як і в усіх інших записах
+            await conn.copy_records_to_table('interactions', records=rows, columns=['user_id', 'news_id', 'action'])
+            if stats:
+                await conn.execute(
+                    """
+                    INSERT INTO user_stats (user_id, viewed, saved, reported, last_active)
+                    SELECT t.user_id, t.viewed, t.saved, t.reported, NOW()
+                    FROM UNNEST($1::INT[], $2::INT[], $3::INT[], $4::INT[]) AS t(user_id, viewed, saved, reported)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        viewed = user_stats.viewed + EXCLUDED.viewed,
+                        saved = user_stats.saved + EXCLUDED.saved,
+                        reported = user_stats.reported + EXCLUDED.reported,
+                        last_active = NOW()
+                    """,
+                    list(stats),
+                    [c["viewed"] for c in stats.values()],
+                    [c["saved"] for c in stats.values()],
+                    [c["reported"] for c in stats.values()]
+                )
+    return len(rows)
+
+async def flush_user_activity(limit: Optional[int] = None) -> int:
+    """
+    Записує один пакет подій: спершу пакет, що очікує повтору, інакше до limit подій з черги.
+    Невдалий пакет не губиться — він повертається на повтор, а після ACTIVITY_MAX_ATTEMPTS
+    спроб записується в журнал помилок. Повертає кількість взятих подій.
+    """
+    if _activity_retry:
+        attempts, batch = _activity_retry.popleft()
+    else:
+        attempts, batch = 0, []
+        while not activity_queue.empty() and (limit is None or len(batch) < limit):
+            batch.append(activity_queue.get_nowait())
+    if not batch:
+        return 0
+
+    try:
+        await write_user_activity(batch)
+    except Exception:
+        if attempts + 1 < ACTIVITY_MAX_ATTEMPTS:
+            _activity_retry.append((attempts + 1, batch))
+        else:
+            logging.error(f"Пакет активності з {len(batch)} подій не записано після {ACTIVITY_MAX_ATTEMPTS} спроб: {batch}")
+        raise
+    return len(batch)
+
+async def flush_user_activity_task():
+    """Фонова задача, що періодично скидає чергу активності користувачів у БД."""
+    while True:
+        try:
+            written = await flush_user_activity(ACTIVITY_FLUSH_BATCH_SIZE)
+        except Exception as e:
+            logging.error(f"Помилка пакетного запису активності користувачів: {e}")
+            await asyncio.sleep(ACTIVITY_RETRY_DELAY)
+            continue
+        # Якщо пакет заповнено повністю, одразу беремо наступний
+        if written < ACTIVITY_FLUSH_BATCH_SIZE:
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+
 # ==== API ENDPOINTS ====
 
-@app.post("/summary")
-async def generate_summary_api(req: SummaryRequest):
-    """Генерує AI-резюме для новини або наданого тексту."""
+async def summary_json(req: SummaryRequest) -> bytes:
+    """AI-резюме для новини або наданого тексту (серіалізований JSON). Спільна для POST /summary і бота."""
     # Це мокова функція. В реальності тут буде виклик до моделі AI.
     if req.news_id:
-        # Fetch news content from DB based on news_id
-        conn = await get_db_connection()
-        try:
-            news = await conn.fetchrow("SELECT content FROM news WHERE id = $1", req.news_id)
-            if news:
-                content = news['content']
-                # Моковане резюме
-                summary = f"AI-генероване резюме для новини #{req.news_id} на основі контенту: {content[:100]}..."
-                return {"summary": summary}
-            else:
+        async def load_summary() -> bytes:
+            async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+                news = await conn.fetchrow("SELECT content FROM news WHERE id = $1", req.news_id)
+            if not news:
                 raise HTTPException(status_code=404, detail="Новину не знайдено.")
-        finally:
-            await conn.close()
+            # Моковане резюме
+            summary = f"AI-генероване резюме для новини #{req.news_id} на основі контенту: {news['content'][:100]}..."
+            return orjson.dumps({"summary": summary})
+
+        # Повторний запит резюме тієї ж новини не запускає генерацію вдруге
+        return await cached_json(f"summary:{req.news_id}", SUMMARY_CACHE_TTL, load_summary)
     elif req.text:
         # Моковане резюме для довільного тексту
         summary = f"AI-генероване резюме для тексту: {req.text[:100]}..."
-        return {"summary": summary}
+        return orjson.dumps({"summary": summary})
     else:
         raise HTTPException(status_code=400, detail="Потрібен news_id або text.")
 
+@app.post("/summary")
+async def generate_summary_api(req: SummaryRequest):
+    """Генерує AI-резюме для новини або наданого тексту."""
+    return json_bytes_response(await summary_json(req))
+
+async def save_feedback(user_id: int, message: str) -> bool:
+    """
+    Зберігає відгук користувача (telegram_id). Спільна для POST /feedback і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        # feedback.user_id посилається на users.id, а не на telegram_id
+        user_internal_id = await resolve_uid(conn, user_id)
+        if not user_internal_id:
+            return False
+        await conn.execute("INSERT INTO feedback (user_id, message) VALUES ($1, $2)", user_internal_id, message)
+        return True
+
 @app.post("/feedback")
 async def save_feedback_api(req: FeedbackRequest):
     """Зберігає відгук користувача."""
-    conn = await get_db_connection()
-    try:
-        await conn.execute("INSERT INTO feedback (user_id, message) VALUES ($1, $2)", req.user_id, req.message)
-        return {"status": "saved", "user_id": req.user_id, "message": req.message}
-    finally:
-        await conn.close()
+    if not await save_feedback(req.user_id, req.message):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "saved", "user_id": req.user_id, "message": req.message}
+
+async def save_rating(user_id: int, news_id: int, value: int) -> bool:
+    """
+    Зберігає оцінку новини користувачем (telegram_id). Спільна для POST /rate і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        # ratings.user_id посилається на users.id, а не на telegram_id
+        user_internal_id = await resolve_uid(conn, user_id)
+        if not user_internal_id:
+            return False
+        await conn.execute("INSERT INTO ratings (user_id, news_id, value) VALUES ($1, $2, $3) ON CONFLICT (user_id, news_id) DO UPDATE SET value = EXCLUDED.value", user_internal_id, news_id, value)
+        return True
 
 @app.post("/rate")
 async def save_rating_api(req: RateRequest):
     """Зберігає оцінку новини користувачем."""
     if 1 <= req.value <= 5:
-        conn = await get_db_connection()
-        try:
-            await conn.execute("INSERT INTO ratings (user_id, news_id, value) VALUES ($1, $2, $3) ON CONFLICT (user_id, news_id) DO UPDATE SET value = EXCLUDED.value", req.user_id, req.news_id, req.value)
-            return {"status": "rated", "news_id": req.news_id, "value": req.value}
-        finally:
-            await conn.close()
+        if not await save_rating(req.user_id, req.news_id, req.value):
+            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+        return {"status": "rated", "news_id": req.news_id, "value": req.value}
     return {"error": "invalid rating"}
 
 @app.post("/block")
 async def block_source_api(req: BlockRequest):
     """Блокує джерело/тег/категорію/мову для користувача."""
-    conn = await get_db_connection()
-    try:
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
         await conn.execute("INSERT INTO blocks (user_id, block_type, value) VALUES ($1, $2, $3) ON CONFLICT (user_id, block_type, value) DO NOTHING", req.user_id, req.block_type, req.value)
         return {"blocked": True, "type": req.block_type, "value": req.value}
-    finally:
-        await conn.close()
 
 @app.post("/daily")
 async def subscribe_daily_api(req: DigestRequest):
     """Підписує користувача на щоденний дайджест (застаріле)."""
     # Цей ендпоінт замінено на /subscriptions/update
-    conn = await get_db_connection()
-    try:
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
         await conn.execute("INSERT INTO subscriptions (user_id, active) VALUES ($1, TRUE) ON CONFLICT (user_id) DO UPDATE SET active = TRUE", req.user_id)
         return {"subscribed": True, "user_id": req.user_id}
-    finally:
-        await conn.close()
+
+async def analytics_json(user_id: int) -> bytes:
+    """Аналітика користувача (серіалізований JSON) з кешу. Спільна для GET /analytics і бота."""
+    return await cached_json(f"analytics:{user_id}", ANALYTICS_CACHE_TTL, lambda: load_analytics(user_id))
 
 @app.get("/analytics/{user_id}")
 async def get_analytics_api(user_id: int):
     """Повертає аналітику використання для користувача."""
-    conn = await get_db_connection()
-    try:
-        stats = await conn.fetchrow("SELECT viewed, saved, reported, last_active FROM user_stats WHERE user_id = (SELECT id FROM users WHERE telegram_id = $1)", user_id)
-        user_info = await conn.fetchrow("SELECT level, badges FROM users WHERE telegram_id = $1", user_id)
-        
-        # Моковані дані для інших метрик, поки не імплементовані в БД
-        read_full_count = 0
-        skipped_count = 0
-        liked_count = 0
-        comments_count = 0
-        sources_added_count = 0
-        
-        if stats:
-            return {
-                "user_id": user_id,
-                "viewed": stats['viewed'],
-                "saved": stats['saved'],
-                "reported": stats['reported'],
-                "read_full_count": read_full_count,
-                "skipped_count": skipped_count,
-                "liked_count": liked_count,
-                "comments_count": comments_count,
-                "sources_added_count": sources_added_count,
-                "level": user_info['level'] if user_info else 1,
-                "badges": user_info['badges'] if user_info else [],
-                "last_active": stats['last_active'].isoformat() if stats['last_active'] else None
-            }
-        # Якщо статистики немає, повертаємо початкові значення
-        return {
+    return json_bytes_response(await analytics_json(user_id))
+
+async def load_analytics(user_id: int) -> bytes:
+    """Завантажує аналітику користувача з БД і серіалізує її для кешу."""
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        # Рівень/бейджі та статистика — один запит з LEFT JOIN замість двох послідовних
+        user_info = await conn.fetchrow(
+            """
+            SELECT u.level, u.badges, s.user_id IS NOT NULL AS has_stats,
+                   s.viewed, s.saved, s.reported, s.last_active
+            FROM users u
+            LEFT JOIN user_stats s ON s.user_id = u.id
+            WHERE u.telegram_id = $1
+            """,
+            user_id
+        )
+
+    # Моковані дані для інших метрик, поки не імплементовані в БД
+    read_full_count = 0
+    skipped_count = 0
+    liked_count = 0
+    comments_count = 0
+    sources_added_count = 0
+
+    if user_info and user_info['has_stats']:
+        return orjson.dumps({
             "user_id": user_id,
-            "viewed": 0, "saved": 0, "reported": 0,
-            "read_full_count": 0, "skipped_count": 0, "liked_count": 0,
-            "comments_count": 0, "sources_added_count": 0,
-            "level": user_info['level'] if user_info else 1,
-            "badges": user_info['badges'] if user_info else [],
-            "last_active": datetime.utcnow().isoformat()
-        }
-    finally:
-        await conn.close()
+            "viewed": user_info['viewed'],
+            "saved": user_info['saved'],
+            "reported": user_info['reported'],
+            "read_full_count": read_full_count,
+            "skipped_count": skipped_count,
+            "liked_count": liked_count,
+            "comments_count": comments_count,
+            "sources_added_count": sources_added_count,
+            "level": user_info['level'],
+            "badges": user_info['badges'],
+            "last_active": user_info['last_active']
+        })
+    # Якщо статистики немає, повертаємо початкові значення
+    return orjson.dumps({
+        "user_id": user_id,
+        "viewed": 0, "saved": 0, "reported": 0,
+        "read_full_count": 0, "skipped_count": 0, "liked_count": 0,
+        "comments_count": 0, "sources_added_count": 0,
+        "level": user_info['level'] if user_info else 1,
+        "badges": user_info['badges'] if user_info else [],
+        "last_active": datetime.now(timezone.utc)
+    })
+
+async def save_report(user_id: int, news_id: Optional[int], reason: str) -> bool:
+    """
+    Зберігає скаргу користувача (telegram_id) на новину або загальну проблему. Спільна для POST /report і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        # reports.user_id посилається на users.id, а не на telegram_id
+        user_internal_id = await resolve_uid(conn, user_id)
+        if not user_internal_id:
+            return False
+        await conn.execute("INSERT INTO reports (user_id, news_id, reason) VALUES ($1, $2, $3)", user_internal_id, news_id, reason)
+        return True
 
 @app.post("/report")
 async def send_report_api(req: ReportRequest):
     """Відправляє скаргу на новину або загальну проблему."""
-    conn = await get_db_connection()
-    try:
-        await conn.execute("INSERT INTO reports (user_id, news_id, reason) VALUES ($1, $2, $3)", req.user_id, req.news_id, req.reason)
-        return {"status": "reported", "user_id": req.user_id, "news_id": req.news_id, "reason": req.reason}
-    finally:
-        await conn.close()
+    if not await save_report(req.user_id, req.news_id, req.reason):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "reported", "user_id": req.user_id, "news_id": req.news_id, "reason": req.reason}
 
-@app.get("/recommend/{user_id}")
-async def get_recommendations_api(user_id: int):
-    """Повертає AI-рекомендації новин для користувача (моковано)."""
+async def recommendations_json(user_id: int) -> bytes:
+    """AI-рекомендації новин для користувача (серіалізований JSON, моковано). Спільна для GET /recommend і бота."""
     # В реальності тут буде складна логіка рекомендацій
     # Завантажуємо якісь новини з БД для моку
-    conn = await get_db_connection()
-    try:
-        mock_news = await conn.fetch("SELECT id, title FROM news LIMIT 3")
-        return {
+    async def load_recommendations() -> bytes:
+        async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+            # Найсвіжіші новини: порядок збігається з індексом idx_news_published_at_id, тож читаються лише 3 рядки
+            mock_news = await conn.fetch("SELECT id, title FROM news WHERE published_at IS NOT NULL ORDER BY published_at DESC, id DESC LIMIT 3")
+        return orjson.dumps({
             "user_id": user_id,
             "recommended": [
                 {"id": news['id'], "title": news['title']} for news in mock_news
             ]
-        }
-    finally:
-        await conn.close()
+        })
 
-@app.get("/verify/{news_id}")
-async def verify_news_api(news_id: int):
-    """Виконує AI-фактчекінг новини (моковано)."""
-    # В реальності тут буде виклик до моделі фактчекінгу
+    return await cached_json(f"recommend:{user_id}", RECOMMEND_CACHE_TTL, load_recommendations)
+
+@app.get("/recommend/{user_id}")
+async def get_recommendations_api(user_id: int):
+    """Повертає AI-рекомендації новин для користувача (моковано)."""
+    return json_bytes_response(await recommendations_json(user_id))
+
+def verify_news(news_id: int) -> Dict[str, Any]:
+    """AI-фактчекінг новини (моковано). Спільна для GET /verify і бота."""
+    # В реальності тут буде виклик до моделі фактчекінгу.
+    # Мок детермінований: значення виводяться з хешу news_id, тож однакові для однієї новини
+    digest = int.from_bytes(hashlib.blake2b(news_id.to_bytes(8, 'little', signed=True), digest_size=8).digest(), 'little')
     return {
         "news_id": news_id,
-        "is_fake": random.choice([True, False]),
-        "confidence": random.uniform(0.5, 0.99),
+        "is_fake": bool(digest & 1),
+        "confidence": 0.5 + ((digest >> 1) & 0xFFFF) / 0xFFFF * 0.49,
         "source": "AI Fact-Checker"
     }
 
+@app.get("/verify/{news_id}")
+async def verify_news_api(news_id: int):
+    """Виконує AI-фактчекінг новини (моковано)."""
+    return verify_news(news_id)
+
+def rewrite_headline(text: str) -> str:
+    """Переписує заголовок новини за допомогою AI (моковано). Спільна для POST /ai/rewrite_headline і бота."""
+    # Простий мок: додаємо "AI-rewritten: " до заголовка
+    return f"AI-rewritten: {text}"
+
 @app.post("/ai/rewrite_headline")
 async def rewrite_headline_api(req: RewriteHeadlineRequest):
     """Переписує заголовок новини за допомогою AI (моковано)."""
-    # Простий мок: додаємо "AI-rewritten: " до заголовка
-    rewritten_headline = f"AI-rewritten: {req.text}"
-    return {"original_headline": req.text, "rewritten_headline": rewritten_headline}
+    return {"original_headline": req.text, "rewritten_headline": rewrite_headline(req.text)}
 
 
-@app.post("/users/register")
-async def register_user_api(req: UserRegisterRequest):
+# Поля профілю, які можна передати при реєстрації/оновленні (None — не змінювати)
+USER_PROFILE_FIELDS = ("language", "country", "safe_mode", "current_feed_id", "email", "auto_notifications", "view_mode", "is_premium")
+
+async def register_user(req: UserRegisterRequest) -> Optional[asyncpg.Record]:
     """
-    Реєструє нового користувача або оновлює існуючого.
+    Реєструє нового користувача або оновлює існуючого. Спільна для POST /users/register і бота.
     Використовує telegram_id як унікальний ідентифікатор.
+    Один INSERT ... ON CONFLICT: передані поля записуються, решта лишаються як є
+    (для нового користувача — значення за замовчуванням зі схеми).
+    Повертає рядок (id, inserted) або None, якщо змінювати нічого.
     """
-    conn = await get_db_connection()
-    try:
-        # Спроба знайти користувача за telegram_id
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
-
-        update_parts = []
-        params = []
-        param_idx = 1
-
-        if req.language is not None:
-            update_parts.append(f"language = ${param_idx}")
-            params.append(req.language)
-            param_idx += 1
-        if req.country is not None:
-            update_parts.append(f"country = ${param_idx}")
-            params.append(req.country)
-            param_idx += 1
-        if req.safe_mode is not None:
-            update_parts.append(f"safe_mode = ${param_idx}")
-            params.append(req.safe_mode)
-            param_idx += 1
-        if req.current_feed_id is not None:
-            update_parts.append(f"current_feed_id = ${param_idx}")
-            params.append(req.current_feed_id)
-            param_idx += 1
-        if req.email is not None:
-            update_parts.append(f"email = ${param_idx}")
-            params.append(req.email)
-            param_idx += 1
-        if req.auto_notifications is not None:
-            update_parts.append(f"auto_notifications = ${param_idx}")
-            params.append(req.auto_notifications)
-            param_idx += 1
-        if req.view_mode is not None:
-            update_parts.append(f"view_mode = ${param_idx}")
-            params.append(req.view_mode)
-            param_idx += 1
-        
-        # Обробка is_premium та premium_expires_at
-        if req.is_premium is not None:
-            update_parts.append(f"is_premium = ${param_idx}")
-            params.append(req.is_premium)
-            param_idx += 1
-            if req.is_premium:
-                update_parts.append(f"premium_expires_at = ${param_idx}")
-                params.append(datetime.utcnow() + timedelta(days=30)) # 30 днів преміуму
-                param_idx += 1
-            else:
-                update_parts.append(f"premium_expires_at = NULL") # Скасувати преміум
-
-        if user_internal_id:
-            # Користувач існує, оновлюємо його
-            if update_parts:
-                query = f"UPDATE users SET {', '.join(update_parts)} WHERE telegram_id = ${param_idx}"
-                params.append(req.user_id)
-                await conn.execute(query, *params)
-                return {"status": "success", "message": "Профіль оновлено"}
-            return {"status": "no_changes", "message": "Немає змін для оновлення"}
-        else:
-            # Користувач не існує, вставляємо нового
-            insert_columns = ["telegram_id"]
-            insert_values = ["$1"]
-            insert_params = [req.user_id]
-            insert_idx = 2
-
-            if req.language is not None:
-                insert_columns.append("language")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.language)
-                insert_idx += 1
-            if req.country is not None:
-                insert_columns.append("country")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.country)
-                insert_idx += 1
-            if req.safe_mode is not None:
-                insert_columns.append("safe_mode")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.safe_mode)
-                insert_idx += 1
-            if req.current_feed_id is not None:
-                insert_columns.append("current_feed_id")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.current_feed_id)
-                insert_idx += 1
-            if req.email is not None:
-                insert_columns.append("email")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.email)
-                insert_idx += 1
-            if req.auto_notifications is not None:
-                insert_columns.append("auto_notifications")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.auto_notifications)
-                insert_idx += 1
-            if req.view_mode is not None:
-                insert_columns.append("view_mode")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.view_mode)
-                insert_idx += 1
-            if req.is_premium is not None:
-                insert_columns.append("is_premium")
-                insert_values.append(f"${insert_idx}")
-                insert_params.append(req.is_premium)
-                insert_idx += 1
-                if req.is_premium:
-                    insert_columns.append("premium_expires_at")
-                    insert_values.append(f"${insert_idx}")
-                    insert_params.append(datetime.utcnow() + timedelta(days=30))
-                    insert_idx += 1
-
-            query = f"INSERT INTO users ({', '.join(insert_columns)}) VALUES ({', '.join(insert_values)}) RETURNING id"
-            new_user_id = await conn.fetchval(query, *insert_params)
-            return {"status": "success", "message": "Користувача зареєстровано", "user_internal_id": new_user_id}
+    fields = {name: getattr(req, name) for name in USER_PROFILE_FIELDS if getattr(req, name) is not None}
+    columns = ["telegram_id", *fields]
+    values = [f"${idx}" for idx in range(1, len(columns) + 1)]
+    params = [req.user_id, *fields.values()]
+    if req.is_premium is not None:
+        # 30 днів преміуму, час рахує БД; false скасовує преміум
+        columns.append("premium_expires_at")
+        values.append("NOW() + INTERVAL '30 days'" if req.is_premium else "NULL")
+
+    if len(columns) > 1:
+        on_conflict = "DO UPDATE SET " + ", ".join(f"{column} = EXCLUDED.{column}" for column in columns[1:])
+    else:
+        on_conflict = "DO NOTHING" # Існуючий користувач без змін: рядок не повертається
+
+    query = f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join(values)}) ON CONFLICT (telegram_id) {on_conflict} RETURNING id, (xmax = 0) AS inserted"
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_row = await conn.fetchrow(query, *params)
+
+    if user_row is None:
+        return None
+
+    _uid_cache[req.user_id] = user_row['id'] # Наступні запити користувача не звертатимуться до БД за ID
+    if user_row['inserted']:
+        # Аналітика незареєстрованого користувача могла закешуватись зі значеннями за замовчуванням
+        _analytics_text_cache.pop(req.user_id, None)
+        await invalidate_cached(f"analytics:{req.user_id}")
+    else:
+        await invalidate_profile(req.user_id)
+    return user_row
+
+@app.post("/users/register")
+async def register_user_api(req: UserRegisterRequest):
+    """Реєструє нового користувача або оновлює існуючого."""
+    user_row = await register_user(req)
+    if user_row is None:
+        return {"status": "no_changes", "message": "Немає змін для оновлення"}
+    if user_row['inserted']:
+        return {"status": "success", "message": "Користувача зареєстровано", "user_internal_id": user_row['id']}
+    return {"status": "success", "message": "Профіль оновлено"}
 
-    finally:
-        await conn.close()
 
+# Булеві поля профілю, які можна перемкнути одним запитом
+USER_TOGGLE_FIELDS = ("safe_mode", "auto_notifications")
+
+async def toggle_user_flag(user_id: int, field: str) -> Optional[bool]:
+    """
+    Атомарно інвертує булеве поле профілю користувача (telegram_id) і повертає нове значення.
+    Повертає None, якщо користувача не знайдено.
+    """
+    if field not in USER_TOGGLE_FIELDS:
+        raise ValueError(f"Поле {field} не можна перемикати")
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        new_value = await conn.fetchval(
+            f"UPDATE users SET {field} = NOT COALESCE({field}, FALSE) WHERE telegram_id = $1 RETURNING {field}",
+            user_id
+        )
+    if new_value is not None:
+        await invalidate_profile(user_id)
+    return new_value
+
+async def clear_user_email(user_id: int) -> bool:
+    """
+    Видаляє email користувача (telegram_id) — відписка від email-розсилки.
+    /users/register цього не вміє: None там означає "не змінювати".
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        updated = await conn.fetchval("UPDATE users SET email = NULL WHERE telegram_id = $1 RETURNING id", user_id)
+    if updated is None:
+        return False
+    await invalidate_profile(user_id)
+    return True
+
+@app.post("/users/{user_id}/toggle")
+async def toggle_user_flag_api(user_id: int, req: UserToggleRequest):
+    """Перемикає булеве поле профілю (safe_mode, auto_notifications) без попереднього читання профілю."""
+    if req.field not in USER_TOGGLE_FIELDS:
+        raise HTTPException(status_code=400, detail="Це поле не можна перемкнути.")
+    new_value = await toggle_user_flag(user_id, req.field)
+    if new_value is None:
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "field": req.field, "new_value": new_value}
 
 @app.get("/users/{user_id}/profile")
 async def get_user_profile_api(user_id: int):
     """Повертає профіль користувача за telegram_id."""
-    conn = await get_db_connection()
-    try:
-        user_profile = await conn.fetchrow("SELECT telegram_id, language, country, safe_mode, current_feed_id, is_premium, premium_expires_at, level, badges, inviter_id, email, auto_notifications, view_mode FROM users WHERE telegram_id = $1", user_id)
+    async def load_profile() -> bytes:
+        user_profile = await get_user_profile(user_id)
         if user_profile:
-            # Перетворюємо record на dict, щоб дату можна було серіалізувати
-            profile_dict = dict(user_profile)
-            if profile_dict.get('premium_expires_at'):
-                profile_dict['premium_expires_at'] = profile_dict['premium_expires_at'].isoformat()
-            return profile_dict
+            # orjson серіалізує Record (через _orjson_default) і datetime напряму, без проміжного dict
+            return orjson.dumps(user_profile, default=_orjson_default)
         raise HTTPException(status_code=404, detail="Користувача не знайдено")
-    finally:
-        await conn.close()
 
-@app.get("/news/{user_id}")
-async def get_news_for_user_api(user_id: int, limit: int = 10, offset: int = 0):
+    return await cached_json_response(f"profile:{user_id}", PROFILE_CACHE_TTL, load_profile)
+
+@app.get("/users/{user_id}/premium")
+async def get_user_premium_api(user_id: int):
+    """Повертає лише статус преміуму користувача (без решти профілю)."""
+    user_profile = await get_user_profile(user_id)
+    if not user_profile:
+        raise HTTPException(status_code=404, detail="Користувача не знайдено")
+    return {"is_premium": user_profile['is_premium'], "expires_at": user_profile['premium_expires_at']}
+
+async def fetch_news_for_user(user_id: int, limit: int = 10, after_ts: Optional[datetime] = None, after_id: Optional[int] = None) -> List[asyncpg.Record]:
     """
-    Повертає новини для користувача, застосовуючи його фільтри
-    та враховуючи переглянуті новини.
+    Новини для користувача (telegram_id) з урахуванням його фільтрів і переглянутих новин;
+    видані новини позначаються переглянутими. Спільна для GET /news/{user_id} і бота.
     """
-    conn = await get_db_connection()
-    try:
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
         # Отримати внутрішній ID користувача
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", user_id)
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
             return [] # Користувача не знайдено
 
-        # Отримати фільтри користувача
-        filters = await conn.fetchrow("SELECT tag, category, source, language, country, content_type FROM filters WHERE user_id = $1", user_internal_id)
-        
-        # Отримати ID вже переглянутих новин
-        viewed_news_ids = await conn.fetch("SELECT news_id FROM user_news_views WHERE user_id = $1", user_internal_id)
-        viewed_news_ids = [r['news_id'] for r in viewed_news_ids]
-
-        query = """
-            SELECT n.id, n.title, n.content, n.lang, n.country, n.tags, n.source, n.link
-            FROM news n
-            LEFT JOIN user_news_views uv ON n.id = uv.news_id AND uv.user_id = $1
-            WHERE uv.news_id IS NULL -- Новини, які ще не були переглянуті цим користувачем
-        """
-        params = [user_internal_id]
-        param_idx = 2
-        
-        filter_conditions = []
+        if after_ts is None or after_id is None:
+            after_ts = after_id = None
 
-        if filters:
-            if filters['tag']:
-                filter_conditions.append(f"$ {param_idx} = ANY(n.tags)")
-                params.append(filters['tag'])
-                param_idx += 1
-            if filters['category']:
-                # Припускаємо, що categories будуть окремим полем або тегом
-                filter_conditions.append(f"$ {param_idx} = ANY(n.tags)") # Замість цього потрібно category
-                params.append(filters['category'])
-                param_idx += 1
-            if filters['source']:
-                filter_conditions.append(f"n.source ILIKE $ {param_idx}")
-                params.append(filters['source'])
-                param_idx += 1
-            if filters['language']:
-                filter_conditions.append(f"n.lang ILIKE $ {param_idx}")
-                params.append(filters['language'])
-                param_idx += 1
-            if filters['country']:
-                filter_conditions.append(f"n.country ILIKE $ {param_idx}")
-                params.append(filters['country'])
-                param_idx += 1
-            if filters['content_type']:
-                # Припускаємо, що content_type буде в тегах або окремим полем
-                filter_conditions.append(f"$ {param_idx} = ANY(n.tags)") # Замість цього потрібно content_type
-                params.append(filters['content_type'])
-                param_idx += 1
-        
-        if filter_conditions:
-            query += " AND " + " AND ".join(filter_conditions)
+        # Фільтри користувача застосовуються всередині запиту (CTE по filters)
+        async with public_read_transaction(conn, FEED_READ_TIMEOUTS_SQL):
+            news_items = await conn.fetch(NEWS_FEED_QUERY, user_internal_id, after_ts, after_id, limit)
 
-        query += f" ORDER BY n.published_at DESC LIMIT $ {param_idx} OFFSET $ {param_idx + 1}"
-        params.extend([limit, offset])
+        if news_items:
+            # Перегляди і статистика — один запит, тобто одна неявна транзакція
+            await conn.execute(MARK_NEWS_VIEWED_QUERY, user_internal_id, [news_item['id'] for news_item in news_items])
+            _analytics_text_cache.pop(user_id, None) # змінився лічильник viewed
 
-        news_items = await conn.fetch(query, *params)
-        
-        # Оновлюємо user_news_views для отриманих новин
-        for news_item in news_items:
-            await conn.execute(
-                "INSERT INTO user_news_views (user_id, news_id, viewed, first_viewed_at) VALUES ($1, $2, TRUE, NOW()) ON CONFLICT (user_id, news_id) DO UPDATE SET viewed = TRUE, last_viewed_at = NOW()",
-                user_internal_id, news_item['id']
-            )
-            # Оновлюємо статистику переглядів
-            await update_user_stats(conn, user_internal_id, "viewed")
+        return news_items
 
-        return [dict(n) for n in news_items]
-    finally:
-        await conn.close()
+@app.get("/news/{user_id}")
+async def get_news_for_user_api(user_id: int, limit: int = 10, after_ts: Optional[datetime] = None, after_id: Optional[int] = None):
+    """
+    Повертає новини для користувача, застосовуючи його фільтри
+    та враховуючи переглянуті новини.
+    Пагінація курсорна: after_ts/after_id — published_at та id останньої отриманої новини.
+    """
+    return RecordJSONResponse(await fetch_news_for_user(user_id, limit, after_ts, after_id))
 
-@app.post("/log_user_activity")
-async def log_user_activity_api(user_id: int, news_id: int, action: str):
-    """Логує дії користувача з новинами (like, dislike, skip)."""
-    conn = await get_db_connection()
+async def record_user_activity(user_id: int, news_id: int, action: str) -> bool:
+    """
+    Ставить дію користувача (telegram_id) в чергу пакетного запису.
+    Повертає False, якщо користувача не знайдено.
+    """
+    # При влученні в кеш з'єднання з пулу взагалі не береться
+    user_internal_id = await resolve_uid(app.state.pool, user_id)
+    if not user_internal_id:
+        return False
+
+    # Запис в interactions та оновлення статистики виконує фонова задача пакетами
+    event = (user_internal_id, news_id, action)
     try:
-        # Отримати внутрішній ID користувача
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", user_id)
+        activity_queue.put_nowait(event)
+    except asyncio.QueueFull:
+        # Фонова задача не встигає (повільна БД): пишемо подію одразу, і клієнт чекає на запис
+        await write_user_activity([event])
+    _analytics_text_cache.pop(user_id, None)
+    return True
+
+@app.post("/log_user_activity", status_code=202)
+async def log_user_activity_api(user_id: int, news_id: int, action: str):
+    """
+    Логує дії користувача з новинами (like, dislike, skip).
+    Подія лише ставиться в чергу, тому відповідь — 202 Accepted.
+    """
+    if not await record_user_activity(user_id, news_id, action):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "user_id": user_id, "news_id": news_id, "action": action}
+
+async def update_filters(req: FilterUpdateRequest) -> bool:
+    """
+    Оновлює або додає фільтри для користувача (telegram_id). Спільна для POST /filters/update і бота.
+    Повертає False, якщо користувача не знайдено; ValueError — якщо значення містить шаблон '%'.
+    """
+    # Джерело, мова та країна порівнюються точно (див. NEWS_FEED_QUERY), тож шаблон '%' нічого б не знайшов
+    if any(value and "%" in value for value in (req.source, req.language, req.country)):
+        raise ValueError("Фільтри джерела, мови та країни не підтримують шаблони '%'.")
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, req.user_id)
         if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+            return False
 
-        await conn.execute("INSERT INTO interactions (user_id, news_id, action) VALUES ($1, $2, $3)", user_internal_id, news_id, action)
-        await update_user_stats(conn, user_internal_id, action) # Оновлюємо статистику
-        return {"status": "success", "user_id": user_id, "news_id": news_id, "action": action}
-    finally:
-        await conn.close()
+        # Оновлення або вставка фільтрів одним запитом: поля, що не передані (None), зберігають попереднє значення
+        await conn.execute(
+            """
+            INSERT INTO filters (user_id, tag, category, source, language, country, content_type)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (user_id) DO UPDATE SET
+                tag = COALESCE(EXCLUDED.tag, filters.tag),
+                category = COALESCE(EXCLUDED.category, filters.category),
+                source = COALESCE(EXCLUDED.source, filters.source),
+                language = COALESCE(EXCLUDED.language, filters.language),
+                country = COALESCE(EXCLUDED.country, filters.country),
+                content_type = COALESCE(EXCLUDED.content_type, filters.content_type)
+            """,
+            user_internal_id, req.tag, req.category, req.source, req.language, req.country, req.content_type
+        )
+
+    await invalidate_cached(f"filters:{req.user_id}")
+    return True
 
 @app.post("/filters/update")
 async def update_filter_api(req: FilterUpdateRequest):
     """Оновлює або додає фільтри для користувача."""
-    conn = await get_db_connection()
     try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
-        if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
-
-        # Оновлення або вставка фільтрів
-        # Ця логіка може бути складнішою, якщо фільтрів багато і вони мають комбінуватися
-        if req.tag is not None:
-            await conn.execute("INSERT INTO filters (user_id, tag) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET tag = EXCLUDED.tag", user_internal_id, req.tag)
-        if req.category is not None:
-            await conn.execute("INSERT INTO filters (user_id, category) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET category = EXCLUDED.category", user_internal_id, req.category)
-        if req.source is not None:
-            await conn.execute("INSERT INTO filters (user_id, source) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET source = EXCLUDED.source", user_internal_id, req.source)
-        if req.language is not None:
-            await conn.execute("INSERT INTO filters (user_id, language) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET language = EXCLUDED.language", user_internal_id, req.language)
-        if req.country is not None:
-            await conn.execute("INSERT INTO filters (user_id, country) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET country = EXCLUDED.country", user_internal_id, req.country)
-        if req.content_type is not None:
-            await conn.execute("INSERT INTO filters (user_id, content_type) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET content_type = EXCLUDED.content_type", user_internal_id, req.content_type)
-            
-        return {"status": "success", "message": "Фільтр оновлено/додано"}
-    finally:
-        await conn.close()
+        updated = await update_filters(req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not updated:
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": "Фільтр оновлено/додано"}
+
+async def filters_json(user_id: int) -> bytes:
+    """Активні фільтри користувача (серіалізований JSON) з кешу. Спільна для GET /filters і бота."""
+    async def load_filters() -> bytes:
+        async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+            user_internal_id = await resolve_uid(conn, user_id)
+            if not user_internal_id:
+                raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+
+            filters = await conn.fetchrow("SELECT tag, category, source, language, country, content_type FROM filters WHERE user_id = $1", user_internal_id)
+        return orjson.dumps(filters or {}, default=_orjson_default)
+
+    return await cached_json(f"filters:{user_id}", FILTERS_CACHE_TTL, load_filters)
 
 @app.get("/filters/{user_id}")
 async def get_filters_api(user_id: int):
     """Повертає активні фільтри для користувача."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", user_id)
+    return json_bytes_response(await filters_json(user_id))
+
+async def reset_filters(user_id: int) -> bool:
+    """
+    Скидає всі фільтри користувача (telegram_id). Спільна для DELETE /filters/reset і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
-        
-        filters = await conn.fetchrow("SELECT tag, category, source, language, country, content_type FROM filters WHERE user_id = $1", user_internal_id)
-        return dict(filters) if filters else {}
-    finally:
-        await conn.close()
+            return False
+
+        await conn.execute("DELETE FROM filters WHERE user_id = $1", user_internal_id)
+
+    await invalidate_cached(f"filters:{user_id}")
+    return True
 
 @app.delete("/filters/reset/{user_id}")
 async def reset_filters_api(user_id: int):
     """Скидає всі фільтри для користувача."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", user_id)
-        if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    if not await reset_filters(user_id):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": "Фільтри скинуто"}
 
-        await conn.execute("DELETE FROM filters WHERE user_id = $1", user_internal_id)
-        return {"status": "success", "message": "Фільтри скинуто"}
-    finally:
-        await conn.close()
+async def add_news(news: NewsAddRequest):
+    """Додає нову новину. Спільна для POST /news/add і бота."""
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        await conn.execute(
+            "INSERT INTO news (title, content, lang, country, tags, source, link) VALUES ($1, $2, $3, $4, $5, $6, $7)",
+            news.title, news.content, news.lang, news.country, news.tags, news.source, news.link
+        )
 
 @app.post("/news/add")
 async def add_news_api(req: NewsAddRequest):
     """Додає нову новину (для адмінів/контент-менеджерів)."""
-    conn = await get_db_connection()
-    try:
+    await add_news(req)
+    return {"status": "success", "message": "Новина додана"}
+
+async def add_source(req: SourceAddRequest) -> bool:
+    """
+    Додає нове джерело від користувача (telegram_id). Спільна для POST /sources/add і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, req.user_id)
+        if not user_internal_id:
+            return False
+
         await conn.execute(
-            "INSERT INTO news (title, content, lang, country, tags, source, link) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-            req.title, req.content, req.lang, req.country, req.tags, req.source, req.link
+            "INSERT INTO sources (name, link, type, added_by_user_id) VALUES ($1, $2, $3, $4) ON CONFLICT (link) DO NOTHING",
+            req.name, req.link, req.type, user_internal_id
         )
-        return {"status": "success", "message": "Новина додана"}
-    finally:
-        await conn.close()
+        return True
 
 @app.post("/sources/add")
 async def add_source_api(req: SourceAddRequest):
     """Додає нове джерело."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
+    if not await add_source(req):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": "Джерело додано"}
+
+async def add_bookmark(user_id: int, news_id: int) -> bool:
+    """
+    Додає новину до закладок користувача (telegram_id).
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+            return False
 
+        # Закладка і лічильник saved в одному запиті; лічильник зростає лише для нової закладки
         await conn.execute(
-            "INSERT INTO sources (name, link, type, added_by_user_id) VALUES ($1, $2, $3, $4) ON CONFLICT (link) DO NOTHING",
-            req.name, req.link, req.type, user_internal_id
+            """
+            WITH ins AS (
+                INSERT INTO bookmarks (user_id, news_id) VALUES ($1, $2)
+                ON CONFLICT (user_id, news_id) DO NOTHING
+                RETURNING user_id
+            )
+            INSERT INTO user_stats (user_id, saved, last_active)
+            SELECT user_id, 1, NOW() FROM ins
+            ON CONFLICT (user_id) DO UPDATE SET saved = user_stats.saved + 1, last_active = NOW()
+            """,
+            user_internal_id, news_id
         )
-        return {"status": "success", "message": "Джерело додано"}
-    finally:
-        await conn.close()
+    _analytics_text_cache.pop(user_id, None) # змінився лічильник saved
+    return True
 
 @app.post("/bookmarks/add")
 async def add_bookmark_api(req: BookmarkAddRequest):
     """Додає новину до закладок користувача."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
+    if not await add_bookmark(req.user_id, req.news_id):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": "Закладку додано"}
+
+async def json_array_stream(rows: AsyncIterator[Any]) -> AsyncIterator[bytes]:
+    """Віддає рядки (asyncpg.Record або dict) частинами JSON-масиву: '[', об'єкти через кому, ']'."""
+    yield b'['
+    first = True
+    async for row in rows:
+        yield (b'' if first else b',') + orjson.dumps(dict(row))
+        first = False
+    yield b']'
+
+def bookmarks_query(user_internal_id: int, limit: Optional[int], after_ts: Optional[datetime], after_id: Optional[int]) -> Tuple[str, tuple]:
+    """Запит і параметри сторінки закладок; LIMIT NULL у Postgres означає "без обмеження"."""
+    if after_ts is not None and after_id is not None:
+        query = "SELECT n.id, n.title, n.link, b.created_at AS bookmarked_at FROM bookmarks b JOIN news n ON b.news_id = n.id WHERE b.user_id = $1 AND (b.created_at, b.news_id) < ($2, $3) ORDER BY b.created_at DESC, b.news_id DESC LIMIT $4"
+        return query, (user_internal_id, after_ts, after_id, limit)
+    query = "SELECT n.id, n.title, n.link, b.created_at AS bookmarked_at FROM bookmarks b JOIN news n ON b.news_id = n.id WHERE b.user_id = $1 ORDER BY b.created_at DESC, b.news_id DESC LIMIT $2"
+    return query, (user_internal_id, limit)
+
+async def fetch_bookmarks(user_id: int, limit: Optional[int] = None) -> Optional[List[asyncpg.Record]]:
+    """Закладки користувача (telegram_id) для бота; None, якщо користувача не знайдено."""
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
-
-        await conn.execute("INSERT INTO bookmarks (user_id, news_id) VALUES ($1, $2) ON CONFLICT (user_id, news_id) DO NOTHING", user_internal_id, req.news_id)
-        await update_user_stats(conn, user_internal_id, "saved")
-        return {"status": "success", "message": "Закладку додано"}
-    finally:
-        await conn.close()
+            return None
+        return await conn.fetch(*bookmarks_query(user_internal_id, limit, None, None))
 
 @app.get("/bookmarks/{user_id}")
-async def get_bookmarks_api(user_id: int):
-    """Повертає список закладок для користувача."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", user_id)
+async def get_bookmarks_api(user_id: int, limit: Optional[int] = None, after_ts: Optional[datetime] = None, after_id: Optional[int] = None):
+    """
+    Повертає список закладок для користувача.
+    Пагінація курсорна: after_ts/after_id — bookmarked_at та id останньої отриманої закладки.
+    Без limit список не обмежений, тому відповідь стрімиться з серверного курсора
+    і не збирається в пам'яті цілком.
+    """
+    user_internal_id = await resolve_uid(app.state.pool, user_id)
+    if not user_internal_id:
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+
+    query, params = bookmarks_query(user_internal_id, limit, after_ts, after_id)
+
+    async def stream_bookmarks():
+        # З'єднання тримається лише поки відповідь віддається клієнту
+        async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+            async with conn.transaction(): # Курсори asyncpg працюють лише в транзакції
+                async for chunk in json_array_stream(conn.cursor(query, *params, prefetch=64)):
+                    yield chunk
+
+    return StreamingResponse(stream_bookmarks(), media_type="application/json")
+
+async def add_comment(user_id: int, news_id: int, content: str) -> bool:
+    """
+    Додає коментар користувача (telegram_id) до новини. Спільна для POST /comments/add і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+            return False
 
-        bookmarks = await conn.fetch(
-            "SELECT n.id, n.title, n.link FROM bookmarks b JOIN news n ON b.news_id = n.id WHERE b.user_id = $1 ORDER BY b.created_at DESC",
-            user_internal_id
-        )
-        return [dict(b) for b in bookmarks]
-    finally:
-        await conn.close()
+        await conn.execute("INSERT INTO comments (user_id, news_id, content) VALUES ($1, $2, $3)", user_internal_id, news_id, content)
+        return True
 
 @app.post("/comments/add")
 async def add_comment_api(req: CommentAddRequest):
     """Додає коментар до новини."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
-        if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    if not await add_comment(req.user_id, req.news_id, req.content):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": "Коментар додано, очікує модерації"}
+
+async def comments_json(news_id: int) -> bytes:
+    """Схвалені коментарі новини (серіалізований JSON) з кешу. Спільна для GET /comments і бота."""
+    async def load_comments() -> bytes:
+        async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn, public_read_transaction(conn):
+            comments = await conn.fetch(
+                "SELECT c.content, u.telegram_id AS user_telegram_id FROM comments c JOIN users u ON c.user_id = u.id WHERE c.news_id = $1 AND c.moderation_status = 'approved' ORDER BY c.created_at ASC",
+                news_id
+            )
+        return orjson.dumps(comments, default=_orjson_default)
 
-        await conn.execute("INSERT INTO comments (user_id, news_id, content) VALUES ($1, $2, $3)", user_internal_id, req.news_id, req.content)
-        return {"status": "success", "message": "Коментар додано, очікує модерації"}
-    finally:
-        await conn.close()
+    return await cached_json(f"comments:{news_id}", COMMENTS_CACHE_TTL, load_comments)
 
 @app.get("/comments/{news_id}")
 async def get_comments_api(news_id: int):
     """Повертає схвалені коментарі для новини."""
-    conn = await get_db_connection()
-    try:
-        comments = await conn.fetch(
-            "SELECT c.content, u.telegram_id FROM comments c JOIN users u ON c.user_id = u.id WHERE c.news_id = $1 AND c.moderation_status = 'approved' ORDER BY c.created_at ASC",
-            news_id
-        )
-        return [{"content": c['content'], "user_telegram_id": c['telegram_id']} for c in comments]
-    finally:
-        await conn.close()
+    return json_bytes_response(await comments_json(news_id))
+
+# Тренди з матеріалізованого trending_scores, доповнені найновішими новинами з основної таблиці.
+# Саме news, а не лише схвалені: новини з /news/add лишаються 'pending' без published_at/expires_at,
+# тож вибірка лише схвалених повертала б порожній список.
+# Обидві гілки обмежені LIMIT, тому сортування не проходить усю таблицю.
+TRENDING_NEWS_QUERY = """
+WITH candidates AS (
+    (SELECT n.id, n.title, t.trend_score, n.published_at
+     FROM trending_scores t JOIN news n ON n.id = t.news_id
+     WHERE n.is_duplicate = FALSE
+     ORDER BY t.trend_score DESC
+     LIMIT $1)
+    UNION ALL
+    (SELECT n.id, n.title, NULL::numeric, n.published_at
+     FROM news n
+     WHERE n.is_duplicate = FALSE
+     ORDER BY n.published_at DESC NULLS LAST, n.id DESC
+     LIMIT $1)
+)
+SELECT id, title FROM (
+    SELECT DISTINCT ON (id) id, title, trend_score, published_at
+    FROM candidates
+    ORDER BY id, trend_score DESC NULLS LAST
+) c
+ORDER BY trend_score DESC NULLS LAST, published_at DESC NULLS LAST, id DESC
+LIMIT $1
+"""
+
+async def trending_json(limit: int) -> bytes:
+    """Трендові новини (серіалізований JSON) з кешу. Спільна для GET /trending і бота."""
+    async def load_trending() -> bytes:
+        async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn, public_read_transaction(conn):
+            trending_news = await conn.fetch(TRENDING_NEWS_QUERY, limit)
+        return orjson.dumps(trending_news, default=_orjson_default)
+
+    return await cached_json(f"trending:{limit}", TRENDING_CACHE_TTL, load_trending)
 
 @app.get("/trending")
 async def get_trending_news_api(limit: int = 5):
-    """Повертає трендові новини (моковано)."""
-    conn = await get_db_connection()
-    try:
-        # Для моку: просто повертаємо останні 5 новин
-        trending_news = await conn.fetch("SELECT id, title FROM news ORDER BY published_at DESC LIMIT $1", limit)
-        return [dict(n) for n in trending_news]
-    finally:
-        await conn.close()
+    """
+    Повертає трендові новини за переглядами та оцінками за останні 24 години.
+    Якщо трендових новин менше за limit, список доповнюється найновішими новинами.
+    """
+    return json_bytes_response(await trending_json(limit))
+
+async def create_custom_feed(req: CustomFeedCreateRequest) -> bool:
+    """
+    Створює нову персональну добірку для користувача (telegram_id). Спільна для POST /custom_feeds/create і бота.
+    Повертає False, якщо користувача не знайдено; asyncpg.UniqueViolationError — якщо назва вже зайнята.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, req.user_id)
+        if not user_internal_id:
+            return False
+
+        # Унікальність назви (без урахування регістру) перевіряє унікальний індекс при вставці
+        await conn.execute(
+            "INSERT INTO custom_feeds (user_id, feed_name, filters) VALUES ($1, $2, $3)",
+            user_internal_id, req.feed_name, req.filters # dict кодується в JSONB кодеком з'єднання
+        )
+        return True
 
 @app.post("/custom_feeds/create")
 async def create_custom_feed_api(req: CustomFeedCreateRequest):
     """Створює нову персональну добірку для користувача."""
-    conn = await get_db_connection()
     try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
+        created = await create_custom_feed(req)
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(status_code=409, detail="Добірка з такою назвою вже існує.")
+    if not created:
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": "Добірку створено"}
+
+async def fetch_custom_feeds(user_id: int) -> List[asyncpg.Record]:
+    """Персональні добірки користувача (telegram_id). Спільна для GET /custom_feeds і бота."""
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
-        
-        # Перетворюємо filters dict на JSONB для зберігання
-        filters_json = json.dumps(req.filters)
-        
-        # Перевірка на унікальність назви добірки для користувача
-        existing_feed = await conn.fetchval("SELECT id FROM custom_feeds WHERE user_id = $1 AND feed_name ILIKE $2", user_internal_id, req.feed_name)
-        if existing_feed:
-            raise HTTPException(status_code=409, detail="Добірка з такою назвою вже існує.")
+            return [] # Користувача не знайдено
 
-        await conn.execute(
-            "INSERT INTO custom_feeds (user_id, feed_name, filters) VALUES ($1, $2, $3)",
-            user_internal_id, req.feed_name, filters_json
-        )
-        return {"status": "success", "message": "Добірку створено"}
-    finally:
-        await conn.close()
+        return await conn.fetch("SELECT id, feed_name, filters FROM custom_feeds WHERE user_id = $1 ORDER BY created_at DESC", user_internal_id)
 
 @app.get("/custom_feeds/{user_id}")
 async def get_custom_feeds_api(user_id: int):
     """Повертає список персональних добірок для користувача."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", user_id)
+    return RecordJSONResponse(await fetch_custom_feeds(user_id)) # Фільтри вже JSONB, тому просто передаємо
+
+async def switch_custom_feed(user_id: int, feed_id: int) -> Optional[bool]:
+    """
+    Переключає активну добірку користувача (telegram_id). Спільна для POST /custom_feeds/switch і бота.
+    Повертає None, якщо користувача не знайдено, і False, якщо добірка не його або не існує.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
-            return [] # Користувача не знайдено
-        
-        feeds = await conn.fetch("SELECT id, feed_name, filters FROM custom_feeds WHERE user_id = $1 ORDER BY created_at DESC", user_internal_id)
-        return [dict(f) for f in feeds] # Фільтри вже JSONB, тому просто передаємо
-    finally:
-        await conn.close()
+            return None
+
+        # Перевірка, що добірка належить користувачу, виконується в тому ж UPDATE
+        switched = await conn.fetchval(
+            "UPDATE users SET current_feed_id = $1 WHERE id = $2 AND EXISTS (SELECT 1 FROM custom_feeds WHERE id = $1 AND user_id = $2) RETURNING id",
+            feed_id, user_internal_id
+        )
+        if not switched:
+            return False
+
+    await invalidate_profile(user_id)
+    return True
 
 @app.post("/custom_feeds/switch")
 async def switch_custom_feed_api(req: CustomFeedSwitchRequest):
     """Переключає активну персональну добірку для користувача."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
-        if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
-        
-        # Перевіряємо, чи належить добірка користувачу
-        feed_exists = await conn.fetchval("SELECT id FROM custom_feeds WHERE id = $1 AND user_id = $2", req.feed_id, user_internal_id)
-        if not feed_exists:
-            raise HTTPException(status_code=403, detail="Доступ заборонено або добірку не знайдено.")
-
-        await conn.execute("UPDATE users SET current_feed_id = $1 WHERE id = $2", req.feed_id, user_internal_id)
-        return {"status": "success", "message": f"Переключено на добірку ID {req.feed_id}"}
-    finally:
-        await conn.close()
-
-@app.post("/subscriptions/update")
-async def update_subscription_api(req: SubscriptionUpdateRequest):
-    """Оновлює підписку користувача на розсилку."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.user_id)
+    switched = await switch_custom_feed(req.user_id, req.feed_id)
+    if switched is None:
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    if not switched:
+        raise HTTPException(status_code=403, detail="Доступ заборонено або добірку не знайдено.")
+    return {"status": "success", "message": f"Переключено на добірку ID {req.feed_id}"}
+
+async def update_subscription(user_id: int, frequency: str) -> bool:
+    """
+    Оновлює підписку користувача (telegram_id) на розсилку. Спільна для POST /subscriptions/update і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
         if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+            return False
         
         # 'active' буде true, якщо це підписка, false якщо відписка
         active_status = True
-        if req.frequency == "unsubscribe": # Якщо це запит на відписку
+        if frequency == "unsubscribe": # Якщо це запит на відписку
             active_status = False
 
         await conn.execute(
             "INSERT INTO subscriptions (user_id, frequency, active) VALUES ($1, $2, $3) ON CONFLICT (user_id) DO UPDATE SET frequency = EXCLUDED.frequency, active = EXCLUDED.active",
-            user_internal_id, req.frequency, active_status
+            user_internal_id, frequency, active_status
         )
-        return {"status": "success", "message": f"Підписку на {req.frequency} оновлено"}
-    finally:
-        await conn.close()
+        return True
+
+@app.post("/subscriptions/update")
+async def update_subscription_api(req: SubscriptionUpdateRequest):
+    """Оновлює підписку користувача на розсилку."""
+    if not await update_subscription(req.user_id, req.frequency):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": f"Підписку на {req.frequency} оновлено"}
+
+async def unsubscribe_from_digest(user_id: int) -> bool:
+    """
+    Відписує користувача (telegram_id) від усіх розсилок. Спільна для POST /subscriptions/unsubscribe і бота.
+    Повертає False, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        user_internal_id = await resolve_uid(conn, user_id)
+        if not user_internal_id:
+            return False
+
+        await conn.execute("UPDATE subscriptions SET active = FALSE WHERE user_id = $1", user_internal_id)
+        return True
 
 @app.post("/subscriptions/unsubscribe")
 async def unsubscribe_from_digest_api(user_id: int):
     """Відписує користувача від усіх розсилок."""
-    conn = await get_db_connection()
-    try:
-        user_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", user_id)
-        if not user_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача не знайдено.")
-        
-        await conn.execute("UPDATE subscriptions SET active = FALSE WHERE user_id = $1", user_internal_id)
-        return {"status": "success", "message": "Успішно відписано від розсилок"}
-    finally:
-        await conn.close()
+    if not await unsubscribe_from_digest(user_id):
+        raise HTTPException(status_code=404, detail="Користувача не знайдено.")
+    return {"status": "success", "message": "Успішно відписано від розсилок"}
+
+async def generate_invite_code(user_id: int) -> Optional[str]:
+    """
+    Створює код запрошення для користувача (telegram_id). Спільна для POST /invite/generate і бота.
+    Повертає None, якщо користувача не знайдено.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        # Код генерується на сервері БД (gen_random_uuid, криптографічно випадковий) в тому ж INSERT,
+        # що й пошук користувача, який запрошує: один запит замість двох
+        return await conn.fetchval(
+            """
+            INSERT INTO invites (inviter_user_id, invite_code)
+            SELECT id, substr(replace(gen_random_uuid()::text, '-', ''), 1, 12)
+            FROM users WHERE telegram_id = $1
+            RETURNING invite_code
+            """,
+            user_id
+        )
 
 @app.post("/invite/generate")
 async def generate_invite_code_api(req: InviteGenerateRequest):
     """Генерує унікальний код запрошення."""
-    conn = await get_db_connection()
-    try:
-        inviter_internal_id = await conn.fetchval("SELECT id FROM users WHERE telegram_id = $1", req.inviter_user_id)
+    invite_code = await generate_invite_code(req.inviter_user_id)
+    if not invite_code:
+        raise HTTPException(status_code=404, detail="Користувача, що запрошує, не знайдено.")
+    return {"status": "success", "invite_code": invite_code}
+
+@app.post("/invite/accept")
+async def accept_invite_api(req: InviteAcceptRequest):
+    """Приймає запрошення та позначає запрошеного користувача."""
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        # Пошук запрошення, прив'язка запрошеного користувача та позначка про використання —
+        # один запит, тобто одна неявна транзакція; FOR UPDATE не дає двом запитам прийняти один код
+        inviter_internal_id = await conn.fetchval(
+            """
+            WITH inv AS (
+                SELECT id, inviter_user_id FROM invites
+                WHERE invite_code = $1 AND invited_user_id IS NULL
+                FOR UPDATE
+            ),
+            invited AS (
+                UPDATE users SET inviter_id = (SELECT inviter_user_id FROM inv)
+                WHERE telegram_id = $2 AND EXISTS (SELECT 1 FROM inv)
+                RETURNING id
+            ),
+            used AS (
+                UPDATE invites SET invited_user_id = (SELECT id FROM invited), accepted_at = NOW()
+                WHERE id = (SELECT id FROM inv)
+            )
+            SELECT inviter_user_id FROM inv
+            """,
+            req.invite_code, req.invited_user_id
+        )
+
         if not inviter_internal_id:
-            raise HTTPException(status_code=404, detail="Користувача, що запрошує, не знайдено.")
-        
-        invite_code = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=10))
-        await conn.execute("INSERT INTO invites (inviter_user_id, invite_code) VALUES ($1, $2)", inviter_internal_id, invite_code)
-        return {"status": "success", "invite_code": invite_code}
-    finally:
-        await conn.close()
+            raise HTTPException(status_code=400, detail="Недійсний або вже використаний код запрошення.")
+
+        await invalidate_profile(req.invited_user_id) # змінився inviter_id
+        return {"status": "success", "message": "Запрошення прийнято", "inviter_user_id": inviter_internal_id, "invited_user_id": req.invited_user_id}
+
+
+# ==== Автоматичні сповіщення ====
+# Скільки повідомлень автоматичних сповіщень відправляється в Telegram одночасно
+AUTO_NOTIFICATIONS_SEND_CONCURRENCY = 20
+
+async def send_auto_notification(news_item, semaphore: asyncio.Semaphore) -> bool:
+    """Відправляє одне автоматичне сповіщення; повертає True, якщо повідомлення доставлено."""
+    title = escape_markdown_v2(news_item['title'])
+    content = escape_markdown_v2(news_item['content'])
+    link = news_item.get('link') # URL не екрануємо
+
+    text_message = (
+        f"🔔 Нова новина: *{title}*\n\n"
+        f"{content}\n\n"
+        f"[Читати більше]({escape_markdown_v2(link) if link else ''})" # Посилання на оригінальний URL новини
+    )
+
+    async with semaphore:
+        try:
+            await bot.send_message(chat_id=news_item['telegram_id'], text=text_message, parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e:
+            logging.error(f"Помилка відправки сповіщення користувачу {news_item['telegram_id']}: {e}")
+            return False
+    logging.info(f"Відправлено автоматичне сповіщення користувачу {news_item['telegram_id']} про новину: {news_item['title']}")
+    return True
+
+async def send_auto_notifications():
+    """
+    Один прохід автоматичних сповіщень: відправляє нові новини
+    користувачам, у яких увімкнені auto_notifications.
+    """
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        # Одним запитом отримуємо для кожного користувача з auto_notifications
+        # найсвіжішу непереглянуту новину, що відповідає його фільтрам
+        # (ті ж умови, що й у NEWS_FEED_QUERY, але з рядка filters через JOIN)
+        notifications = await conn.fetch(
+            """
+            WITH subscribers AS (
+                SELECT u.id AS user_internal_id, u.telegram_id,
+                       array_remove(ARRAY[NULLIF(f.tag, ''), NULLIF(f.category, ''), NULLIF(f.content_type, '')], NULL) AS tag_filters,
+                       NULLIF(f.source, '') AS source,
+                       NULLIF(f.language, '') AS language,
+                       NULLIF(f.country, '') AS country
+                FROM users u
+                LEFT JOIN filters f ON f.user_id = u.id
+                WHERE u.auto_notifications = TRUE
+            )
+            SELECT s.user_internal_id, s.telegram_id, n.id AS news_id, n.title, n.content, n.source, n.link
+            FROM subscribers s
+            CROSS JOIN LATERAL (
+                SELECT n.id, n.title, n.content, n.source, n.link
+                FROM news n
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM user_news_views uv WHERE uv.user_id = s.user_internal_id AND uv.news_id = n.id
+                ) -- Новини, які ще не були переглянуті цим користувачем
+                  AND (cardinality(s.tag_filters) = 0 OR n.tags @> s.tag_filters)
+                  AND (s.source IS NULL OR lower(n.source) = lower(s.source))
+                  AND (s.language IS NULL OR lower(n.lang) = lower(s.language))
+                  AND (s.country IS NULL OR lower(n.country) = lower(s.country))
+                ORDER BY n.published_at DESC
+                LIMIT 1 -- По одній новині за раз
+            ) n
+            """
+        )
+
+    # З'єднання вже повернуто в пул: відправка в Telegram може тривати довго, а пул потрібен API.
+    # Відправляємо паралельно, обмежуючи кількість одночасних запитів до Telegram
+    semaphore = asyncio.Semaphore(AUTO_NOTIFICATIONS_SEND_CONCURRENCY)
+    sent = await asyncio.gather(*(send_auto_notification(news_item, semaphore) for news_item in notifications))
+    delivered = [news_item for news_item, ok in zip(notifications, sent) if ok]
+    notified_user_ids = [news_item['user_internal_id'] for news_item in delivered]
+    notified_news_ids = [news_item['news_id'] for news_item in delivered]
+
+    if notified_user_ids:
+        # Позначаємо надіслані новини як переглянуті та оновлюємо статистику пакетно
+        async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    INSERT INTO user_news_views (user_id, news_id, viewed, first_viewed_at)
+                    SELECT t.user_id, t.news_id, TRUE, NOW()
+                    FROM UNNEST($1::INT[], $2::INT[]) AS t(user_id, news_id)
+                    ON CONFLICT (user_id, news_id) DO UPDATE SET viewed = TRUE, last_viewed_at = NOW()
+                    """,
+                    notified_user_ids, notified_news_ids
+                )
+                await conn.execute(
+                    """
+                    INSERT INTO user_stats (user_id, viewed, last_active)
+                    SELECT t.user_id, 1, NOW()
+                    FROM UNNEST($1::INT[]) AS t(user_id)
+                    ON CONFLICT (user_id) DO UPDATE SET viewed = user_stats.viewed + 1, last_active = NOW()
+                    """,
+                    notified_user_ids
+                )
 
-@app.post("/invite/accept")
-async def accept_invite_api(req: InviteAcceptRequest):
-    """Приймає запрошення та позначає запрошеного користувача."""
-    conn = await get_db_connection()
-    try:
-        # Знайти запрошення за кодом
-        invite_record = await conn.fetchrow("SELECT id, inviter_user_id FROM invites WHERE invite_code = $1 AND invited_user_id IS NULL", req.invite_code)
-        
-        if not invite_record:
-            raise HTTPException(status_code=400, detail="Недійсний або вже використаний код запрошення.")
-        
-        inviter_internal_id = invite_record['inviter_user_id']
 
-        # Оновити користувача, що приєднався, додавши inviter_id
-        await conn.execute("UPDATE users SET inviter_id = $1 WHERE telegram_id = $2", inviter_internal_id, req.invited_user_id)
+# Запасний інтервал автоматичних сповіщень, якщо NOTIFY не надходять (наприклад, слухач недоступний)
+AUTO_NOTIFICATIONS_FALLBACK_INTERVAL = 15 * 60 # секунд
+# Пауза після NOTIFY, щоб серія вставок новин оброблялась одним проходом
+AUTO_NOTIFICATIONS_DEBOUNCE = 5 # секунд
 
-        # Позначити запрошення як використане
-        await conn.execute("UPDATE invites SET invited_user_id = (SELECT id FROM users WHERE telegram_id = $1), accepted_at = NOW() WHERE id = $2", req.invited_user_id, invite_record['id'])
-        
-        return {"status": "success", "message": "Запрошення прийнято", "inviter_user_id": inviter_internal_id, "invited_user_id": req.invited_user_id}
-    finally:
-        await conn.close()
+# Встановлюється слухачем LISTEN news_added (тригер trg_news_added_notify у schema.sql)
+news_added_event = asyncio.Event()
 
+def _on_news_added(connection, pid, channel, payload):
+    """Колбек asyncpg для NOTIFY news_added: будить задачу автоматичних сповіщень."""
+    news_added_event.set()
 
-# ==== Автоматичні сповіщення ====
-async def send_auto_notifications_task():
+NEWS_LISTENER_HEALTHCHECK_INTERVAL = 60 # секунд між перевірками з'єднання слухача
+NEWS_LISTENER_HEALTHCHECK_TIMEOUT = 5 # секунд на відповідь SELECT 1
+NEWS_LISTENER_RECONNECT_DELAY = 5 # секунд перед повторним підключенням
+
+async def news_listener_task():
     """
-    Фонова задача для відправлення автоматичних сповіщень про нові новини
-    користувачам, у яких увімкнені auto_notifications.
+    Тримає окреме з'єднання (поза пулом) з LISTEN news_added. Розрив з'єднання помічається
+    termination listener'ом або періодичним SELECT 1 (для "тихих" мережевих збоїв),
+    після чого слухач перепідключається. Після перепідключення запускається позачерговий
+    прохід сповіщень, бо NOTIFY за час розриву загублені.
     """
+    reconnecting = False
     while True:
         conn = None
+        lost = asyncio.Event()
         try:
-            conn = await get_db_connection()
-            # Отримуємо користувачів, які увімкнули auto_notifications
-            users_for_notifications = await conn.fetch("SELECT id AS user_internal_id, telegram_id, language, current_feed_id FROM users WHERE auto_notifications = TRUE")
-
-            for user in users_for_notifications:
-                # Отримуємо нові новини для кожного користувача, що відповідають його фільтрам
-                # Використовуємо ту ж логіку, що й get_news_for_user, але без оновлення viewed
-                # і без пропуску вже переглянутих, оскільки це "нові" сповіщення
-                
-                # Завантаження фільтрів для користувача
-                filters = await conn.fetchrow("SELECT tag, category, source, language, country, content_type FROM filters WHERE user_id = $1", user['user_internal_id'])
-                
-                query = """
-                    SELECT n.id, n.title, n.content, n.source, n.link
-                    FROM news n
-                    LEFT JOIN user_news_views uv ON n.id = uv.news_id AND uv.user_id = $1
-                    WHERE uv.news_id IS NULL -- Новини, які ще не були переглянуті цим користувачем
-                """
-                params = [user['user_internal_id']]
-                param_idx = 2
-                
-                filter_conditions = []
-
-                if filters:
-                    if filters['tag']:
-                        filter_conditions.append(f"$ {param_idx} = ANY(n.tags)")
-                        params.append(filters['tag'])
-                        param_idx += 1
-                    if filters['category']:
-                        filter_conditions.append(f"$ {param_idx} = ANY(n.tags)") 
-                        params.append(filters['category'])
-                        param_idx += 1
-                    if filters['source']:
-                        filter_conditions.append(f"n.source ILIKE $ {param_idx}")
-                        params.append(filters['source'])
-                        param_idx += 1
-                    if filters['language']:
-                        filter_conditions.append(f"n.lang ILIKE $ {param_idx}")
-                        params.append(filters['language'])
-                        param_idx += 1
-                    if filters['country']:
-                        filter_conditions.append(f"n.country ILIKE $ {param_idx}")
-                        params.append(filters['country'])
-                        param_idx += 1
-                    if filters['content_type']:
-                        filter_conditions.append(f"$ {param_idx} = ANY(n.tags)")
-                        params.append(filters['content_type'])
-                        param_idx += 1
-                
-                if filter_conditions:
-                    query += " AND " + " AND ".join(filter_conditions)
-
-                query += " ORDER BY n.published_at DESC LIMIT 1" # По одній новині за раз
-
-                news_item = await conn.fetchrow(query, *params)
-                
-                if news_item:
-                    # Відправляємо сповіщення
-                    title = escape_markdown_v2(news_item['title'])
-                    content = escape_markdown_v2(news_item['content'])
-                    link = news_item.get('link') # URL не екрануємо
-                    
-                    text_message = (
-                        f"🔔 Нова новина: *{title}*\n\n"
-                        f"{content}\n\n"
-                        f"[Читати більше]({escape_markdown_v2(link) if link else ''})" # Посилання на оригінальний URL новини
-                    )
-                    
-                    try:
-                        await bot.send_message(chat_id=user['telegram_id'], text=text_message, parse_mode=ParseMode.MARKDOWN_V2)
-                        logging.info(f"Відправлено автоматичне сповіщення користувачу {user['telegram_id']} про новину: {news_item['title']}")
-                        # Позначаємо новину як переглянуту після відправки сповіщення
-                        await conn.execute(
-                            "INSERT INTO user_news_views (user_id, news_id, viewed, first_viewed_at) VALUES ($1, $2, TRUE, NOW()) ON CONFLICT (user_id, news_id) DO UPDATE SET viewed = TRUE, last_viewed_at = NOW()",
-                            user['user_internal_id'], news_item['id']
-                        )
-                        await update_user_stats(conn, user['user_internal_id'], "viewed")
-                    except Exception as e:
-                        logging.error(f"Помилка відправки сповіщення користувачу {user['telegram_id']}: {e}")
+            conn = await asyncpg.connect(DATABASE_URL)
+            conn.add_termination_listener(lambda _: lost.set())
+            await conn.add_listener('news_added', _on_news_added)
+            app.state.news_listener = conn
+            if reconnecting:
+                logging.info("Слухач news_added перепідключено.")
+                news_added_event.set()
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), timeout=NEWS_LISTENER_HEALTHCHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    await conn.fetchval("SELECT 1", timeout=NEWS_LISTENER_HEALTHCHECK_TIMEOUT)
+            logging.warning("З'єднання слухача news_added розірвано.")
+        except Exception as e:
+            logging.error(f"Слухач news_added недоступний, сповіщення працюють за розкладом: {e}")
+        finally:
+            app.state.news_listener = None
+            if conn is not None and not conn.is_closed():
+                conn.terminate()
+        reconnecting = True
+        await asyncio.sleep(NEWS_LISTENER_RECONNECT_DELAY)
 
+async def auto_notifications_task():
+    """
+    Фонова задача автоматичних сповіщень: прохід запускається, щойно в БД
+    з'являються нові новини (LISTEN/NOTIFY), і не рідше ніж раз на 15 хвилин.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(news_added_event.wait(), timeout=AUTO_NOTIFICATIONS_FALLBACK_INTERVAL)
+            await asyncio.sleep(AUTO_NOTIFICATIONS_DEBOUNCE)
+        except asyncio.TimeoutError:
+            pass
+        news_added_event.clear()
+        try:
+            await send_auto_notifications()
         except Exception as e:
             logging.error(f"Помилка в задачі автоматичних сповіщень: {e}")
-        finally:
-            if conn:
-                await conn.close()
-        await asyncio.sleep(15 * 60) # Перевіряємо кожні 15 хвилин
 
 
+# ==== Оновлення матеріалізованих представлень ====
+async def refresh_materialized_views():
+    """Оновлює матеріалізоване представлення trending_scores (тренди за останні 24 години)."""
+    async with app.state.pool.acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        await conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY trending_scores")
+
+
+# ==== Планувальник фонових задач ====
+async def run_periodic(name: str, job, interval: float, jitter: float = 0.0):
+    """
+    Періодично виконує корутину job. Наступний запуск починається лише після
+    завершення попереднього (запуски не накладаються), через interval секунд
+    плюс випадковий зсув до jitter секунд, щоб задачі не спрацьовували синхронно.
+    """
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logging.error(f"Помилка у фоновій задачі {name}: {e}")
+        await asyncio.sleep(interval + random.uniform(0, jitter))
+
+
+# == ВИКЛИКИ СПІЛЬНИХ КОРУТИН З БОТА ==
+async def bot_call(coro: Awaitable, action: str) -> Tuple[bool, Any]:
+    """
+    Виконує спільну з API корутину в хендлері бота: бот працює в тому ж процесі, тож HTTP-запит
+    до власного API не потрібен. Повертає (True, результат) або (False, None), якщо корутина впала
+    (пул зайнятий, HTTPException тощо); помилка логується.
+    """
+    try:
+        return True, await coro
+    except Exception as e:
+        logging.error(f"Помилка: {action}: {e}")
+        return False, None
+
 # == КЛАВІАТУРИ ==
 main_keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, keyboard=[
     [types.KeyboardButton(text="📰 Новини"), types.KeyboardButton(text="🎯 Фільтри")],
@@ -1068,8 +1670,104 @@ extra_features_keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, keyboa
     [types.KeyboardButton(text="✉️ Запросити друга"), types.KeyboardButton(text="⬅️ Головне меню")]
 ])
 
+# Статичні inline-клавіатури: створюються один раз при імпорті, а не на кожен виклик хендлера
+filter_type_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Тег", callback_data="filter_type_tag"), types.InlineKeyboardButton(text="Категорія", callback_data="filter_type_category")],
+    [types.InlineKeyboardButton(text="Джерело", callback_data="filter_type_source"), types.InlineKeyboardButton(text="Мова", callback_data="filter_type_language")],
+    [types.InlineKeyboardButton(text="Країна", callback_data="filter_type_country"), types.InlineKeyboardButton(text="Тип контенту", callback_data="filter_type_content_type")]
+])
+
+custom_feed_filters_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Додати теги", callback_data="add_feed_filter_tags")],
+    [types.InlineKeyboardButton(text="Додати джерела", callback_data="add_feed_filter_sources")],
+    [types.InlineKeyboardButton(text="Додати мови", callback_data="add_feed_filter_languages")],
+    [types.InlineKeyboardButton(text="✅ Завершити створення добірки", callback_data="finish_create_feed")]
+])
+
+buy_premium_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Купити Преміум (100 UAH/міс)", callback_data="buy_premium")]
+])
+
+email_manage_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Змінити Email", callback_data="change_email"), types.InlineKeyboardButton(text="Відписатись від Email", callback_data="unsubscribe_email")]
+])
+
+email_add_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Додати Email", callback_data="add_email")]
+])
+
+view_mode_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Ручний перегляд (MyFeed)", callback_data="set_view_mode_manual")],
+    [types.InlineKeyboardButton(text="Автоматичний дайджест", callback_data="set_view_mode_auto")]
+])
+
+daily_digest_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Підписатись на щоденну", callback_data="subscribe_daily_daily")],
+    [types.InlineKeyboardButton(text="Підписатись на погодинну", callback_data="subscribe_daily_hourly")],
+    [types.InlineKeyboardButton(text="Відписатись", callback_data="unsubscribe_daily")]
+])
+
+report_type_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="На новину", callback_data="report_news")],
+    [types.InlineKeyboardButton(text="Загальна проблема", callback_data="report_general")]
+])
+
+language_menu_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Змінити мову інтерфейсу", callback_data="change_interface_lang")],
+    [types.InlineKeyboardButton(text="Увімкнути/вимкнути переклад новин", callback_data="toggle_news_translation")]
+])
+
+source_type_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Telegram", callback_data="source_type_telegram"), types.InlineKeyboardButton(text="RSS", callback_data="source_type_rss")],
+    [types.InlineKeyboardButton(text="Website", callback_data="source_type_website"), types.InlineKeyboardButton(text="Twitter", callback_data="source_type_twitter")]
+])
+
+comments_menu_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Додати коментар", callback_data="add_comment")],
+    [types.InlineKeyboardButton(text="Переглянути коментарі до новини", callback_data="view_comments")]
+])
+
 # == ХЕНДЛЕРИ ==
 
+# Позначка "стан до виклику хендлера невідомий" (raw_state не передано)
+_STATE_UNKNOWN = object()
+
+def clear_state_after(handler):
+    """
+    Скидає стан FSM після завершення хендлера на будь-якому шляху виходу (зокрема при помилці).
+    Решта залежностей, які приймає хендлер (bot, command, дані middleware), передаються йому без змін.
+    raw_state — стан, який FSM middleware aiogram уже прочитав зі сховища; aiogram передає його обгортці
+    при прямій реєстрації, а call_route — при виклику з таблиць маршрутів. Якщо він порожній, запис
+    у сховище пропускається (ці хендлери самі стан не встановлюють). Без raw_state стан скидається завжди.
+    """
+    # Імена додаткових параметрів хендлера (крім event і state) визначаються один раз при декоруванні
+    handler_params = list(inspect.signature(handler).parameters.values())[2:]
+    accepts_any = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in handler_params)
+    extra_names = frozenset(p.name for p in handler_params)
+
+    async def wrapper(event, state: FSMContext, raw_state: Any = _STATE_UNKNOWN, **kwargs):
+        if not accepts_any:
+            kwargs = {name: value for name, value in kwargs.items() if name in extra_names}
+        try:
+            return await handler(event, state, **kwargs)
+        finally:
+            if raw_state is not None:
+                await state.set_state(None)
+    update_wrapper(wrapper, handler)
+    # aiogram розгортає __wrapped__ (inspect.unwrap) і тоді передавав би лише параметри хендлера,
+    # без raw_state; без цього атрибута він бачить сигнатуру обгортки з **kwargs
+    del wrapper.__wrapped__
+    wrapper.accepts_raw_state = True
+    return wrapper
+
+async def call_route(route: Callable[..., Awaitable[Any]], event, state: FSMContext, raw_state: Optional[str]):
+    """Викликає хендлер із таблиці маршрутів; хендлерам з clear_state_after передає відомий raw_state."""
+    if getattr(route, "accepts_raw_state", False):
+        await route(event, state, raw_state=raw_state)
+    else:
+        await route(event, state)
+
+@clear_state_after
 async def start_command_handler(msg: types.Message, state: FSMContext):
     """
     Обробляє команду /start.
@@ -1077,19 +1775,18 @@ async def start_command_handler(msg: types.Message, state: FSMContext):
     """
     user_id = msg.from_user.id
     language_code = msg.from_user.language_code
-    country_code = msg.from_user.locale.language if msg.from_user.locale else None
+    # У aiogram 3 User не має locale; країну беремо з регіональної частини мовного тегу (напр., "en-US")
+    country_code = language_code.partition("-")[2].upper() or None if language_code else None
     
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/users/register", json={
-            "user_id": user_id,
-            "language": language_code,
-            "country": country_code
-        })
-        if resp.status == 200:
-            await msg.answer("👋 Ласкаво просимо до AI News Бота!", reply_markup=main_keyboard)
-        else:
-            await msg.answer("👋 Ласкаво просимо! Виникла проблема з реєстрацією, але ви можете продовжувати користуватися.")
-    await state.set_state(None) # Очищаємо стан, якщо був
+    ok, _ = await bot_call(register_user(UserRegisterRequest(
+        user_id=user_id,
+        language=language_code,
+        country=country_code
+    )), "реєстрація користувача")
+    if ok:
+        await msg.answer("👋 Ласкаво просимо до AI News Бота!", reply_markup=main_keyboard)
+    else:
+        await msg.answer("👋 Ласкаво просимо! Виникла проблема з реєстрацією, але ви можете продовжувати користуватися.")
 
 
 async def show_news_handler(msg: types.Message):
@@ -1098,46 +1795,54 @@ async def show_news_handler(msg: types.Message):
     """
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/news/{user_id}?limit=1")
-        if resp.status == 200:
-            news_items = await resp.json()
-            if news_items:
-                news_item = news_items[0]
-                await session.post(f"{WEBAPP_URL}/log_user_activity", json={
-                    "user_id": user_id,
-                    "news_id": news_item['id'],
-                    "action": "view"
-                })
-                
-                # Екранування тексту для MarkdownV2
-                title = escape_markdown_v2(news_item['title'])
-                content = escape_markdown_v2(news_item['content'])
-                source = escape_markdown_v2(news_item['source'])
-                # Не екрануємо link, оскільки це URL
-                link = news_item.get('link')
-
-                keyboard = types.InlineKeyboardMarkup(row_width=2)
-                keyboard.add(
-                    types.InlineKeyboardButton(text="👍 Подобається", callback_data=f"like_{news_item['id']}"),
-                    types.InlineKeyboardButton(text="👎 Не подобається", callback_data=f"dislike_{news_item['id']}"),
-                    types.InlineKeyboardButton(text="🔖 Зберегти", callback_data=f"save_{news_item['id']}"),
-                    types.InlineKeyboardButton(text="➡️ Пропустити", callback_data=f"skip_{news_item['id']}")
-                )
-                if link:
-                     keyboard.add(types.InlineKeyboardButton(text="🌐 Читати повністю", url=link)) # URL не потребує екранування
-
-                await msg.answer(
-                    f"*{title}*\n\n"
-                    f"{content}\n\n"
-                    f"Джерело: {source}\n",
-                    reply_markup=keyboard,
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            else:
-                await msg.answer("Наразі немає нових новин за вашими фільтрами. Спробуйте змінити налаштування фільтрів або повторіть спробу пізніше.")
-        else:
-            await msg.answer("❌ Виникла проблема при завантаженні новин.")
+    # Стрічка береться напряму, без HTTP-запиту до власного API
+    try:
+        news_items = await fetch_news_for_user(user_id, limit=1)
+    except Exception as e:
+        logging.error(f"Помилка завантаження новин для користувача {user_id}: {e}")
+        await msg.answer("❌ Виникла проблема при завантаженні новин.")
+        return
+
+    if news_items:
+        news_item = news_items[0]
+        # Лог перегляду не залежить від відправки повідомлення, тож виконується паралельно з нею
+        log_task = asyncio.create_task(record_user_activity(user_id, news_item['id'], "view"))
+        # Задача очікується на будь-якому шляху виходу: навіть якщо відправка впала (напр., TelegramBadRequest),
+        # лог перегляду дописується, а його помилка не губиться
+        try:
+            # Екранування тексту для MarkdownV2
+            title = escape_markdown_v2(news_item['title'])
+            content = escape_markdown_v2(news_item['content'])
+            source = escape_markdown_v2(news_item['source'])
+            # Не екрануємо link, оскільки це URL
+            link = news_item.get('link')
+
+            news_id = news_item['id']
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    types.InlineKeyboardButton(text="👍 Подобається", callback_data=f"like_{news_id}"),
+                    types.InlineKeyboardButton(text="👎 Не подобається", callback_data=f"dislike_{news_id}"),
+                ],
+                [
+                    types.InlineKeyboardButton(text="🔖 Зберегти", callback_data=f"save_{news_id}"),
+                    types.InlineKeyboardButton(text="➡️ Пропустити", callback_data=f"skip_{news_id}"),
+                ],
+            ] + ([[types.InlineKeyboardButton(text="🌐 Читати повністю", url=link)]] if link else [])) # URL не потребує екранування
+
+            await msg.answer(
+                f"*{title}*\n\n"
+                f"{content}\n\n"
+                f"Джерело: {source}\n",
+                reply_markup=keyboard,
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+        finally:
+            try:
+                await log_task
+            except Exception as e:
+                logging.error(f"Помилка запису перегляду новини {news_item['id']} користувачем {user_id}: {e}")
+    else:
+        await msg.answer("Наразі немає нових новин за вашими фільтрами. Спробуйте змінити налаштування фільтрів або повторіть спробу пізніше.")
 
 
 async def process_news_interaction_handler(callback_query: types.CallbackQuery):
@@ -1164,37 +1869,35 @@ async def process_news_interaction_handler(callback_query: types.CallbackQuery):
         interaction_action = "skip"
         response_text = "➡️ Новина пропущена."
 
-    async with aiohttp.ClientSession() as session:
+    # Закладка та лог дії виконуються напряму, без HTTP-запиту до власного API
+    try:
         if interaction_action == "save":
-            resp = await session.post(f"{WEBAPP_URL}/bookmarks/add", json={"user_id": user_id, "news_id": news_id})
-        else:
-            resp = await session.post(f"{WEBAPP_URL}/log_user_activity", json={"user_id": user_id, "news_id": news_id, "action": interaction_action})
-
-        if resp.status == 200:
-            await callback_query.message.answer(response_text)
-            await callback_query.message.edit_reply_markup(reply_markup=None) # Приховуємо кнопки
-            if interaction_action == "skip":
-                await show_news_handler(callback_query.message) # Передаємо message об'єкт
+            processed = await add_bookmark(user_id, news_id)
         else:
-            await callback_query.message.answer("❌ Виникла проблема з обробкою вашої дії.")
+            processed = await record_user_activity(user_id, news_id, interaction_action)
+    except Exception as e:
+        logging.error(f"Помилка обробки дії {interaction_action} користувача {user_id}: {e}")
+        processed = False
+
+    if processed:
+        # Відповідь і приховування кнопок — незалежні запити до Telegram
+        await asyncio.gather(
+            callback_query.message.answer(response_text),
+            callback_query.message.edit_reply_markup(reply_markup=None) # Приховуємо кнопки
+        )
+        if interaction_action == "skip":
+            await show_news_handler(callback_query.message) # Передаємо message об'єкт
+    else:
+        await callback_query.message.answer("❌ Виникла проблема з обробкою вашої дії.")
 
+@clear_state_after
 async def show_filters_menu_handler(msg: types.Message, state: FSMContext):
     """Відкриває меню фільтрів."""
     await msg.answer("Оберіть дію з фільтрами:", reply_markup=filters_keyboard)
-    await state.set_state(None) # Очищаємо стан, якщо був
 
 async def add_filter_start_handler(msg: types.Message):
     """Починає процес додавання нового фільтра."""
-    keyboard = types.InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        types.InlineKeyboardButton(text="Тег", callback_data="filter_type_tag"),
-        types.InlineKeyboardButton(text="Категорія", callback_data="filter_type_category"),
-        types.InlineKeyboardButton(text="Джерело", callback_data="filter_type_source"),
-        types.InlineKeyboardButton(text="Мова", callback_data="filter_type_language"),
-        types.InlineKeyboardButton(text="Країна", callback_data="filter_type_country"),
-        types.InlineKeyboardButton(text="Тип контенту", callback_data="filter_type_content_type")
-    )
-    await msg.answer("Оберіть тип фільтра, який бажаєте додати:", reply_markup=keyboard)
+    await msg.answer("Оберіть тип фільтра, який бажаєте додати:", reply_markup=filter_type_keyboard)
 
 async def process_filter_type_handler(callback_query: types.CallbackQuery, state: FSMContext):
     """
@@ -1205,8 +1908,9 @@ async def process_filter_type_handler(callback_query: types.CallbackQuery, state
     
     await state.update_data(filter_type=filter_type)
     await callback_query.message.answer(f"Будь ласка, введіть значення для фільтра '*{escape_markdown_v2(filter_type)}*':", parse_mode=ParseMode.MARKDOWN_V2)
-    await FilterStates.waiting_for_filter_tag.set()
+    await state.set_state(FilterStates.waiting_for_filter_tag)
 
+@clear_state_after
 async def process_filter_value_handler(msg: types.Message, state: FSMContext):
     """
     Обробляє введене значення фільтра та зберігає його.
@@ -1216,66 +1920,54 @@ async def process_filter_value_handler(msg: types.Message, state: FSMContext):
     filter_value = msg.text.strip()
     user_id = msg.from_user.id
     
-    payload = {"user_id": user_id, filter_type: filter_value}
-    
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/filters/update", json=payload)
-        if resp.status == 200:
-            await msg.answer(f"✅ Фільтр '`{escape_markdown_v2(filter_type)}`: `{escape_markdown_v2(str(filter_value))}`' успішно додано/оновлено\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося додати/оновити фільтр. Спробуйте ще раз.")
-    await state.set_state(None)
+    ok, updated = await bot_call(update_filters(FilterUpdateRequest(user_id=user_id, **{filter_type: filter_value})), "оновлення фільтра")
+    if ok and updated:
+        await msg.answer(f"✅ Фільтр '`{escape_markdown_v2(filter_type)}`: `{escape_markdown_v2(str(filter_value))}`' успішно додано/оновлено\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося додати/оновити фільтр. Спробуйте ще раз.")
 
 
 async def show_my_filters_handler(msg: types.Message):
     """Показує поточні активні фільтри користувача."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/filters/{user_id}")
-        if resp.status == 200:
-            filters = await resp.json()
-            if filters:
-                filter_text = "*Ваші активні фільтри:*\n"
-                for k, v in filters.items():
-                    if v:
-                        filter_text += f"\\- *{escape_markdown_v2(k.capitalize())}*: `{escape_markdown_v2(str(v))}`\n" # Екрануємо значення V
-                await msg.answer(filter_text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("У вас немає активних фільтрів.")
+    ok, payload = await bot_call(filters_json(user_id), "завантаження фільтрів")
+    if ok:
+        filters = orjson.loads(payload)
+        if filters:
+            filter_text = "*Ваші активні фільтри:*\n"
+            for k, v in filters.items():
+                if v:
+                    filter_text += f"\\- *{escape_markdown_v2(k.capitalize())}*: `{escape_markdown_v2(str(v))}`\n" # Екрануємо значення V
+            await msg.answer(filter_text, parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            await msg.answer("❌ Не вдалося завантажити ваші фільтри.")
+            await msg.answer("У вас немає активних фільтрів.")
+    else:
+        await msg.answer("❌ Не вдалося завантажити ваші фільтри.")
 
 async def reset_filters_handler(msg: types.Message):
     """Скидає всі фільтри користувача."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.delete(f"{WEBAPP_URL}/filters/reset/{user_id}")
-        if resp.status == 200:
-            await msg.answer("✅ Усі ваші фільтри успішно скинуто\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося скинути фільтри. Спробуйте пізніше.")
+    ok, reset = await bot_call(reset_filters(user_id), "скидання фільтрів")
+    if ok and reset:
+        await msg.answer("✅ Усі ваші фільтри успішно скинуто.")
+    else:
+        await msg.answer("❌ Не вдалося скинути фільтри. Спробуйте пізніше.")
 
 async def create_custom_feed_start_handler(msg: types.Message, state: FSMContext):
     """Починає процес створення нової персональної добірки."""
     await msg.answer("Будь ласка, введіть назву для вашої нової добірки:")
-    await CustomFeedStates.waiting_for_feed_name.set()
+    await state.set_state(CustomFeedStates.waiting_for_feed_name)
 
 async def process_custom_feed_name_handler(msg: types.Message, state: FSMContext):
     """Зберігає назву добірки і просить ввести фільтри."""
     feed_name = msg.text.strip()
-    await state.update_data(feed_name=feed_name, filters={})
-    
-    keyboard = types.InlineKeyboardMarkup(row_width=1)
-    keyboard.add(
-        types.InlineKeyboardButton(text="Додати теги", callback_data="add_feed_filter_tags"),
-        types.InlineKeyboardButton(text="Додати джерела", callback_data="add_feed_filter_sources"),
-        types.InlineKeyboardButton(text="Додати мови", callback_data="add_feed_filter_languages"),
-        types.InlineKeyboardButton(text="✅ Завершити створення добірки", callback_data="finish_create_feed")
-    )
-    await msg.answer(f"Добірка '`{escape_markdown_v2(feed_name)}`' створена. Тепер ви можете додати до неї фільтри:", reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-    await CustomFeedStates.waiting_for_feed_filters_tags.set()
+    # Нова добірка починається з чистих даних, щоб не підхопити фільтри попередньої
+    await state.set_data({'feed_name': feed_name})
+
+    await msg.answer(f"Добірка '`{escape_markdown_v2(feed_name)}`' створена. Тепер ви можете додати до неї фільтри:", reply_markup=custom_feed_filters_keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+    await state.set_state(CustomFeedStates.waiting_for_feed_filters_tags)
 
 
 async def add_feed_filter_handler(callback_query: types.CallbackQuery, state: FSMContext):
@@ -1292,17 +1984,11 @@ async def process_feed_filter_value_handler(msg: types.Message, state: FSMContex
     
     if current_feed_filter_type:
         values = [v.strip() for v in msg.text.split(',') if v.strip()]
-        user_data['filters'][current_feed_filter_type] = values
-        await state.update_data(filters=user_data['filters'])
-        
-        keyboard = types.InlineKeyboardMarkup(row_width=1)
-        keyboard.add(
-            types.InlineKeyboardButton(text="Додати теги", callback_data="add_feed_filter_tags"),
-            types.InlineKeyboardButton(text="Додати джерела", callback_data="add_feed_filter_sources"),
-            types.InlineKeyboardButton(text="Додати мови", callback_data="add_feed_filter_languages"),
-            types.InlineKeyboardButton(text="✅ Завершити створення добірки", callback_data="finish_create_feed")
-        )
-        await msg.answer(f"Фільтри для '`{escape_markdown_v2(current_feed_filter_type)}`' додано. Можете додати ще або завершити.", reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+        # Кожен тип фільтра — окремий ключ; дані вже прочитані, тож один запис без повторного читання
+        user_data[f"feed_filter_{current_feed_filter_type}"] = values
+        await state.set_data(user_data)
+
+        await msg.answer(f"Фільтри для '`{escape_markdown_v2(current_feed_filter_type)}`' додано. Можете додати ще або завершити.", reply_markup=custom_feed_filters_keyboard, parse_mode=ParseMode.MARKDOWN_V2)
     else:
         await msg.answer("Будь ласка, спочатку оберіть тип фільтра для добірки.")
 
@@ -1312,137 +1998,120 @@ async def finish_create_feed_handler(callback_query: types.CallbackQuery, state:
     await callback_query.bot.answer_callback_query(callback_query.id)
     user_data = await state.get_data()
     feed_name = user_data['feed_name']
-    filters = user_data['filters']
+    # Збираємо фільтри добірки з окремих ключів feed_filter_<тип>
+    filters = {key[len("feed_filter_"):]: value for key, value in user_data.items() if key.startswith("feed_filter_")}
     user_id = callback_query.from_user.id
     
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/custom_feeds/create", json={
-            "user_id": user_id,
-            "feed_name": feed_name,
-            "filters": filters
-        })
-        if resp.status == 200:
-            await callback_query.message.answer(f"✅ Персональна добірка '`{escape_markdown_v2(feed_name)}`' успішно збережена!", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            error_details = await resp.json()
-            await callback_query.message.answer(f"❌ Не вдалося створити добірку: {escape_markdown_v2(error_details.get('detail', 'Невідома помилка'))}")
+    try:
+        created = await create_custom_feed(CustomFeedCreateRequest(user_id=user_id, feed_name=feed_name, filters=filters))
+        error_text = None if created else "Користувача не знайдено."
+    except asyncpg.UniqueViolationError:
+        error_text = "Добірка з такою назвою вже існує."
+    except Exception as e:
+        logging.error(f"Помилка створення добірки користувача {user_id}: {e}")
+        error_text = "Невідома помилка"
+    if error_text is None:
+        await callback_query.message.answer(f"✅ Персональна добірка '`{escape_markdown_v2(feed_name)}`' успішно збережена!", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await callback_query.message.answer(f"❌ Не вдалося створити добірку: {error_text}")
     await state.set_state(None)
     await callback_query.message.delete_reply_markup()
 
 
+@clear_state_after
 async def switch_custom_feed_menu_handler(msg: types.Message, state: FSMContext):
     """Показує список добірок для переключення."""
     user_id = msg.from_user.id
     
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/custom_feeds/{user_id}")
-        if resp.status == 200:
-            feeds = await resp.json()
-            if feeds:
-                keyboard = types.InlineKeyboardMarkup(row_width=1)
-                for feed in feeds:
-                    keyboard.add(types.InlineKeyboardButton(text=feed['feed_name'], callback_data=f"switch_feed_{feed['id']}"))
-                await msg.answer("Оберіть добірку, на яку хочете переключитися:", reply_markup=keyboard)
-            else:
-                await msg.answer("У вас ще немає створених добірок. Створіть одну за допомогою '🆕 Створити добірку'.")
+    ok, feeds = await bot_call(fetch_custom_feeds(user_id), "завантаження добірок")
+    if ok:
+        if feeds:
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text=feed['feed_name'], callback_data=f"switch_feed_{feed['id']}")] for feed in feeds
+            ])
+            await msg.answer("Оберіть добірку, на яку хочете переключитися:", reply_markup=keyboard)
         else:
-            await msg.answer("❌ Не вдалося завантажити ваші добірки.")
-    await state.set_state(None)
+            await msg.answer("У вас ще немає створених добірок. Створіть одну за допомогою '🆕 Створити добірку'.")
+    else:
+        await msg.answer("❌ Не вдалося завантажити ваші добірки.")
 
 
+@clear_state_after
 async def process_switch_feed_handler(callback_query: types.CallbackQuery, state: FSMContext):
     """Обробляє вибір добірки для переключення."""
     await callback_query.bot.answer_callback_query(callback_query.id)
     feed_id = int(callback_query.data.replace("switch_feed_", ""))
     user_id = callback_query.from_user.id
     
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/custom_feeds/switch", json={
-            "user_id": user_id,
-            "feed_id": feed_id
-        })
-        if resp.status == 200:
-            await callback_query.message.answer(f"✅ Ви успішно переключилися на добірку ID: `{escape_markdown_v2(str(feed_id))}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await callback_query.message.answer("❌ Не вдалося переключити добірку. Спробуйте пізніше.")
-    await callback_query.message.edit_reply_markup(reply_markup=None) # Remove inline keyboard after selection
-    await state.set_state(None)
+    ok, switched = await bot_call(switch_custom_feed(user_id, feed_id), "переключення добірки")
+    # Результат замінює меню в тому ж повідомленні: edit_text без reply_markup прибирає кнопки
+    if ok and switched:
+        await callback_query.message.edit_text(f"✅ Ви успішно переключилися на добірку ID: `{escape_markdown_v2(str(feed_id))}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await callback_query.message.edit_text("❌ Не вдалося переключити добірку. Спробуйте пізніше.")
 
 
+@clear_state_after
 async def edit_custom_feed_menu_handler(msg: types.Message, state: FSMContext):
     """Пропонує користувачу обрати добірку для редагування."""
     user_id = msg.from_user.id
     
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/custom_feeds/{user_id}")
-        if resp.status == 200:
-            feeds = await resp.json()
-            if feeds:
-                keyboard = types.InlineKeyboardMarkup(row_width=1)
-                for feed in feeds:
-                    keyboard.add(types.InlineKeyboardButton(text=feed['feed_name'], callback_data=f"edit_feed_{feed['id']}"))
-                await msg.answer("Оберіть добірку для редагування:", reply_markup=keyboard)
-            else:
-                await msg.answer("У вас ще немає створених добірок для редагування.")
+    ok, feeds = await bot_call(fetch_custom_feeds(user_id), "завантаження добірок")
+    if ok:
+        if feeds:
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text=feed['feed_name'], callback_data=f"edit_feed_{feed['id']}")] for feed in feeds
+            ])
+            await msg.answer("Оберіть добірку для редагування:", reply_markup=keyboard)
         else:
-            await msg.answer("❌ Не вдалося завантажити ваші добірки.")
-    await state.set_state(None)
+            await msg.answer("У вас ще немає створених добірок для редагування.")
+    else:
+        await msg.answer("❌ Не вдалося завантажити ваші добірки.")
 
 
+@clear_state_after
 async def show_settings_handler(msg: types.Message, state: FSMContext):
     """Відкриває меню налаштувань."""
+    # Пункти «Преміум» та «Email розсилка» читають профіль: завантажуємо його, поки користувач обирає
+    prefetch_user_profile(msg.from_user.id)
     await msg.answer("Оберіть налаштування:", reply_markup=settings_keyboard)
-    await state.set_state(None)
 
 async def toggle_safe_mode_handler(msg: types.Message):
     """Перемикає безпечний режим для користувача."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        profile_resp = await session.get(f"{WEBAPP_URL}/users/{user_id}/profile")
-        if profile_resp.status == 200:
-            profile = await profile_resp.json()
-            current_safe_mode = profile.get('safe_mode', False)
-            new_safe_mode = not current_safe_mode
-
-            update_resp = await session.post(f"{WEBAPP_URL}/users/register", json={"user_id": user_id, "safe_mode": new_safe_mode})
-            if update_resp.status == 200:
-                status_text = "увімкнено" if new_safe_mode else "вимкнено"
-                await msg.answer(f"✅ Безпечний режим {status_text}\\.", parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("❌ Не вдалося змінити налаштування безпечного режиму.")
-        else:
-            await msg.answer("❌ Не вдалося завантажити профіль користувача.")
+    # Читання і запис в одному UPDATE, без окремого запиту профілю
+    new_safe_mode = await toggle_user_flag(user_id, "safe_mode")
+    if new_safe_mode is not None:
+        status_text = "увімкнено" if new_safe_mode else "вимкнено"
+        await msg.answer(f"✅ Безпечний режим {status_text}\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося завантажити профіль користувача.")
 
 async def premium_info_handler(msg: types.Message):
     """Надає інформацію про преміум-підписку."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        profile_resp = await session.get(f"{WEBAPP_URL}/users/{user_id}/profile")
-        if profile_resp.status == 200:
-            profile = await profile_resp.json()
-            is_premium = profile.get('is_premium', False)
-            premium_expires_at = profile.get('premium_expires_at')
-
-            if is_premium:
-                expires_date = datetime.fromisoformat(premium_expires_at).strftime("%d.%m.%Y %H:%M") if premium_expires_at else "невідомо"
-                await msg.answer(f"🎉 У вас активна *Преміум\\-підписка* до `{escape_markdown_v2(expires_date)}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                keyboard = types.InlineKeyboardMarkup().add(
-                    types.InlineKeyboardButton(text="Купити Преміум (100 UAH/міс)", callback_data="buy_premium")
-                )
-                await msg.answer("✨ Отримайте *Преміум\\-підписку* для доступу до розширених функцій!\n\n"
-                                 "**Переваги:**\n"
-                                 "\\- Розширений AI\\-аналіз\n"
-                                 "\\- Персоналізовані рекомендації\n"
-                                 "\\- Відсутність реклами\n"
-                                 "\\- Пріоритетна підтримка\n"
-                                 "\\- Інші ексклюзивні функції\n\n"
-                                 f"Вартість: `100 UAH/місяць`\\. Оплатити можна на Monobank: `{escape_markdown_v2(MONOBANK_CARD_NUMBER)}`",
-                                 reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+    profile = await get_user_profile(user_id)
+    if profile:
+        is_premium = profile['is_premium']
+        premium_expires_at = profile['premium_expires_at']
+
+        if is_premium:
+            expires_date = premium_expires_at.strftime("%d.%m.%Y %H:%M") if premium_expires_at else "невідомо"
+            await msg.answer(f"🎉 У вас активна *Преміум\\-підписка* до `{escape_markdown_v2(expires_date)}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            await msg.answer("❌ Не вдалося завантажити профіль користувача.")
+            await msg.answer("✨ Отримайте *Преміум\\-підписку* для доступу до розширених функцій!\n\n"
+                             "**Переваги:**\n"
+                             "\\- Розширений AI\\-аналіз\n"
+                             "\\- Персоналізовані рекомендації\n"
+                             "\\- Відсутність реклами\n"
+                             "\\- Пріоритетна підтримка\n"
+                             "\\- Інші ексклюзивні функції\n\n"
+                             f"Вартість: `100 UAH/місяць`\\. Оплатити можна на Monobank: `{escape_markdown_v2(MONOBANK_CARD_NUMBER)}`",
+                             reply_markup=buy_premium_keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося завантажити профіль користувача.")
 
 async def handle_buy_premium_callback(callback_query: types.CallbackQuery):
     """Обробляє натискання кнопки 'Купити Преміум'."""
@@ -1450,213 +2119,164 @@ async def handle_buy_premium_callback(callback_query: types.CallbackQuery):
     await callback_query.message.answer(f"Для активації *Преміум\\-підписки* перекажіть `100 UAH` на картку Monobank: `{escape_markdown_v2(MONOBANK_CARD_NUMBER)}`\\.\n\n"
                                         "Активація відбудеться автоматично після підтвердження оплати\\.", parse_mode=ParseMode.MARKDOWN_V2)
 
+@clear_state_after
 async def email_subscription_menu_handler(msg: types.Message, state: FSMContext):
     """Меню для управління email-розсилками."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        profile_resp = await session.get(f"{WEBAPP_URL}/users/{user_id}/profile")
-        if profile_resp.status == 200:
-            profile = await profile_resp.json()
-            user_email = profile.get('email')
+    profile = await get_user_profile(user_id)
+    if profile:
+        user_email = profile['email']
 
-            if user_email:
-                keyboard = types.InlineKeyboardMarkup().add(
-                    types.InlineKeyboardButton(text="Змінити Email", callback_data="change_email"),
-                    types.InlineKeyboardButton(text="Відписатись від Email", callback_data="unsubscribe_email")
-                )
-                await msg.answer(f"Ваша поточна Email\\-адреса для розсилки: `{escape_markdown_v2(user_email)}`\\.", reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                keyboard = types.InlineKeyboardMarkup().add(
-                    types.InlineKeyboardButton(text="Додати Email", callback_data="add_email")
-                )
-                await msg.answer("У вас ще не налаштована Email\\-розсилка\\. Додайте вашу Email\\-адресу:", reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+        if user_email:
+            await msg.answer(f"Ваша поточна Email\\-адреса для розсилки: `{escape_markdown_v2(user_email)}`\\.", reply_markup=email_manage_keyboard, parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            await msg.answer("❌ Не вдалося завантажити профіль користувача.")
-    await state.set_state(None)
+            await msg.answer("У вас ще не налаштована Email-розсилка. Додайте вашу Email-адресу:", reply_markup=email_add_keyboard)
+    else:
+        await msg.answer("❌ Не вдалося завантажити профіль користувача.")
 
 async def request_email_input_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Запитує Email адресу у користувача."""
     await callback_query.bot.answer_callback_query(callback_query.id)
-    await callback_query.message.answer("Будь ласка, введіть вашу Email\\-адресу:", parse_mode=ParseMode.MARKDOWN_V2)
-    await ProfileSettingsStates.waiting_for_email.set()
+    await callback_query.message.answer("Будь ласка, введіть вашу Email-адресу:")
+    await state.set_state(ProfileSettingsStates.waiting_for_email)
+
+# Проста перевірка формату: одна @, без пробілів, у домені є крапка
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+EMAIL_MAX_LENGTH = 254 # RFC 5321
 
 async def process_email_input_handler(msg: types.Message, state: FSMContext):
     """Обробляє введену Email адресу та зберігає її."""
     user_id = msg.from_user.id
-    email = msg.text.strip()
-    
-    if "@" not in email or "." not in email:
-        await msg.answer("Будь ласка, введіть коректну Email\\-адресу\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    # Домен нечутливий до регістру, а локальна частина — може бути чутливою, тож її не чіпаємо
+    local_part, at, domain = msg.text.strip().rpartition("@")
+    email = f"{local_part}{at}{domain.lower()}" if at else domain
+
+    if len(email) > EMAIL_MAX_LENGTH or not EMAIL_RE.match(email):
+        await msg.answer("Будь ласка, введіть коректну Email-адресу.")
         return
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/users/register", json={"user_id": user_id, "email": email})
-        if resp.status == 200:
-            await msg.answer(f"✅ Вашу Email\\-адресу `{escape_markdown_v2(email)}` успішно збережено для розсилки\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося зберегти Email\\. Можливо, ця адреса вже використовується\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    ok, _ = await bot_call(register_user(UserRegisterRequest(user_id=user_id, email=email)), "збереження email")
+    if ok:
+        await msg.answer(f"✅ Вашу Email\\-адресу `{escape_markdown_v2(email)}` успішно збережено для розсилки\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося зберегти Email. Можливо, ця адреса вже використовується.")
     await state.set_state(None)
 
+@clear_state_after
 async def unsubscribe_email_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Відписує користувача від email-розсилок."""
     await callback_query.bot.answer_callback_query(callback_query.id)
     user_id = callback_query.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/users/register", json={"user_id": user_id, "email": None})
-        if resp.status == 200:
-            await callback_query.message.answer("✅ Ви успішно відписалися від Email\\-розсилки\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await callback_query.message.answer("❌ Не вдалося відписатися від Email\\-розсилки\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    ok, cleared = await bot_call(clear_user_email(user_id), "відписка від email-розсилки")
+    if ok and cleared:
+        await callback_query.message.answer("✅ Ви успішно відписалися від Email-розсилки.")
+    else:
+        await callback_query.message.answer("❌ Не вдалося відписатися від Email-розсилки.")
 
 async def toggle_auto_notifications_handler(msg: types.Message):
     """Перемикає автоматичні сповіщення про нові новини."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        profile_resp = await session.get(f"{WEBAPP_URL}/users/{user_id}/profile")
-        if profile_resp.status == 200:
-            profile = await profile_resp.json()
-            current_auto_notifications = profile.get('auto_notifications', False)
-            new_auto_notifications = not current_auto_notifications
-
-            resp = await session.post(f"{WEBAPP_URL}/users/register", json={"user_id": user_id, "auto_notifications": new_auto_notifications})
-            if resp.status == 200:
-                status_text = "увімкнено" if new_auto_notifications else "вимкнено"
-                await msg.answer(f"✅ Автоматичні сповіщення про нові новини {status_text}\\.", parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("❌ Не вдалося змінити налаштування авто\\-сповіщень\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося завантажити профіль користувача\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    new_auto_notifications = await toggle_user_flag(user_id, "auto_notifications")
+    if new_auto_notifications is not None:
+        status_text = "увімкнено" if new_auto_notifications else "вимкнено"
+        await msg.answer(f"✅ Автоматичні сповіщення про нові новини {status_text}\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося завантажити профіль користувача.")
 
+@clear_state_after
 async def set_view_mode_handler(msg: types.Message, state: FSMContext):
     """Дозволяє користувачеві обрати режим перегляду новин."""
-    user_id = msg.from_user.id
-
-    async with aiohttp.ClientSession() as session:
-        profile_resp = await session.get(f"{WEBAPP_URL}/users/{user_id}/profile")
-        if profile_resp.status == 200:
-            profile = await profile_resp.json()
-            current_view_mode = profile.get('view_mode', 'manual')
-
-            keyboard = types.InlineKeyboardMarkup(row_width=1)
-            keyboard.add(
-                types.InlineKeyboardButton(text="Ручний перегляд (MyFeed)", callback_data="set_view_mode_manual"),
-                types.InlineKeyboardButton(text="Автоматичний дайджест", callback_data="set_view_mode_auto")
-            )
-            await msg.answer(f"Ваш поточний режим перегляду: *{escape_markdown_v2(current_view_mode)}*\\.\nОберіть новий режим:", reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося завантажити профіль користувача\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    # Поточний режим не запитуємо: меню однакове, а новий режим користувач все одно обере
+    await msg.answer("Оберіть режим перегляду новин:", reply_markup=view_mode_keyboard)
 
+@clear_state_after
 async def process_view_mode_selection_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Обробляє вибір режиму перегляду новин."""
     await callback_query.bot.answer_callback_query(callback_query.id)
     new_view_mode = callback_query.data.replace('set_view_mode_', '')
     user_id = callback_query.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/users/register", json={"user_id": user_id, "view_mode": new_view_mode})
-        if resp.status == 200:
-            await callback_query.message.answer(f"✅ Режим перегляду успішно змінено на *{escape_markdown_v2(new_view_mode)}*\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await callback_query.message.answer("❌ Не вдалося змінити режим перегляду\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await callback_query.message.edit_reply_markup(reply_markup=None)
-    await state.set_state(None)
+    ok, _ = await bot_call(register_user(UserRegisterRequest(user_id=user_id, view_mode=new_view_mode)), "зміна режиму перегляду")
+    if ok:
+        await callback_query.message.edit_text(f"✅ Режим перегляду успішно змінено на *{escape_markdown_v2(new_view_mode)}*\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await callback_query.message.edit_text("❌ Не вдалося змінити режим перегляду.")
 
+@clear_state_after
 async def daily_digest_menu_handler(msg: types.Message, state: FSMContext):
     """Відкриває меню управління щоденною розсилкою."""
-    keyboard = types.InlineKeyboardMarkup(row_width=1)
-    keyboard.add(
-        types.InlineKeyboardButton(text="Підписатись на щоденну", callback_data="subscribe_daily_daily"),
-        types.InlineKeyboardButton(text="Підписатись на погодинну", callback_data="subscribe_daily_hourly"),
-        types.InlineKeyboardButton(text="Відписатись", callback_data="unsubscribe_daily")
-    )
-    await msg.answer("Оберіть частоту розсилки новин:", reply_markup=keyboard)
-    await state.set_state(None)
+    await msg.answer("Оберіть частоту розсилки новин:", reply_markup=daily_digest_keyboard)
 
+@clear_state_after
 async def process_subscribe_daily_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Обробляє підписку на дайджест з різною частотою."""
     await callback_query.bot.answer_callback_query(callback_query.id)
     frequency = callback_query.data.replace('subscribe_daily_', '')
     user_id = callback_query.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/subscriptions/update", json={"user_id": user_id, "frequency": frequency})
-        if resp.status == 200:
-            await callback_query.message.answer(f"✅ Ви успішно підписалися на `{escape_markdown_v2(frequency)}` дайджест\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await callback_query.message.answer("❌ Не вдалося оформити підписку\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await callback_query.message.edit_reply_markup(reply_markup=None)
-    await state.set_state(None)
+    ok, updated = await bot_call(update_subscription(user_id, frequency), "оформлення підписки")
+    if ok and updated:
+        await callback_query.message.edit_text(f"✅ Ви успішно підписалися на `{escape_markdown_v2(frequency)}` дайджест\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await callback_query.message.edit_text("❌ Не вдалося оформити підписку.")
 
+@clear_state_after
 async def process_unsubscribe_daily_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Обробляє відписку від щоденної розсилки."""
     await callback_query.bot.answer_callback_query(callback_query.id)
     user_id = callback_query.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/subscriptions/unsubscribe", params={"user_id": user_id})
-        if resp.status == 200:
-            await callback_query.message.answer("✅ Ви успішно відписалися від розсилок\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await callback_query.message.answer("❌ Не вдалося відписатися\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await callback_query.message.edit_reply_markup(reply_markup=None)
-    await state.set_state(None)
+    ok, unsubscribed = await bot_call(unsubscribe_from_digest(user_id), "відписка від розсилок")
+    if ok and unsubscribed:
+        await callback_query.message.edit_text("✅ Ви успішно відписалися від розсилок.")
+    else:
+        await callback_query.message.edit_text("❌ Не вдалося відписатися.")
 
+@clear_state_after
 async def show_analytics_handler(msg: types.Message, state: FSMContext):
     """Показує статистику використання бота для користувача."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/analytics/{user_id}")
-        if resp.status == 200:
-            analytics_data = await resp.json()
-            if analytics_data:
-                # Екранування всіх значень для MarkdownV2
-                viewed = escape_markdown_v2(str(analytics_data.get('viewed', 0)))
-                saved = escape_markdown_v2(str(analytics_data.get('saved', 0)))
-                read_full_count = escape_markdown_v2(str(analytics_data.get('read_full_count', 0)))
-                skipped_count = escape_markdown_v2(str(analytics_data.get('skipped_count', 0)))
-                liked_count = escape_markdown_v2(str(analytics_data.get('liked_count', 0)))
-                comments_count = escape_markdown_v2(str(analytics_data.get('comments_count', 0)))
-                sources_added_count = escape_markdown_v2(str(analytics_data.get('sources_added_count', 0)))
-                level = escape_markdown_v2(str(analytics_data.get('level', 1)))
-                badges = escape_markdown_v2(', '.join(analytics_data.get('badges', [])) if analytics_data.get('badges') else 'Немає')
-                last_active_dt = datetime.fromisoformat(analytics_data['last_active']) if analytics_data.get('last_active') else None
-                last_active = escape_markdown_v2(last_active_dt.strftime('%d.%m.%Y %H:%M') if last_active_dt else 'Невідомо')
-
-                stats_text = (
-                    "*📊 Ваша статистика:*\n"
-                    f"\\- Переглянуто новин: `{viewed}`\n"
-                    f"\\- Збережено новин: `{saved}`\n"
-                    f"\\- Прочитано повністю: `{read_full_count}`\n"
-                    f"\\- Пропущено новин: `{skipped_count}`\n"
-                    f"\\- Вподобано новин: `{liked_count}`\n"
-                    f"\\- Залишено коментарів: `{comments_count}`\n"
-                    f"\\- Додано джерел: `{sources_added_count}`\n"
-                    f"\\- Поточний рівень: `{level}`\n"
-                    f"\\- Ваші бейджі: `{badges}`\n"
-                    f"\\- Остання активність: `{last_active}`"
-                )
-                await msg.answer(stats_text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("Поки що немає даних для аналітики.")
-        else:
+    stats_text = _analytics_text_cache.get(user_id)
+    if stats_text is None:
+        ok, payload = await bot_call(analytics_json(user_id), "завантаження аналітики")
+        if not ok:
             await msg.answer("❌ Не вдалося завантажити аналітику.")
-    await state.set_state(None)
+            return
+        analytics_data = orjson.loads(payload)
+        if not analytics_data:
+            await msg.answer("Поки що немає даних для аналітики.")
+            return
+
+        # Лічильники — невід'ємні цілі, спецсимволів MarkdownV2 в них немає, тож екранування не потрібне
+        badges = escape_markdown_v2(', '.join(analytics_data['badges']) if analytics_data.get('badges') else 'Немає')
+        last_active_dt = datetime.fromisoformat(analytics_data['last_active']) if analytics_data.get('last_active') else None
+        last_active = escape_markdown_v2(last_active_dt.strftime('%d.%m.%Y %H:%M') if last_active_dt else 'Невідомо')
+
+        stats_text = (
+            "*📊 Ваша статистика:*\n"
+            f"\\- Переглянуто новин: `{int(analytics_data.get('viewed') or 0)}`\n"
+            f"\\- Збережено новин: `{int(analytics_data.get('saved') or 0)}`\n"
+            f"\\- Прочитано повністю: `{int(analytics_data.get('read_full_count') or 0)}`\n"
+            f"\\- Пропущено новин: `{int(analytics_data.get('skipped_count') or 0)}`\n"
+            f"\\- Вподобано новин: `{int(analytics_data.get('liked_count') or 0)}`\n"
+            f"\\- Залишено коментарів: `{int(analytics_data.get('comments_count') or 0)}`\n"
+            f"\\- Додано джерел: `{int(analytics_data.get('sources_added_count') or 0)}`\n"
+            f"\\- Поточний рівень: `{int(analytics_data.get('level') or 1)}`\n"
+            f"\\- Ваші бейджі: `{badges}`\n"
+            f"\\- Остання активність: `{last_active}`"
+        )
+        _analytics_text_cache[user_id] = stats_text
 
+    await msg.answer(stats_text, parse_mode=ParseMode.MARKDOWN_V2)
+
+@clear_state_after
 async def start_report_process_handler(msg: types.Message, state: FSMContext):
     """Починає процес подачі скарги."""
-    keyboard = types.InlineKeyboardMarkup(row_width=1)
-    keyboard.add(
-        types.InlineKeyboardButton(text="На новину", callback_data="report_news"),
-        types.InlineKeyboardButton(text="Загальна проблема", callback_data="report_general")
-    )
-    await msg.answer("На що ви бажаєте подати скаргу?", reply_markup=keyboard)
-    await state.set_state(None)
+    await msg.answer("На що ви бажаєте подати скаргу?", reply_markup=report_type_keyboard)
 
 async def process_report_type_handler(callback_query: types.CallbackQuery, state: FSMContext):
     """Обробляє тип скарги та запитує додаткову інформацію."""
@@ -1666,22 +2286,23 @@ async def process_report_type_handler(callback_query: types.CallbackQuery, state
 
     if report_type == "news":
         await callback_query.message.answer("Будь ласка, вкажіть *ID новини*, на яку ви скаржитесь\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        await ReportNewsStates.waiting_for_news_id_for_report.set()
+        await state.set_state(ReportNewsStates.waiting_for_news_id_for_report)
     else: # report_general
-        await callback_query.message.answer("Будь ласка, опишіть вашу проблему або причину скарги\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        await ReportNewsStates.waiting_for_report_reason.set()
+        await callback_query.message.answer("Будь ласка, опишіть вашу проблему або причину скарги.")
+        await state.set_state(ReportNewsStates.waiting_for_report_reason)
 
 
 async def process_news_id_for_report_handler(msg: types.Message, state: FSMContext):
     """Зберігає ID новини для скарги та просить ввести причину."""
     news_id_str = msg.text.strip()
     if not news_id_str.isdigit():
-        await msg.answer("Будь ласка, введіть коректний числовий ID новини\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await msg.answer("Будь ласка, введіть коректний числовий ID новини.")
         return
     await state.update_data(news_id=int(news_id_str))
-    await msg.answer("Дякуємо\\. Тепер, будь ласка, опишіть причину вашої скарги на цю новину\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await ReportNewsStates.waiting_for_report_reason.set()
+    await msg.answer("Дякуємо. Тепер, будь ласка, опишіть причину вашої скарги на цю новину.")
+    await state.set_state(ReportNewsStates.waiting_for_report_reason)
 
+@clear_state_after
 async def process_report_reason_handler(msg: types.Message, state: FSMContext):
     """Зберігає причину скарги та відправляє її на бекенд."""
     user_data = await state.get_data()
@@ -1690,91 +2311,74 @@ async def process_report_reason_handler(msg: types.Message, state: FSMContext):
     reason = msg.text.strip()
     user_id = msg.from_user.id
     
-    async with aiohttp.ClientSession() as session:
-        payload = {
-            "user_id": user_id,
-            "reason": reason
-        }
-        if news_id: # Додаємо news_id тільки якщо він є
-            payload["news_id"] = news_id
-
-        resp = await session.post(f"{WEBAPP_URL}/report", json=payload)
-        if resp.status == 200:
-            await msg.answer("✅ Вашу скаргу отримано\\. Дякуємо за допомогу\\!", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося відправити скаргу\\. Спробуйте пізніше\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    # news_id є лише у скарги на новину
+    ok, saved = await bot_call(save_report(user_id, news_id or None, reason), "відправлення скарги")
+    if ok and saved:
+        await msg.answer("✅ Вашу скаргу отримано. Дякуємо за допомогу!")
+    else:
+        await msg.answer("❌ Не вдалося відправити скаргу. Спробуйте пізніше.")
 
 async def start_feedback_process_handler(msg: types.Message, state: FSMContext):
     """Починає процес залишення відгуку."""
-    await msg.answer("✍️ Напишіть ваш відгук, і ми обов'язково врахуємо його\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await FeedbackStates.waiting_for_feedback_message.set()
+    await msg.answer("✍️ Напишіть ваш відгук, і ми обов'язково врахуємо його.")
+    await state.set_state(FeedbackStates.waiting_for_feedback_message)
 
+@clear_state_after
 async def process_feedback_message_handler(msg: types.Message, state: FSMContext):
     """Обробляє повідомлення відгуку та відправляє його на бекенд."""
     feedback_message = msg.text.strip()
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/feedback", json={
-            "user_id": user_id,
-            "message": feedback_message
-        })
-        if resp.status == 200:
-            await msg.answer("✅ Дякуємо за ваш відгук\\!", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося відправити відгук\\. Спробуйте пізніше\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    ok, saved = await bot_call(save_feedback(user_id, feedback_message), "відправлення відгуку")
+    if ok and saved:
+        await msg.answer("✅ Дякуємо за ваш відгук!")
+    else:
+        await msg.answer("❌ Не вдалося відправити відгук. Спробуйте пізніше.")
 
+@clear_state_after
 async def language_translate_handler(msg: types.Message, state: FSMContext):
     """Меню для вибору мови інтерфейсу та налаштування перекладу новин."""
-    keyboard = types.InlineKeyboardMarkup(row_width=1)
-    keyboard.add(
-        types.InlineKeyboardButton(text="Змінити мову інтерфейсу", callback_data="change_interface_lang"),
-        types.InlineKeyboardButton(text="Увімкнути/вимкнути переклад новин", callback_data="toggle_news_translation")
-    )
-    await msg.answer("🌍 Оберіть опцію мови:", reply_markup=keyboard)
-    await state.set_state(None)
+    await msg.answer("🌍 Оберіть опцію мови:", reply_markup=language_menu_keyboard)
 
 async def request_interface_lang_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Запитує нову мову інтерфейсу у користувача."""
     await callback_query.bot.answer_callback_query(callback_query.id)
     await callback_query.message.answer("Будь ласка, введіть код нової мови інтерфейсу (наприклад, `en` для англійської, `uk` для української)\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await ProfileSettingsStates.waiting_for_language_change.set()
+    await state.set_state(ProfileSettingsStates.waiting_for_language_change)
 
+@clear_state_after
 async def process_interface_lang_change_handler(msg: types.Message, state: FSMContext):
     """Обробляє зміну мови інтерфейсу."""
     new_lang = msg.text.strip().lower()
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/users/register", json={"user_id": user_id, "language": new_lang})
-        if resp.status == 200:
-            await msg.answer(f"✅ Мову інтерфейсу успішно змінено на `{escape_markdown_v2(new_lang)}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося змінити мову інтерфейсу\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    ok, _ = await bot_call(register_user(UserRegisterRequest(user_id=user_id, language=new_lang)), "зміна мови інтерфейсу")
+    if ok:
+        await msg.answer(f"✅ Мову інтерфейсу успішно змінено на `{escape_markdown_v2(new_lang)}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося змінити мову інтерфейсу.")
 
+@clear_state_after
 async def toggle_news_translation_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Перемикає функцію автоматичного перекладу новин."""
     await callback_query.bot.answer_callback_query(callback_query.id)
-    await callback_query.message.answer("Функція автоматичного перекладу новин перемкнена (моковано)\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    await callback_query.message.answer("Функція автоматичного перекладу новин перемкнена (моковано).")
 
 
+@clear_state_after
 async def ai_features_handler(msg: types.Message, state: FSMContext):
     """Відкриває меню функцій AI-аналізу."""
     await msg.answer("🤖 Доступні функції AI-аналізу:", reply_markup=ai_analysis_keyboard)
-    await state.set_state(None)
 
+@clear_state_after
 async def summary_start_handler(msg: types.Message, state: FSMContext):
     """Запитує ID новини для генерації AI-резюме."""
     await msg.answer("🧠 Вкажіть ID новини для резюме: `/summary ID_НОВИНИ`", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None) # Clear state in case it was stuck
 
-async def summary_command_handler(msg: types.Message, state: FSMContext):
+@clear_state_after
+async def summary_command_handler(msg: types.Message, state: FSMContext, command: CommandObject):
     """Генерує AI-резюме для вказаної новини."""
-    args = msg.get_args()
+    args = command.args # текст після команди; None, якщо аргументів немає
     news_id = None
     text_to_summarize = None
 
@@ -1785,94 +2389,70 @@ async def summary_command_handler(msg: types.Message, state: FSMContext):
             text_to_summarize = args
     else:
         await msg.answer("🧠 Будь ласка, вкажіть ID новини (наприклад, `/summary 123`) або надайте текст для резюме (наприклад, `/summary Ваш текст тут`)", parse_mode=ParseMode.MARKDOWN_V2)
-        await state.set_state(None)
         return
 
-    async with aiohttp.ClientSession() as session:
-        payload = {"news_id": news_id}
-        if text_to_summarize:
-            payload["text"] = text_to_summarize
-
-        resp = await session.post(f"{WEBAPP_URL}/summary", json=payload)
-        if resp.status == 200:
-            result = await resp.json()
-            summary_text = escape_markdown_v2(result['summary'])
-            await msg.answer(f"🧠 *Резюме:*\n`{summary_text}`", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося згенерувати резюме. Спробуйте ще раз.")
-    await state.set_state(None)
+    ok, payload = await bot_call(summary_json(SummaryRequest(news_id=news_id, text=text_to_summarize)), "генерація резюме")
+    if ok:
+        summary_text = escape_markdown_v2(orjson.loads(payload)['summary'])
+        await msg.answer(f"🧠 *Резюме:*\n`{summary_text}`", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося згенерувати резюме. Спробуйте ще раз.")
 
+@clear_state_after
 async def recommend_handler(msg: types.Message, state: FSMContext):
     """Показує AI-рекомендації новин."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/recommend/{user_id}")
-        if resp.status == 200:
-            result = await resp.json()
-            recommended = result.get('recommended', [])
-            if recommended:
-                recommendations_text = "*📌 Вам можуть сподобатись ці новини:*\n\n"
-                for item in recommended:
-                    title_escaped = escape_markdown_v2(item['title'])
-                    recommendations_text += f"\\- `{escape_markdown_v2(str(item['id']))}`: {title_escaped}\n"
-                await msg.answer(recommendations_text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("Наразі немає рекомендацій. Продовжуйте читати, щоб AI зміг краще вас зрозуміти!")
+    ok, payload = await bot_call(recommendations_json(user_id), "завантаження рекомендацій")
+    if ok:
+        recommended = orjson.loads(payload).get('recommended', [])
+        if recommended:
+            recommendations_text = format_news_list("*📌 Вам можуть сподобатись ці новини:*\n\n", recommended)
+            await msg.answer(recommendations_text, parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            await msg.answer("❌ Не вдалося отримати рекомендації.")
-    await state.set_state(None)
+            await msg.answer("Наразі немає рекомендацій. Продовжуйте читати, щоб AI зміг краще вас зрозуміти!")
+    else:
+        await msg.answer("❌ Не вдалося отримати рекомендації.")
 
+@clear_state_after
 async def fact_check_start_handler(msg: types.Message, state: FSMContext):
     """Запитує ID новини для фактчекінгу."""
     await msg.answer("🔍 Вкажіть ID новини для фактчекінгу: `/verify ID_НОВИНИ`", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
 
-async def verify_command_handler(msg: types.Message, state: FSMContext):
+@clear_state_after
+async def verify_command_handler(msg: types.Message, state: FSMContext, command: CommandObject):
     """Виконує фактчекінг для вказаної новини."""
-    args = msg.get_args()
+    args = command.args # текст після команди; None, якщо аргументів немає
     if not args or not args.isdigit():
         await msg.answer("🔍 Будь ласка, вкажіть коректний ID новини: `/verify 123`", parse_mode=ParseMode.MARKDOWN_V2)
-        await state.set_state(None)
         return
     news_id = int(args)
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/verify/{news_id}")
-        if resp.status == 200:
-            result = await resp.json()
-            is_fake_status = "❌ Фейк!" if result['is_fake'] else "✅ Достовірна новина"
-            confidence = round(result['confidence'] * 100)
-            source = escape_markdown_v2(result['source'])
-            await msg.answer(f"🔍 *Результат фактчекінгу новини ID `{escape_markdown_v2(str(news_id))}`:*\n\n"
-                             f"Статус: `{is_fake_status}`\n"
-                             f"Впевненість AI: `{escape_markdown_v2(str(confidence))}`%\\.\n"
-                             f"Джерело: `{source}`",
-                             parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося провести фактчекінг для цієї новини.")
-    await state.set_state(None)
+    # Мок фактчекінгу обчислюється на місці, без БД
+    result = verify_news(news_id)
+    is_fake_status = "❌ Фейк!" if result['is_fake'] else "✅ Достовірна новина"
+    confidence = round(result['confidence'] * 100)
+    source = escape_markdown_v2(result['source'])
+    await msg.answer(f"🔍 *Результат фактчекінгу новини ID `{escape_markdown_v2(str(news_id))}`:*\n\n"
+                     f"Статус: `{is_fake_status}`\n"
+                     f"Впевненість AI: `{escape_markdown_v2(str(confidence))}`%\\.\n"
+                     f"Джерело: `{source}`",
+                     parse_mode=ParseMode.MARKDOWN_V2)
 
 async def rewrite_headline_start_handler(msg: types.Message, state: FSMContext):
     """Запитує заголовок для переписування."""
     await msg.answer("✍️ Будь ласка, надішліть заголовок, який ви хочете переписати:")
     await state.set_state(AddNewsStates.waiting_for_title) # Using AddNewsStates.waiting_for_title for general text input
 
+@clear_state_after
 async def process_headline_rewrite_handler(msg: types.Message, state: FSMContext):
     """Переписує заголовок за допомогою AI."""
     original_headline = msg.text.strip()
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/ai/rewrite_headline", json={"text": original_headline})
-        if resp.status == 200:
-            result = await resp.json()
-            rewritten = escape_markdown_v2(result['rewritten_headline'])
-            await msg.answer(f"✅ *Оригінальний заголовок:*\n`{escape_markdown_v2(original_headline)}`\n\n"
-                             f"*✍️ Переписаний AI:*\n`{rewritten}`",
-                             parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося переписати заголовок.")
-    await state.set_state(None)
+    rewritten = escape_markdown_v2(rewrite_headline(original_headline))
+    await msg.answer(f"✅ *Оригінальний заголовок:*\n`{escape_markdown_v2(original_headline)}`\n\n"
+                     f"*✍️ Переписаний AI:*\n`{rewritten}`",
+                     parse_mode=ParseMode.MARKDOWN_V2)
 
 # == Додаткові функції (не в меню AI-аналізу) ==
 
@@ -1881,45 +2461,46 @@ async def add_news_admin_start_handler(msg: types.Message, state: FSMContext):
     Починає процес додавання нової новини вручну (для адмінів).
     """
     await msg.answer("Введіть *заголовок* новини:", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_title.set()
+    await state.set_state(AddNewsStates.waiting_for_title)
 
 async def process_news_title_handler(msg: types.Message, state: FSMContext):
     await state.update_data(title=msg.text)
     await msg.answer("Введіть *повний зміст* новини:", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_content.set()
+    await state.set_state(AddNewsStates.waiting_for_content)
 
 async def process_news_content_handler(msg: types.Message, state: FSMContext):
     await state.update_data(content=msg.text)
     await msg.answer("Введіть *мову* новини (наприклад, `uk`, `en`):", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_lang.set()
+    await state.set_state(AddNewsStates.waiting_for_lang)
 
 async def process_news_lang_handler(msg: types.Message, state: FSMContext):
     await state.update_data(lang=msg.text.lower())
     await msg.answer("Введіть *країну* новини (наприклад, `UA`, `US`):", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_country.set()
+    await state.set_state(AddNewsStates.waiting_for_country)
 
 async def process_news_country_handler(msg: types.Message, state: FSMContext):
     await state.update_data(country=msg.text.upper())
     await msg.answer("Введіть *теги* для новини через кому (наприклад, `політика, економіка`):", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_tags.set()
+    await state.set_state(AddNewsStates.waiting_for_tags)
 
 async def process_news_tags_handler(msg: types.Message, state: FSMContext):
     tags = [tag.strip() for tag in msg.text.split(',') if tag.strip()]
     await state.update_data(tags=tags)
     await msg.answer("Введіть *назву джерела* новини:", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_source_name.set()
+    await state.set_state(AddNewsStates.waiting_for_source_name)
 
 async def process_news_source_name_handler(msg: types.Message, state: FSMContext):
     await state.update_data(source=msg.text)
     await msg.answer("Введіть *посилання* на оригінальну новину (URL, якщо є, інакше `-`):", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_link.set()
+    await state.set_state(AddNewsStates.waiting_for_link)
 
 async def process_news_link_handler(msg: types.Message, state: FSMContext):
     link = msg.text.strip()
     await state.update_data(link=link if link != '-' else None)
     await msg.answer("Надішліть *фото/відео* або інший медіа\\-файл для новини, або введіть `-` якщо немає:", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddNewsStates.waiting_for_media.set()
+    await state.set_state(AddNewsStates.waiting_for_media)
 
+@clear_state_after
 async def process_news_media_handler(msg: types.Message, state: FSMContext):
     file_id = None
     media_type = None
@@ -1938,37 +2519,35 @@ async def process_news_media_handler(msg: types.Message, state: FSMContext):
     await state.update_data(file_id=file_id, media_type=media_type)
     
     news_data = await state.get_data()
-    
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/news/add", json=news_data)
-        if resp.status == 200:
-            await msg.answer("✅ Новина успішно додана та відправлена на обробку AI\\!", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося додати новину\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+
+    # Новина записується напряму, без HTTP-запиту до власного API; модель перевіряє дані так само, як ендпоінт
+    try:
+        await add_news(NewsAddRequest(**news_data))
+        added = True
+    except (ValidationError, asyncpg.PostgresError) as e:
+        logging.error(f"Помилка додавання новини: {e}")
+        added = False
+    if added:
+        await msg.answer("✅ Новина успішно додана та відправлена на обробку AI!")
+    else:
+        await msg.answer("❌ Не вдалося додати новину.")
 
 async def add_source_start_handler(msg: types.Message, state: FSMContext):
     """Починає процес додавання нового джерела."""
     await msg.answer("Введіть *назву* джерела:", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddSourceStates.waiting_for_source_name.set()
+    await state.set_state(AddSourceStates.waiting_for_source_name)
 
 async def process_source_name_handler(msg: types.Message, state: FSMContext):
     await state.update_data(name=msg.text)
     await msg.answer("Введіть *посилання* на джерело (URL або Telegram ID):", parse_mode=ParseMode.MARKDOWN_V2)
-    await AddSourceStates.waiting_for_source_link.set()
+    await state.set_state(AddSourceStates.waiting_for_source_link)
 
 async def process_source_link_handler(msg: types.Message, state: FSMContext):
     await state.update_data(link=msg.text)
-    keyboard = types.InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        types.InlineKeyboardButton(text="Telegram", callback_data="source_type_telegram"),
-        types.InlineKeyboardButton(text="RSS", callback_data="source_type_rss"),
-        types.InlineKeyboardButton(text="Website", callback_data="source_type_website"),
-        types.InlineKeyboardButton(text="Twitter", callback_data="source_type_twitter")
-    )
-    await msg.answer("Оберіть *тип* джерела:", reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-    await AddSourceStates.waiting_for_source_type.set()
+    await msg.answer("Оберіть *тип* джерела:", reply_markup=source_type_keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+    await state.set_state(AddSourceStates.waiting_for_source_type)
 
+@clear_state_after
 async def process_source_type_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.bot.answer_callback_query(callback_query.id)
     source_type = callback_query.data.replace('source_type_', '')
@@ -1976,78 +2555,84 @@ async def process_source_type_callback(callback_query: types.CallbackQuery, stat
 
     source_data = await state.get_data()
     user_id = callback_query.from_user.id
-    source_data['user_id'] = user_id
-    
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/sources/add", json=source_data)
-        if resp.status == 200:
-            await callback_query.message.answer("✅ Джерело успішно додано! Воно буде перевірено адміністрацією\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await callback_query.message.answer("❌ Не вдалося додати джерело\\. Можливо, воно вже існує або виникла помилка\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
-    await callback_query.message.edit_reply_markup(reply_markup=None)
 
+    ok, added = await bot_call(add_source(SourceAddRequest(
+        user_id=user_id, name=source_data['name'], link=source_data['link'], type=source_type
+    )), "додавання джерела")
+    if ok and added:
+        await callback_query.message.edit_text("✅ Джерело успішно додано! Воно буде перевірено адміністрацією.")
+    else:
+        await callback_query.message.edit_text("❌ Не вдалося додати джерело. Можливо, воно вже існує або виникла помилка.")
+
+@clear_state_after
 async def rate_news_start_handler(msg: types.Message, state: FSMContext):
     """Просить користувача ввести ID новини для оцінки."""
     await msg.answer("Будь ласка, вкажіть ID новини, яку ви хочете оцінити: `/rate ID_НОВИНИ ОЦІНКА` (від 1 до 5)", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
 
+async def run_with_typing(msg: types.Message, coro: Awaitable):
+    """
+    Виконує coro, паралельно надсилаючи в чат індикатор "друкує…": користувач бачить реакцію бота
+    одразу, а запит до Telegram не додається до часу запису. Помилка індикатора ігнорується.
+    """
+    result, _ = await asyncio.gather(
+        coro,
+        msg.bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.TYPING),
+        return_exceptions=True
+    )
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+# Допустимі оцінки новини у вигляді тексту команди /rate
+VALID_RATINGS = frozenset("12345")
+
+@clear_state_after
 async def rate_news_command_handler(msg: types.Message, state: FSMContext):
     """Обробляє команду оцінки новини."""
-    args = msg.get_args().split()
-    if len(args) != 2 or not args[0].isdigit() or not args[1].isdigit():
+    # "/rate ID ОЦІНКА": команда та два аргументи одним split з обмеженням
+    parts = msg.text.split(maxsplit=2)
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
         await msg.answer("Будь ласка, вкажіть ID новини та оцінку (від 1 до 5): `/rate ID_НОВИНИ ОЦІНКА`", parse_mode=ParseMode.MARKDOWN_V2)
-        await state.set_state(None)
+        return
+    # Перевірка діапазону — пошук у множині рядків, без int() для неприпустимої оцінки
+    if parts[2] not in VALID_RATINGS:
+        await msg.answer("Оцінка повинна бути числом від 1 до 5.")
         return
 
-    news_id = int(args[0])
-    rating_value = int(args[1])
+    news_id = int(parts[1])
+    rating_value = int(parts[2])
     user_id = msg.from_user.id
 
-    if not (1 <= rating_value <= 5):
-        await msg.answer("Оцінка повинна бути числом від 1 до 5\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        await state.set_state(None)
-        return
-
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/rate", json={
-            "user_id": user_id,
-            "news_id": news_id,
-            "value": rating_value
-        })
-        if resp.status == 200:
-            await msg.answer(f"✅ Новина ID `{escape_markdown_v2(str(news_id))}` оцінена на `{escape_markdown_v2(str(rating_value))}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося оцінити новину\\. Можливо, ви вже оцінювали її або сталася помилка\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    # Підтвердження надсилається лише після запису; поки він триває, чат показує "друкує…"
+    try:
+        rated = await run_with_typing(msg, save_rating(user_id, news_id, rating_value))
+    except Exception as e: # напр., новини з таким ID немає або пул зайнятий (TimeoutError)
+        logging.error(f"Помилка збереження оцінки новини {news_id}: {e}")
+        rated = False
+    if rated:
+        await msg.answer(f"✅ Новина ID `{escape_markdown_v2(str(news_id))}` оцінена на `{escape_markdown_v2(str(rating_value))}`\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося оцінити новину. Можливо, ви вже оцінювали її або сталася помилка.")
 
+@clear_state_after
 async def show_bookmarks_handler(msg: types.Message, state: FSMContext):
     """Показує список новин, збережених у закладках користувача."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/bookmarks/{user_id}")
-        if resp.status == 200:
-            bookmarks = await resp.json()
-            if bookmarks:
-                bookmarks_text = "*🔖 Ваші збережені новини:*\n\n"
-                for item in bookmarks:
-                    title_escaped = escape_markdown_v2(item['title'])
-                    bookmarks_text += f"\\- `{escape_markdown_v2(str(item['id']))}`: {title_escaped}\n"
-                await msg.answer(bookmarks_text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("У вас немає збережених новин у закладках\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    bookmarks = await fetch_bookmarks(user_id)
+    if bookmarks is not None:
+        if bookmarks:
+            bookmarks_text = format_news_list("*🔖 Ваші збережені новини:*\n\n", bookmarks)
+            await msg.answer(bookmarks_text, parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            await msg.answer("❌ Не вдалося завантажити закладки\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+            await msg.answer("У вас немає збережених новин у закладках.")
+    else:
+        await msg.answer("❌ Не вдалося завантажити закладки.")
 
+@clear_state_after
 async def comments_menu_handler(msg: types.Message, state: FSMContext):
     """Меню для управління коментарями."""
-    await msg.answer("Оберіть дію з коментарями:", reply_markup=types.InlineKeyboardMarkup(row_width=1).add(
-        types.InlineKeyboardButton(text="Додати коментар", callback_data="add_comment"),
-        types.InlineKeyboardButton(text="Переглянути коментарі до новини", callback_data="view_comments")
-    ))
-    await state.set_state(None)
+    await msg.answer("Оберіть дію з коментарями:", reply_markup=comments_menu_keyboard)
 
 async def start_add_comment_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.bot.answer_callback_query(callback_query.id)
@@ -2056,29 +2641,28 @@ async def start_add_comment_callback(callback_query: types.CallbackQuery, state:
 
 async def process_comment_news_id_handler(msg: types.Message, state: FSMContext):
     if not msg.text.isdigit():
-        await msg.answer("Будь ласка, введіть коректний числовий ID новини\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await msg.answer("Будь ласка, введіть коректний числовий ID новини.")
         return
     await state.update_data(news_id=int(msg.text))
     await msg.answer("Напишіть ваш *коментар*:", parse_mode=ParseMode.MARKDOWN_V2)
     await state.set_state(CommentStates.waiting_for_content) # Set state here
 
+@clear_state_after
 async def process_comment_content_handler(msg: types.Message, state: FSMContext):
     comment_content = msg.text
     user_data = await state.get_data()
     news_id = user_data['news_id']
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/comments/add", json={
-            "user_id": user_id,
-            "news_id": news_id,
-            "content": comment_content
-        })
-        if resp.status == 200:
-            await msg.answer("✅ Ваш коментар успішно додано і очікує модерації\\.", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося додати коментар\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    try:
+        commented = await run_with_typing(msg, add_comment(user_id, news_id, comment_content))
+    except Exception as e:
+        logging.error(f"Помилка додавання коментаря до новини {news_id}: {e}")
+        commented = False
+    if commented:
+        await msg.answer("✅ Ваш коментар успішно додано і очікує модерації.")
+    else:
+        await msg.answer("❌ Не вдалося додати коментар.")
 
 async def start_view_comments_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.bot.answer_callback_query(callback_query.id)
@@ -2087,75 +2671,72 @@ async def start_view_comments_callback(callback_query: types.CallbackQuery, stat
 
 async def process_view_comments_news_id_handler(msg: types.Message, state: FSMContext):
     if not msg.text.isdigit():
-        await msg.answer("Будь ласка, введіть коректний числовий ID новини\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await msg.answer("Будь ласка, введіть коректний числовий ID новини.")
         return
     news_id = int(msg.text)
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/comments/{news_id}")
-        if resp.status == 200:
-            comments = await resp.json()
-            if comments:
-                comments_text = f"*💬 Коментарі до новини ID `{escape_markdown_v2(str(news_id))}`:*\n\n"
-                for comment in comments:
-                    comment_content = escape_markdown_v2(comment['content'])
-                    user_telegram_id = escape_markdown_v2(str(comment['user_telegram_id']) if comment['user_telegram_id'] else 'Невідомий')
-                    comments_text += f"\\_\\*{user_telegram_id}*\\_ \n`{comment_content}`\n\n" # Виправлено екранування для імені користувача
-                await msg.answer(comments_text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("До цієї новини ще немає коментарів або вони очікують модерації\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    ok, payload = await bot_call(comments_json(news_id), "завантаження коментарів")
+    if ok:
+        comments = orjson.loads(payload)
+        if comments:
+            parts = [f"*💬 Коментарі до новини ID `{escape_markdown_v2(str(news_id))}`:*\n\n"]
+            for comment in comments:
+                comment_content = escape_markdown_v2(comment['content'])
+                user_telegram_id = escape_markdown_v2(str(comment['user_telegram_id']) if comment['user_telegram_id'] else 'Невідомий')
+                parts.append(f"\\_\\*{user_telegram_id}*\\_ \n`{comment_content}`\n\n") # Виправлено екранування для імені користувача
+            comments_text = "".join(parts)
+            await msg.answer(comments_text, parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            await msg.answer("❌ Не вдалося завантажити коментарі\\.", parse_mode=ParseMode.MARKDOWN_V2)
+            await msg.answer("До цієї новини ще немає коментарів або вони очікують модерації.")
+    else:
+        await msg.answer("❌ Не вдалося завантажити коментарі.")
     await state.set_state(None)
 
+@clear_state_after
 async def show_trending_news_handler(msg: types.Message, state: FSMContext):
     """Показує трендові новини."""
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(f"{WEBAPP_URL}/trending?limit=5")
-        if resp.status == 200:
-            trending_news = await resp.json()
-            if trending_news:
-                trend_text = "*🔥 Трендові новини:*\n\n"
-                for item in trending_news:
-                    title_escaped = escape_markdown_v2(item['title'])
-                    trend_text += f"\\- `{escape_markdown_v2(str(item['id']))}`: {title_escaped}\n"
-                await msg.answer(trend_text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await msg.answer("Наразі немає трендових новин\\.", parse_mode=ParseMode.MARKDOWN_V2)
+    trending_news = _trending_cache.get(5)
+    if trending_news is None:
+        ok, payload = await bot_call(trending_json(5), "завантаження трендів")
+        if ok:
+            trending_news = _trending_cache[5] = orjson.loads(payload)
+    if trending_news is not None:
+        if trending_news:
+            trend_text = format_news_list("*🔥 Трендові новини:*\n\n", trending_news)
+            await msg.answer(trend_text, parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            await msg.answer("❌ Не вдалося завантажити трендові новини\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+            await msg.answer("Наразі немає трендових новин.")
+    else:
+        await msg.answer("❌ Не вдалося завантажити трендові новини.")
 
+@clear_state_after
 async def invite_friend_handler(msg: types.Message, state: FSMContext):
     """Генерує унікальне посилання-запрошення для реферальної системи."""
     user_id = msg.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(f"{WEBAPP_URL}/invite/generate", json={"inviter_user_id": user_id})
-        if resp.status == 200:
-            result = await resp.json()
-            invite_code = escape_markdown_v2(result['invite_code'])
-            await msg.answer(f"Запросіть друга, надіславши йому це посилання: `https://t.me/{BOT_USERNAME}?start={invite_code}`\n\n"
-                             "Коли ваш друг приєднається за цим посиланням, ви отримаєте бонус!", parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await msg.answer("❌ Не вдалося згенерувати запрошення\\.", parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None)
+    invite_code = await generate_invite_code(user_id)
+    if invite_code:
+        invite_code = escape_markdown_v2(invite_code)
+        await msg.answer(f"Запросіть друга, надіславши йому це посилання: `https://t.me/{BOT_USERNAME}?start={invite_code}`\n\n"
+                         "Коли ваш друг приєднається за цим посиланням, ви отримаєте бонус!", parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        await msg.answer("❌ Не вдалося згенерувати запрошення.")
 
+@clear_state_after
 async def back_to_main_menu_handler(msg: types.Message, state: FSMContext):
     """Повернення до головного меню."""
-    await msg.answer("Ви повернулись до головного меню\\.", reply_markup=main_keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None) # Завжди очищаємо стан при поверненні в головне меню
+    await msg.answer("Ви повернулись до головного меню.", reply_markup=main_keyboard)
 
-async def unknown_message_handler(msg: types.Message, state: FSMContext):
+async def unknown_message_handler(msg: types.Message, raw_state: Optional[str]):
     """Обробляє всі невідомі текстові повідомлення."""
+    # raw_state aiogram уже прочитав зі сховища для фільтрів станів — повторний get_state не потрібен
     # Якщо бот знаходиться в стані FSM, не обробляємо як невідому команду
-    current_state = await state.get_state()
-    if current_state:
-        logging.info(f"Received unknown message '{msg.text}' while in state {current_state}. Not clearing state.")
+    if raw_state:
+        logging.info(f"Received unknown message '{msg.text}' while in state {raw_state}. Not clearing state.")
         return # Не очищаємо стан і не відповідаємо, очікуючи коректного вводу для поточного стану
 
+    # Стан уже порожній, тож скидати його не потрібно
     await msg.answer("🤔 Вибачте, я не розумію вашу команду\\. Будь ласка, скористайтесь меню або командою `/start`\\.", reply_markup=main_keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-    await state.set_state(None) # Очищаємо стан на всяк випадок, якщо це було випадкове повідомлення
 
 # Custom state group for comments
 class CommentStates(StatesGroup):
@@ -2163,141 +2744,225 @@ class CommentStates(StatesGroup):
     waiting_for_content = State()
     waiting_for_view_news_id = State()
 
-# == ФУНКЦІЯ РЕЄСТРАЦІЇ ХЕНДЛЕРІВ ==
-def register_telegram_handlers(dp: Dispatcher):
-    """
-    Реєструє всі хендлери та FSM стани у Aiogram Dispatcher.
-    Ця функція буде викликана з webapp.py.
-    """
-    # Команди
-    dp.message.register(start_command_handler, commands=["start"])
-    dp.message.register(summary_command_handler, commands=["summary"])
-    dp.message.register(verify_command_handler, commands=["verify"])
-    dp.message.register(rate_news_command_handler, commands=["rate"])
-    dp.message.register(invite_friend_handler, commands=["invite"])
-
+# == МАРШРУТИ КНОПОК МЕНЮ ==
+# Текст кнопки -> хендлер (msg, state). Один словниковий пошук замість ланцюжка
+# з ~30 фільтрів m.text == "...", які aiogram перебирав для кожного повідомлення
+MENU_ROUTES: Dict[str, Callable[[types.Message, FSMContext], Awaitable[Any]]] = {
     # Обробники кнопок головного меню
-    dp.message.register(show_news_handler, lambda m: m.text == "📰 Новини")
-    dp.message.register(show_filters_menu_handler, lambda m: m.text == "🎯 Фільтри")
-    dp.message.register(show_settings_handler, lambda m: m.text == "⚙️ Налаштування")
-    dp.message.register(daily_digest_menu_handler, lambda m: m.text == "📬 Щоденна розсилка")
-    dp.message.register(show_analytics_handler, lambda m: m.text == "📊 Аналітика")
-    dp.message.register(start_report_process_handler, lambda m: m.text == "❗ Скарга")
-    dp.message.register(start_feedback_process_handler, lambda m: m.text == "💬 Відгук")
-    dp.message.register(language_translate_handler, lambda m: m.text == "🌐 Мова / Переклад")
-    dp.message.register(ai_features_handler, lambda m: m.text == "🧠 AI-аналіз")
-    dp.message.register(back_to_main_menu_handler, lambda m: m.text == "⬅️ Головне меню")
+    "📰 Новини": lambda msg, state: show_news_handler(msg),
+    "🎯 Фільтри": show_filters_menu_handler,
+    "⚙️ Налаштування": show_settings_handler,
+    "📬 Щоденна розсилка": daily_digest_menu_handler,
+    "📊 Аналітика": show_analytics_handler,
+    "❗ Скарга": start_report_process_handler,
+    "💬 Відгук": start_feedback_process_handler,
+    "🌐 Мова / Переклад": language_translate_handler,
+    "🧠 AI-аналіз": ai_features_handler,
+    "⬅️ Головне меню": back_to_main_menu_handler,
 
     # Обробники кнопок меню AI-аналізу
-    dp.message.register(summary_start_handler, lambda m: m.text == "🧠 AI Summary")
-    dp.message.register(recommend_handler, lambda m: m.text == "💡 Рекомендації")
-    dp.message.register(fact_check_start_handler, lambda m: m.text == "🔍 Фактчекінг")
-    dp.message.register(rewrite_headline_start_handler, lambda m: m.text == "✍️ Переписати заголовок")
+    "🧠 AI Summary": summary_start_handler,
+    "💡 Рекомендації": recommend_handler,
+    "🔍 Фактчекінг": fact_check_start_handler,
+    "✍️ Переписати заголовок": rewrite_headline_start_handler,
 
     # Обробники кнопок налаштувань
-    dp.message.register(toggle_safe_mode_handler, lambda m: m.text == "🔒 Безпечний режим")
-    dp.message.register(premium_info_handler, lambda m: m.text == "✨ Преміум")
-    dp.message.register(email_subscription_menu_handler, lambda m: m.text == "📧 Email розсилка")
-    dp.message.register(toggle_auto_notifications_handler, lambda m: m.text == "🔔 Авто-сповіщення")
-    dp.message.register(set_view_mode_handler, lambda m: m.text == "👁️ Режим перегляду")
+    "🔒 Безпечний режим": lambda msg, state: toggle_safe_mode_handler(msg),
+    "✨ Преміум": lambda msg, state: premium_info_handler(msg),
+    "📧 Email розсилка": email_subscription_menu_handler,
+    "🔔 Авто-сповіщення": lambda msg, state: toggle_auto_notifications_handler(msg),
+    "👁️ Режим перегляду": set_view_mode_handler,
 
     # Обробники кнопок фільтрів
-    dp.message.register(add_filter_start_handler, lambda m: m.text == "➕ Додати фільтр")
-    dp.message.register(show_my_filters_handler, lambda m: m.text == "📝 Мої фільтри")
-    dp.message.register(reset_filters_handler, lambda m: m.text == "🗑️ Скинути фільтри")
-    dp.message.register(create_custom_feed_start_handler, lambda m: m.text == "🆕 Створити добірку")
-    dp.message.register(switch_custom_feed_menu_handler, lambda m: m.text == "🔄 Переключити добірку")
-    dp.message.register(edit_custom_feed_menu_handler, lambda m: m.text == "✏️ Редагувати добірку")
+    "➕ Додати фільтр": lambda msg, state: add_filter_start_handler(msg),
+    "📝 Мої фільтри": lambda msg, state: show_my_filters_handler(msg),
+    "🗑️ Скинути фільтри": lambda msg, state: reset_filters_handler(msg),
+    "🆕 Створити добірку": create_custom_feed_start_handler,
+    "🔄 Переключити добірку": switch_custom_feed_menu_handler,
+    "✏️ Редагувати добірку": edit_custom_feed_menu_handler,
 
     # Обробники додаткових функцій
-    dp.message.register(add_news_admin_start_handler, lambda m: m.text == "➕ Додати новину (Адмін)")
-    dp.message.register(add_source_start_handler, lambda m: m.text == "➕ Додати джерело")
-    dp.message.register(rate_news_start_handler, lambda m: m.text == "⭐ Оцінити новину")
-    dp.message.register(show_bookmarks_handler, lambda m: m.text == "🔖 Закладки")
-    dp.message.register(comments_menu_handler, lambda m: m.text == "💬 Коментарі")
-    dp.message.register(show_trending_news_handler, lambda m: m.text == "📊 Тренд")
+    "➕ Додати новину (Адмін)": add_news_admin_start_handler,
+    "➕ Додати джерело": add_source_start_handler,
+    "⭐ Оцінити новину": rate_news_start_handler,
+    "🔖 Закладки": show_bookmarks_handler,
+    "💬 Коментарі": comments_menu_handler,
+    "📊 Тренд": show_trending_news_handler,
+    "✉️ Запросити друга": invite_friend_handler,
+}
+
+async def menu_dispatch_handler(msg: types.Message, state: FSMContext, raw_state: Optional[str]):
+    """Передає натискання кнопки меню відповідному хендлеру з MENU_ROUTES."""
+    await call_route(MENU_ROUTES[msg.text], msg, state, raw_state)
+
+# == МАРШРУТИ CALLBACK-ЗАПИТІВ ==
+# Точні значення callback_data -> хендлер (callback_query, state)
+CALLBACK_EXACT_ROUTES: Dict[str, Callable[[types.CallbackQuery, FSMContext], Awaitable[Any]]] = {
+    "finish_create_feed": finish_create_feed_handler,
+    "buy_premium": lambda callback_query, state: handle_buy_premium_callback(callback_query),
+    "add_email": request_email_input_callback,
+    "change_email": request_email_input_callback,
+    "unsubscribe_email": unsubscribe_email_callback,
+    "unsubscribe_daily": process_unsubscribe_daily_callback,
+    "change_interface_lang": request_interface_lang_callback,
+    "toggle_news_translation": toggle_news_translation_callback,
+    "add_comment": start_add_comment_callback,
+    "view_comments": start_view_comments_callback,
+}
+
+# Префікси callback_data (до останнього "_" включно) -> хендлер; префікси не вкладені один в одний
+CALLBACK_PREFIX_ROUTES: Dict[str, Callable[[types.CallbackQuery, FSMContext], Awaitable[Any]]] = {
+    "like_": lambda callback_query, state: process_news_interaction_handler(callback_query),
+    "dislike_": lambda callback_query, state: process_news_interaction_handler(callback_query),
+    "save_": lambda callback_query, state: process_news_interaction_handler(callback_query),
+    "skip_": lambda callback_query, state: process_news_interaction_handler(callback_query),
+    "filter_type_": process_filter_type_handler,
+    "add_feed_filter_": add_feed_filter_handler,
+    "switch_feed_": process_switch_feed_handler,
+    "set_view_mode_": process_view_mode_selection_callback,
+    "subscribe_daily_": process_subscribe_daily_callback,
+    "report_": process_report_type_handler,
+    "source_type_": process_source_type_callback,
+}
+
+def find_callback_route(data: str) -> Optional[Callable[[types.CallbackQuery, FSMContext], Awaitable[Any]]]:
+    """
+    Хендлер для callback_data: спершу точний збіг, потім префікси, що закінчуються на кожному "_".
+    Кілька словникових пошуків (за кількістю "_") замість перебору всіх startswith.
+    """
+    handler = CALLBACK_EXACT_ROUTES.get(data)
+    if handler is not None:
+        return handler
+    pos = data.find("_")
+    while pos != -1:
+        handler = CALLBACK_PREFIX_ROUTES.get(data[:pos + 1])
+        if handler is not None:
+            return handler
+        pos = data.find("_", pos + 1)
+    return None
+
+def callback_route_filter(callback_query: types.CallbackQuery):
+    """Фільтр aiogram: знайдений хендлер передається в callback_dispatch_handler як route."""
+    route = find_callback_route(callback_query.data) if callback_query.data else None
+    return {"route": route} if route is not None else False
+
+async def callback_dispatch_handler(callback_query: types.CallbackQuery, state: FSMContext, raw_state: Optional[str], route: Callable[[types.CallbackQuery, FSMContext], Awaitable[Any]]):
+    """Передає callback-запит хендлеру, знайденому callback_route_filter."""
+    await call_route(route, callback_query, state, raw_state)
+
+# == ФУНКЦІЯ РЕЄСТРАЦІЇ ХЕНДЛЕРІВ ==
+def register_telegram_handlers(dp: Dispatcher):
+    """
+    Реєструє всі хендлери та FSM стани у Aiogram Dispatcher.
+    Викликається один раз при імпорті модуля.
+    """
+    # Фільтри у стилі aiogram 3: Command(...) і стан FSM позиційно; ключові аргументи
+    # commands=/state=/content_types= з aiogram 2 register() відхиляє винятком
+    # Команди
+    dp.message.register(start_command_handler, Command("start"))
+    dp.message.register(summary_command_handler, Command("summary"))
+    dp.message.register(verify_command_handler, Command("verify"))
+    dp.message.register(rate_news_command_handler, Command("rate"))
+    dp.message.register(invite_friend_handler, Command("invite"))
+
+    # Кнопки меню (головне, AI-аналіз, налаштування, фільтри, додаткові функції)
+    dp.message.register(menu_dispatch_handler, lambda m: m.text in MENU_ROUTES)
 
 
     # Callback Query handlers
-    dp.callback_query.register(process_news_interaction_handler, lambda c: c.data.startswith('like_') or c.data.startswith('dislike_') or c.data.startswith('save_') or c.data.startswith('skip_'))
-    dp.callback_query.register(process_filter_type_handler, lambda c: c.data.startswith('filter_type_'))
-    dp.callback_query.register(add_feed_filter_handler, lambda c: c.data.startswith('add_feed_filter_'))
-    dp.callback_query.register(finish_create_feed_handler, lambda c: c.data == 'finish_create_feed')
-    dp.callback_query.register(process_switch_feed_handler, lambda c: c.data.startswith("switch_feed_"))
-    dp.callback_query.register(handle_buy_premium_callback, lambda c: c.data == "buy_premium")
-    dp.callback_query.register(request_email_input_callback, lambda c: c.data == "add_email" or c.data == "change_email")
-    dp.callback_query.register(unsubscribe_email_callback, lambda c: c.data == "unsubscribe_email")
-    dp.callback_query.register(process_view_mode_selection_callback, lambda c: c.data.startswith('set_view_mode_'))
-    dp.callback_query.register(process_subscribe_daily_callback, lambda c: c.data.startswith('subscribe_daily_'))
-    dp.callback_query.register(process_unsubscribe_daily_callback, lambda c: c.data == "unsubscribe_daily")
-    dp.callback_query.register(process_report_type_handler, lambda c: c.data.startswith('report_'))
-    dp.callback_query.register(request_interface_lang_callback, lambda c: c.data == "change_interface_lang")
-    dp.callback_query.register(toggle_news_translation_callback, lambda c: c.data == "toggle_news_translation")
-    dp.callback_query.register(process_source_type_callback, lambda c: c.data.startswith('source_type_'))
-    dp.callback_query.register(start_add_comment_callback, lambda c: c.data == "add_comment")
-    dp.callback_query.register(start_view_comments_callback, lambda c: c.data == "view_comments")
+    dp.callback_query.register(callback_dispatch_handler, callback_route_filter)
 
     # FSM handlers
-    dp.message.register(process_filter_value_handler, state=FilterStates.waiting_for_filter_tag)
-    dp.message.register(process_custom_feed_name_handler, state=CustomFeedStates.waiting_for_feed_name)
-    dp.message.register(process_feed_filter_value_handler, state=CustomFeedStates.waiting_for_feed_filters_tags)
-    dp.message.register(process_email_input_handler, state=ProfileSettingsStates.waiting_for_email)
-    dp.message.register(process_interface_lang_change_handler, state=ProfileSettingsStates.waiting_for_language_change)
-    dp.message.register(process_headline_rewrite_handler, state=AddNewsStates.waiting_for_title) # State for rewriting headline
-    dp.message.register(process_news_title_handler, state=AddNewsStates.waiting_for_title)
-    dp.message.register(process_news_content_handler, state=AddNewsStates.waiting_for_content)
-    dp.message.register(process_news_lang_handler, state=AddNewsStates.waiting_for_lang)
-    dp.message.register(process_news_country_handler, state=AddNewsStates.waiting_for_country)
-    dp.message.register(process_news_tags_handler, state=AddNewsStates.waiting_for_tags)
-    dp.message.register(process_news_source_name_handler, state=AddNewsStates.waiting_for_source_name)
-    dp.message.register(process_news_link_handler, state=AddNewsStates.waiting_for_link)
-    dp.message.register(process_news_media_handler, content_types=['photo', 'video', 'document', 'text'], state=AddNewsStates.waiting_for_media)
-    dp.message.register(process_source_name_handler, state=AddSourceStates.waiting_for_source_name)
-    dp.message.register(process_source_link_handler, state=AddSourceStates.waiting_for_source_link)
-    dp.message.register(process_news_id_for_report_handler, state=ReportNewsStates.waiting_for_news_id_for_report)
-    dp.message.register(process_report_reason_handler, state=ReportNewsStates.waiting_for_report_reason)
-    dp.message.register(process_feedback_message_handler, state=FeedbackStates.waiting_for_feedback_message)
-    dp.message.register(process_comment_news_id_handler, state=CommentStates.waiting_for_news_id)
-    dp.message.register(process_comment_content_handler, state=CommentStates.waiting_for_content)
-    dp.message.register(process_view_comments_news_id_handler, state=CommentStates.waiting_for_view_news_id)
+    dp.message.register(process_filter_value_handler, FilterStates.waiting_for_filter_tag)
+    dp.message.register(process_custom_feed_name_handler, CustomFeedStates.waiting_for_feed_name)
+    dp.message.register(process_feed_filter_value_handler, CustomFeedStates.waiting_for_feed_filters_tags)
+    dp.message.register(process_email_input_handler, ProfileSettingsStates.waiting_for_email)
+    dp.message.register(process_interface_lang_change_handler, ProfileSettingsStates.waiting_for_language_change)
+    dp.message.register(process_headline_rewrite_handler, AddNewsStates.waiting_for_title) # State for rewriting headline
+    dp.message.register(process_news_title_handler, AddNewsStates.waiting_for_title)
+    dp.message.register(process_news_content_handler, AddNewsStates.waiting_for_content)
+    dp.message.register(process_news_lang_handler, AddNewsStates.waiting_for_lang)
+    dp.message.register(process_news_country_handler, AddNewsStates.waiting_for_country)
+    dp.message.register(process_news_tags_handler, AddNewsStates.waiting_for_tags)
+    dp.message.register(process_news_source_name_handler, AddNewsStates.waiting_for_source_name)
+    dp.message.register(process_news_link_handler, AddNewsStates.waiting_for_link)
+    dp.message.register(process_news_media_handler, AddNewsStates.waiting_for_media, F.content_type.in_({ContentType.PHOTO, ContentType.VIDEO, ContentType.DOCUMENT, ContentType.TEXT}))
+    dp.message.register(process_source_name_handler, AddSourceStates.waiting_for_source_name)
+    dp.message.register(process_source_link_handler, AddSourceStates.waiting_for_source_link)
+    dp.message.register(process_news_id_for_report_handler, ReportNewsStates.waiting_for_news_id_for_report)
+    dp.message.register(process_report_reason_handler, ReportNewsStates.waiting_for_report_reason)
+    dp.message.register(process_feedback_message_handler, FeedbackStates.waiting_for_feedback_message)
+    dp.message.register(process_comment_news_id_handler, CommentStates.waiting_for_news_id)
+    dp.message.register(process_comment_content_handler, CommentStates.waiting_for_content)
+    dp.message.register(process_view_comments_news_id_handler, CommentStates.waiting_for_view_news_id)
 
     # Обробник невідомих повідомлень має бути останнім
     dp.message.register(unknown_message_handler)
 
-
-# Flask/FastAPI app definition
-app = FastAPI()
+# Хендлери реєструються один раз при імпорті модуля, а не в on_startup:
+# старт воркера займається лише БД, Redis і вебхуком
+register_telegram_handlers(dp)
 
 # Функція для запуску бота через webhook
 @app.on_event("startup")
 async def on_startup():
     logging.info("FastAPI додаток запускається...")
-    # Приклад: перевірка підключення до БД при старті
+    # Запит стану вебхука до Telegram не залежить від БД, тож іде паралельно зі створенням пулу
+    webhook_info_task = asyncio.create_task(bot.get_webhook_info())
+    # Створюємо пул підключень до БД, яким користуються всі ендпоінти та фонові задачі
     try:
-        conn = await get_db_connection()
-        await conn.close()
-        logging.info("Підключення до бази даних успішне.")
+        app.state.pool = await create_db_pool()
+        logging.info("Пул підключень до бази даних створено.")
     except Exception as e:
         logging.error(f"Помилка підключення до бази даних при старті: {e}")
+        webhook_info_task.cancel()
+        raise
+
+    # Клієнт Redis для кешу відповідей (якщо налаштовано)
+    app.state.redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
 
     # Set webhook
-    webhook_info = await bot.get_webhook_info()
+    webhook_info = await webhook_info_task
     if webhook_info.url != WEBHOOK_URL:
         await bot.set_webhook(url=WEBHOOK_URL)
         logging.info(f"Webhook встановлено на: {WEBHOOK_URL}")
     else:
         logging.info(f"Webhook вже встановлено на: {WEBHOOK_URL}")
 
-    # Register handlers
-    register_telegram_handlers(dp)
-    
-    # Start background task for auto notifications
-    asyncio.create_task(send_auto_notifications_task())
+    # З'єднання слухача news_added встановлює (і відновлює після розриву) news_listener_task
+    app.state.news_listener = None
+
+    # Start background tasks; посилання зберігаються, щоб зупинити їх при завершенні
+    app.state.background_tasks = [
+        # Автоматичні сповіщення за NOTIFY news_added (із запасним інтервалом 15 хвилин)
+        asyncio.create_task(auto_notifications_task()),
+        # Окреме з'єднання з LISTEN news_added із перепідключенням
+        asyncio.create_task(news_listener_task()),
+        # Оновлення матеріалізованих представлень щохвилини
+        asyncio.create_task(run_periodic("refresh_materialized_views", refresh_materialized_views, 60, jitter=5)),
+        # Пакетний запис активності користувачів
+        asyncio.create_task(flush_user_activity_task()),
+    ]
 
 @app.on_event("shutdown")
 async def on_shutdown():
     logging.warning('Завершення роботи...')
     await bot.delete_webhook()
+    # Зупиняємо фонові задачі до закриття пулу
+    for task in app.state.background_tasks:
+        task.cancel()
+    # Скасування news_listener_task закриває і з'єднання слухача
+    await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+    # Дописуємо події активності, що залишились у черзі та на повторі, до закриття пулу.
+    # Цикл скінченний: кожен невдалий пакет після ACTIVITY_MAX_ATTEMPTS спроб іде в журнал помилок
+    while not activity_queue.empty() or _activity_retry:
+        try:
+            await flush_user_activity()
+        except Exception as e:
+            logging.error(f"Помилка запису активності користувачів при завершенні: {e}")
+    await app.state.pool.close()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
     await dp.storage.close()
     await bot.session.close()
     logging.warning('Завершено.')
@@ -2305,7 +2970,8 @@ async def on_shutdown():
 # Telegram Bot Webhook Endpoint
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
-    telegram_update = types.Update(**await request.json())
+    # pydantic розбирає й валідує сирі байти вебхука за один прохід, без проміжного дерева dict
+    telegram_update = types.Update.model_validate_json(await request.body(), context={"bot": bot})
     await dp.feed_update(bot, telegram_update)
     return {"ok": True}
 